@@ -26,9 +26,14 @@ __all__ = [
 
 import sys
 import dbus
+import time
 import logging
 
 
+# Used for measuring how long it takes before we can publish.
+_launch_time = time.time()
+
+
 # Set up the DBus main loop.
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib, Gio
@@ -56,9 +61,13 @@ if args.test:
 
 
 # Continue with normal loading...
-from friends.service.dispatcher import Dispatcher, DBUS_INTERFACE
-from friends.utils.base import Base, initialize_caches, _publish_lock
-from friends.utils.model import Model, prune_model
+from friends.service.dispatcher import Dispatcher, ManageTimers
+from friends.service.dispatcher import DBUS_INTERFACE
+from friends.utils.base import Base, initialize_caches, persist_caches
+from friends.utils.base import _publish_lock, _publish_queue, persist_snapshot
+from friends.utils.base import prune_into_snapshot
+from friends.utils.avatar import Avatar
+from friends.utils.model import Model
 from friends.utils.logging import initialize
 
 
@@ -84,9 +93,7 @@ def main():
     if args.list_protocols:
         from friends.utils.manager import protocol_manager
         for name in sorted(protocol_manager.protocols):
-            cls = protocol_manager.protocols[name]
-            package, dot, class_name = cls.__name__.rpartition('.')
-            print(class_name)
+            print(protocol_manager.class_name(name))
         return
 
     # Disallow multiple instances of friends-dispatcher
@@ -125,7 +132,21 @@ def main():
             'private',
             )
 
-    Dispatcher(gsettings, loop)
+    # Keep no more than this many bytes of avatars on disk.
+    Avatar.budget = gsettings.get_int('avatar-cache-size') * 1024 * 1024
+    # Avatars are only shown in notifications, so only fetch them ahead
+    # of time if there will be any.
+    Avatar.prefetching = notify_level != 'none'
+
+    # Stay alive between refreshes rather than exiting when idle.
+    ManageTimers.resident = gsettings.get_boolean('resident')
+    ManageTimers.trimmers.append(Avatar.pixbufs.clear)
+
+    dispatcher = Dispatcher(gsettings, loop)
+    # Poll each stream as often as it deserves, while we're around.
+    dispatcher.scheduler.start()
+    if ManageTimers.resident and gsettings.get_boolean('streaming'):
+        dispatcher.start_streams()
 
     # Don't initialize caches until the model is synchronized
     Model.connect('notify::synchronized', setup)
@@ -136,6 +157,14 @@ def main():
 
     log.info('Stopped friends-dispatcher main loop')
 
+    # Let the next launch skip rebuilding the caches from the model.
+    persist_caches()
+    # And let it poll only the streams that are due.
+    dispatcher.scheduler.persist()
+    # Leave snapshot readers with every row, until we're back.
+    persist_snapshot()
+    Avatar.persist()
+
     # This bit doesn't run until after the mainloop exits.
     if args.performance and yappi is not None:
         yappi.print_stats(sys.stdout, yappi.SORTTYPE_TTOT)
@@ -150,8 +179,9 @@ def setup(model, param):
     # approximately 16,000 rows. However, that seems like a lot to me, so
     # I'm going to set it to 2,000 for now and we can tweak this later if
     # necessary. Do you really need more than 2,000 tweets in memory at
-    # once? What are you doing with all these tweets?
-    prune_model(2000)
+    # once? What are you doing with all these tweets?  (If you do, the
+    # snapshot keeps more of them; see SNAPSHOT_ROWS.)
+    prune_into_snapshot(2000)
 
     # This builds two different indexes of our persisted Dee.Model
     # data for the purposes of faster duplicate checks.
@@ -161,6 +191,11 @@ def setup(model, param):
     with ignored(RuntimeError):
         # Allow publishing.
         _publish_lock.release()
+    # Publish whatever the protocols have fetched in the meantime.
+    _publish_queue.schedule()
+
+    log.info('Ready to publish {:.2f}s after launch'.format(
+        time.time() - _launch_time))
 
 
 if __name__ == '__main__':
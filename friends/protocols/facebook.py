@@ -25,7 +25,6 @@ import time
 import logging
 
 from friends.utils.base import Base, feature
-from friends.utils.cache import JsonCache
 from friends.utils.http import Downloader, Uploader
 from friends.utils.time import parsetime, iso8601utc
 from friends.errors import FriendsError
@@ -47,9 +46,11 @@ log = logging.getLogger(__name__)
 
 
 class Facebook(Base):
-    def __init__(self, account):
-        super().__init__(account)
-        self._timestamps = PostIdCache(self._name + '_ids')
+    _POLL_STREAMS = ('home', 'wall')
+    # The Graph API allows about 200 calls per user per hour.
+    _HOURLY_LIMIT = 200
+    # OAuthException codes for invalid and expired sessions.
+    _AUTH_ERROR_CODES = frozenset((102, 190))
 
     def _whoami(self, authdata):
         """Identify the authenticating user."""
@@ -124,12 +125,11 @@ class Facebook(Base):
         timestamp = entry.get('updated_time', entry.get('created_time'))
         if timestamp is not None:
             timestamp = args['timestamp'] = iso8601utc(parsetime(timestamp))
-            # We need to record timestamps for use with since=. Note that
-            # _timestamps is a special dict subclass that only accepts
-            # timestamps that are larger than the existing value, so at any
-            # given time it will map the stream to the most
-            # recent timestamp we've seen for that stream.
-            self._timestamps[stream] = timestamp
+            # We need to record timestamps for use with since=.  Marks only
+            # move forwards, so at any given time this is the most recent
+            # timestamp we've seen for that stream.  Thank SCIENCE for
+            # lexically-sortable timestamp strings!
+            self._set_mark(timestamp, stream)
 
         # Publish this message into the SharedModel.
         self._publish(**args)
@@ -144,21 +144,30 @@ class Facebook(Base):
 
     def _follow_pagination(self, url, params, limit=None):
         """Follow Facebook's pagination until we hit the limit."""
+        return list(self._iter_pagination(url, params, limit))
+
+    def _iter_pagination(self, url, params, limit=None):
+        """Yield entries from Facebook's pagination until we hit the limit.
+
+        Pages can be big, so their entries are decoded and handed over
+        one at a time.
+        """
         limit = limit or self._DOWNLOAD_LIMIT
-        entries = []
+        count = 0
 
         while True:
-            response = Downloader(url, params).get_json()
+            response = {}
+            for entry in Downloader(url, params).iter_json('data', response):
+                count += 1
+                yield entry
 
             if self._is_error(response):
                 break
 
-            data = response.get('data')
-            if data is None:
+            if response.get('data') is None:
                 break
 
-            entries.extend(data)
-            if len(entries) >= limit:
+            if count >= limit:
                 break
 
             # We haven't gotten the requested number of entries.  Follow the
@@ -176,7 +185,6 @@ class Facebook(Base):
                 break
 
         # We've gotten everything Facebook is going to give us.
-        return entries
 
     def _get(self, url, stream):
         """Retrieve a list of Facebook objects.
@@ -184,8 +192,9 @@ class Facebook(Base):
         A maximum of 50 objects are requested.
         """
         access_token = self._get_access_token()
-        since = self._timestamps.get(
-            stream, iso8601utc(int(time.time()) - TEN_DAYS))
+        since = self._get_mark(stream)
+        if since is None:
+            since = iso8601utc(int(time.time()) - TEN_DAYS)
 
         entries = []
         params = dict(access_token=access_token,
@@ -224,6 +233,9 @@ class Facebook(Base):
         params = dict(
             access_token=access_token,
             q=query)
+        since = self._get_mark('search/{}'.format(query))
+        if since is not None:
+            params['since'] = since
 
         entries = self._follow_pagination(url, params)
         # https://developers.facebook.com/docs/reference/api/post/
@@ -347,13 +359,13 @@ class Facebook(Base):
     @feature
     def contacts(self):
         access_token=self._get_access_token()
-        contacts = self._follow_pagination(
+        contacts = self._iter_pagination(
             url=ME_URL + '/friends',
             params=dict(access_token=access_token, limit=1000),
             limit=1000)
-        log.debug('Found {} contacts'.format(len(contacts)))
 
-        for contact in contacts:
+        count = 0
+        for count, contact in enumerate(contacts, 1):
             contact_id = contact.get('id')
             if not self._previously_stored_contact(contact_id):
                 full_contact = Downloader(
@@ -367,17 +379,5 @@ class Facebook(Base):
                     gender=full_contact.get('gender'),
                     jabber='-{}@chat.facebook.com'.format(contact_id))
 
-        return len(contacts)
-
-
-class PostIdCache(JsonCache):
-    """Persist most-recent timestamps as JSON."""
-
-    def __setitem__(self, key, value):
-        if key.find('/') >= 0:
-            # Don't flood the cache with irrelevant "reply_to/..." and
-            # "search/..." streams, we only need the main streams.
-            return
-        # Thank SCIENCE for lexically-sortable timestamp strings!
-        if value > self.get(key, ''):
-            JsonCache.__setitem__(self, key, value)
+        log.debug('Found {} contacts'.format(count))
+        return count
@@ -54,7 +54,18 @@ PEOPLE_URL = 'http://www.flickr.com/people/{owner}'
 PHOTOID = re.compile('<photoid>(\d+)</photoid>').search
 
 
+def _upload_date(photo):
+    """Return when a photo was uploaded, in seconds since the epoch."""
+    try:
+        return int(photo.get('dateupload', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
 class Flickr(Base):
+    # Per API key, which every user of friends shares.
+    _HOURLY_LIMIT = 3600
+
     def _whoami(self, authdata):
         """Identify the authenticating user."""
         self._account.secret_token = authdata.get('TokenSecret')
@@ -114,8 +125,11 @@ class Flickr(Base):
             extras='date_upload,owner_name,icon_server,geo',
             )
 
-        response = self._get_url(args)
-        for data in response.get('photos', {}).get('photo', []):
+        # getContactsPhotos has no way to ask for only the photos
+        # uploaded since last time, so skip the older ones ourselves.
+        newest = self._get_mark('images')
+        photos = self._get_url(args).get('photos', {}).get('photo', [])
+        for data in photos:
             # Pre-calculate some values to publish.
             username = data.get('username', '')
             ownername = data.get('ownername', '')
@@ -125,6 +139,9 @@ class Flickr(Base):
                 # Can't do anything without this, really.
                 continue
 
+            if newest is not None and _upload_date(data) <= newest:
+                continue
+
             # Icons.
             icon_farm = data.get('iconfarm')
             icon_server = data.get('iconserver')
@@ -175,6 +192,8 @@ class Flickr(Base):
                 latitude=data.get('latitude', 0.0),
                 longitude=data.get('longitude', 0.0),
                 )
+        if photos:
+            self._set_mark(max(map(_upload_date, photos)), 'images')
         return self._get_n_rows()
 
 # http://www.flickr.com/services/api/upload.api.html
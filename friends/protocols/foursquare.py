@@ -56,6 +56,9 @@ def _full_name(user):
 
 
 class FourSquare(Base):
+    # Per OAuth token.
+    _HOURLY_LIMIT = 500
+
     def _whoami(self, authdata):
         """Identify the authenticating user."""
         data = Downloader(
@@ -70,7 +73,11 @@ class FourSquare(Base):
         """Gets a list of each friend's most recent check-ins."""
         token = self._get_access_token()
 
-        result = Downloader(RECENT_URL.format(access_token=token)).get_json()
+        url = RECENT_URL.format(access_token=token)
+        newest = self._get_mark()
+        if newest is not None:
+            url += '&afterTimestamp={}'.format(newest)
+        result = Downloader(url).get_json()
 
         response_code = result.get('meta', {}).get('code')
         if response_code != 200:
@@ -99,4 +106,7 @@ class FourSquare(Base):
                 latitude=location.get('lat', 0.0),
                 longitude=location.get('lng', 0.0),
                 )
+        if checkins:
+            self._set_mark(max(checkin.get('createdAt', 0)
+                               for checkin in checkins))
         return self._get_n_rows()
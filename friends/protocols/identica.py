@@ -39,6 +39,9 @@ class Identica(Twitter):
     _favorite = _api_base.format(endpoint='favorites/create/{}')
     _del_favorite = _api_base.format(endpoint='favorites/destroy/{}')
 
+    # Identi.ca has no streaming API.
+    _user_stream = None
+
     _user_home = 'https://identi.ca/{user_id}'
     _tweet_permalink = 'http://identi.ca/notice/{tweet_id}'
 
@@ -34,6 +34,10 @@ log = logging.getLogger(__name__)
 
 class Instagram(Base):
     _api_base = 'https://api.instagram.com/v1/{endpoint}?access_token={token}'
+    _POLL_STREAMS = ('home',)
+    # Per access token.
+    _HOURLY_LIMIT = 5000
+
     def _whoami(self, authdata):
         """Identify the authenticating user."""
         url = self._api_base.format(
@@ -43,6 +47,14 @@ class Instagram(Base):
         self._account.user_id = result.get('data').get('id')
         self._account.user_name = result.get('data').get('username')
 
+    def _convert_mark(self, value):
+        """Media ids look like '<media>_<user>', and sort by the media.
+
+        As strings, '99_1' would sort after '100_1'.  min_id takes the
+        media part on its own, so that's all the mark keeps.
+        """
+        return int(str(value).split('_')[0])
+
     def _publish_entry(self, entry, stream='messages'):
         """Publish a single update into the Dee.SharedModel."""
         message_id = entry.get('id')
@@ -139,10 +151,16 @@ class Instagram(Base):
         url = self._api_base.format(
             endpoint='users/self/feed',
             token=self._get_access_token())
+        newest = self._get_mark()
+        if newest is not None:
+            url += '&min_id={}'.format(newest)
         result = Downloader(url).get_json()
         values = result.get('data', {})
         for update in values:
             self._publish_entry(update)
+        # The feed comes newest first.
+        if values and values[0].get('id'):
+            self._set_mark(values[0].get('id'))
 
     @feature
     def receive(self):
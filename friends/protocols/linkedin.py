@@ -39,6 +39,9 @@ def make_fullname(firstName=None, lastName=None, **ignored):
 class LinkedIn(Base):
     _api_base = ('https://api.linkedin.com/v1/{endpoint}?format=json' +
                  '&secure-urls=true&oauth2_access_token={token}')
+    _POLL_STREAMS = ('home',)
+    # Network updates are throttled to about 500 calls per user per day.
+    _HOURLY_LIMIT = 20
 
     def _whoami(self, authdata):
         """Identify the authenticating user."""
@@ -92,9 +95,16 @@ class LinkedIn(Base):
         url = self._api_base.format(
             endpoint='people/~/network/updates',
             token=self._get_access_token()) + '&type=STAT'
-        result = Downloader(url).get_json()
-        for update in result.get('values', []):
+        newest = self._get_mark()
+        if newest is not None:
+            url += '&after={}'.format(newest)
+        updates = Downloader(url).get_json().get('values', [])
+        for update in updates:
             self._publish_entry(update)
+        if updates:
+            # LinkedIn timestamps are in milliseconds, as is 'after'.
+            self._set_mark(max(update.get('timestamp', 0)
+                               for update in updates))
         return self._get_n_rows()
 
     @feature
@@ -110,9 +120,10 @@ class LinkedIn(Base):
             url=self._api_base.format(
                 endpoint='people/~/connections',
                 token=self._get_access_token())
-        ).get_json().get('values', [])
+        ).iter_json('values')
 
-        for connection in connections:
+        count = 0
+        for count, connection in enumerate(connections, 1):
             uid = connection.get('id', 'private')
             fullname = make_fullname(**connection)
             if uid != 'private' and not self._previously_stored_contact(uid):
@@ -122,4 +133,4 @@ class LinkedIn(Base):
                     link=connection.get(
                         'siteStandardProfileRequest', {}).get('url'))
 
-        return len(connections)
+        return count
@@ -23,13 +23,17 @@ __all__ = [
 
 
 import time
+import queue
 import logging
+import threading
 
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 
-from friends.utils.base import Base, feature
+from friends.utils import jsoncodec
+from friends.utils.base import Base, _OperationThread, feature
 from friends.utils.cache import JsonCache
 from friends.utils.http import BaseRateLimiter, Downloader
+from friends.utils.stream import StreamReceiver
 from friends.utils.time import parsetime, iso8601utc
 from friends.errors import FriendsError, ignored
 
@@ -61,14 +65,37 @@ class Twitter(Base):
     _favorite = _api_base.format(endpoint='favorites/create')
     _del_favorite = _api_base.format(endpoint='favorites/destroy')
 
+    # https://dev.twitter.com/docs/api/1.1/get/user
+    _user_stream = 'https://userstream.twitter.com/1.1/user.json'
+
     _user_home = 'https://twitter.com/{user_id}'
     _tweet_permalink = _user_home + '/status/{tweet_id}'
 
+    _POLL_STREAMS = ('home', 'mentions', 'private')
+
+    # "Could not authenticate you" and "Invalid or expired token".
+    _AUTH_ERROR_CODES = frozenset((32, 89))
+
+    # The most tweets that the timeline APIs return in one page.
+    _MAX_PAGE_SIZE = 200
+
+    # How many pages to go back looking for tweets that were skipped
+    # because they didn't fit in the page that we first asked for.
+    _BACKFILL_PAGES = 5
+
+    # How many lists lists() fetches at the same time.
+    _LIST_WORKERS = 4
+
     def __init__(self, account):
         super().__init__(account)
         self._rate_limiter = RateLimiter()
-        # Can be 'twitter_ids' or 'identica_ids'
-        self._tweet_ids = TweetIdCache(self._name + '_ids')
+        # Timeline urls mapped to how many tweets to ask them for.
+        self._page_sizes = {}
+        self._backfilling = set()
+        # Timeline urls mapped to the gaps that are still to be filled.
+        self._gaps = {}
+        self._backfill_lock = threading.Lock()
+        self._stream = None
 
     def _whoami(self, authdata):
         """Identify the authenticating user."""
@@ -76,6 +103,67 @@ class Twitter(Base):
         self._account.user_id = authdata.get('UserId')
         self._account.user_name = authdata.get('ScreenName')
 
+    def _convert_mark(self, value):
+        """Tweet ids only sort correctly as numbers."""
+        return int(value)
+
+    def _poll_floor(self, stream, requests=1):
+        """Don't poll a timeline faster than its rate limit allows."""
+        url = dict(
+            home=self._timeline.format('home'),
+            mentions=self._mentions_timeline,
+            private=self._api_base.format(endpoint='direct_messages'),
+            ).get(stream)
+        floor = super()._poll_floor(stream, requests)
+        if url is None:
+            return floor
+        return max(floor, self._rate_limiter.delay(url))
+
+    def _start_stream(self):
+        """Publish tweets from the user stream as they are posted."""
+        if self._user_stream is None:
+            return False
+        if self._stream is None:
+            self._stream = StreamReceiver(
+                '{} {}'.format(self._Name, self._account.id),
+                self._open_stream, self._stream_event)
+            self._stream.start()
+        return True
+
+    def _stop_stream(self):
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream = None
+
+    def _open_stream(self):
+        """Connect to the user stream, with correct OAuth signed headers."""
+        headers = self._get_oauth_headers(method='GET', url=self._user_stream)
+        return Downloader(self._user_stream, headers=headers).open_stream()
+
+    def _stream_event(self, event):
+        """Publish or unpublish whatever the user stream sent us.
+
+        Streamed tweets leave the marks alone.  Those say how far the
+        timelines have been polled, and tweets that were posted while the
+        stream was disconnected are only fetched by polling from them.
+        """
+        if 'direct_message' in event:
+            self._publish_tweet(
+                event['direct_message'], stream='private', mark=False)
+        elif 'delete' in event:
+            status = event['delete'].get('status', {})
+            with ignored(FriendsError):
+                self._unpublish(status.get('id_str'))
+        elif 'text' in event:
+            mentions = event.get('entities', {}).get('user_mentions', [])
+            if any(mention.get('id_str') == self._account.user_id
+                   for mention in mentions):
+                self._publish_tweet(event, stream='mentions', mark=False)
+            else:
+                self._publish_tweet(event, mark=False)
+        # Anything else is a friends list, favorite or follow event,
+        # which we have nowhere to show.
+
     def _get_url(self, url, data=None):
         """Access the Twitter API with correct OAuth signed headers."""
         do_post = data is not None
@@ -93,19 +181,19 @@ class Twitter(Base):
         self._is_error(response)
         return response
 
-    def _publish_tweet(self, tweet, stream='messages'):
+    def _publish_tweet(self, tweet, stream='messages', mark=True):
         """Publish a single tweet into the Dee.SharedModel."""
         tweet_id = tweet.get('id_str') or str(tweet.get('id', ''))
         if not tweet_id:
             log.info('Ignoring tweet with no id_str value')
             return
 
-        # We need to record tweet_ids for use with since_id. Note that
-        # _tweet_ids is a special dict subclass that only accepts
-        # tweet_ids that are larger than the existing value, so at any
-        # given time it will map the stream to the largest (most
-        # recent) tweet_id we've seen for that stream.
-        self._tweet_ids[stream] = tweet_id
+        # We need to record tweet_ids for use with since_id. Marks only
+        # move forwards, so at any given time this is the largest (most
+        # recent) tweet_id we've seen for that stream.  While there is a
+        # gap in the stream, the mark stays below it until it's filled.
+        if mark and not self._has_gap(stream):
+            self._set_mark(tweet_id, stream)
 
         # 'user' for tweets, 'sender' for direct messages.
         user = tweet.get('user', {}) or tweet.get('sender', {})
@@ -200,21 +288,123 @@ class Twitter(Base):
     def _linkify(self, address, name):
         return '<a href="{}">{}</a>'.format(address, name)
 
-    def _append_since(self, url, stream='messages'):
-        since = self._tweet_ids.get(stream)
+    def _append_since(self, url, stream='messages', since=None):
+        if since is None:
+            since = self._get_mark(stream)
         if since is not None:
             return '{}&since_id={}'.format(url, since)
         return url
 
+    def _page_size(self, url):
+        """Return how many tweets to ask for from a timeline url."""
+        return self._page_sizes.get(url, self._DOWNLOAD_LIMIT)
+
+    def _poll_since(self, url, stream='messages'):
+        """Return the since_id to poll a timeline with.
+
+        While a gap in the timeline is being filled, the stream's mark
+        stays below the gap, so new tweets are polled for from the
+        newest one that we already have instead.
+        """
+        with self._backfill_lock:
+            gap = self._gaps.get(url)
+            if gap is not None:
+                return gap['top']
+        return self._get_mark(stream)
+
+    def _has_gap(self, stream):
+        with self._backfill_lock:
+            return any(gap['stream'] == stream for gap in self._gaps.values())
+
+    def _check_page(self, url, tweets, since, stream='messages'):
+        """Adapt the page size to a timeline, and fill any gap in it.
+
+        A full page of tweets newer than since_id means that there were
+        probably more new tweets than we asked for, and the ones older
+        than this page were skipped.  Those get fetched in a background
+        thread, and busy timelines get asked for bigger pages.
+
+        The stream's mark doesn't move past the gap until the backfill
+        gets back to the old since_id.  A backfill that fails or gives up
+        leaves the rest of the gap for the next poll to carry on with,
+        and if friends-dispatcher exits in the meantime, the mark makes
+        it poll the gap again.  So call this before publishing tweets.
+        """
+        count = self._page_size(url)
+        full = len(tweets) >= count
+        if not full and len(tweets) < count // 4:
+            self._page_sizes[url] = max(count // 2, self._DOWNLOAD_LIMIT)
+        elif full:
+            self._page_sizes[url] = min(count * 2, self._MAX_PAGE_SIZE)
+        with self._backfill_lock:
+            gap = self._gaps.get(url)
+            if full and since is not None:
+                top = _newest_id(tweets)
+                if gap is None:
+                    gap = self._gaps[url] = dict(
+                        since=since, stream=stream, top=top)
+                else:
+                    gap['top'] = max(gap['top'], top)
+                # Everything between since and this page is missing.
+                gap['max_id'] = _oldest_id(tweets) - 1
+            elif gap is not None and tweets:
+                gap['top'] = max(gap['top'], _newest_id(tweets))
+            if gap is None or url in self._backfilling:
+                return
+            self._backfilling.add(url)
+        _OperationThread(
+            id='{}._backfill'.format(self._Name), quiet=True,
+            target=self._backfill, args=(url,),
+            ).start()
+
+    def _backfill(self, url):
+        """Page backwards through a timeline's gap, until it's filled."""
+        try:
+            for page in range(self._BACKFILL_PAGES):
+                with self._backfill_lock:
+                    gap = self._gaps[url]
+                    since, max_id = gap['since'], gap['max_id']
+                tweets = self._get_url(
+                    '{}?count={}&since_id={}&max_id={}'.format(
+                        url, self._MAX_PAGE_SIZE, since, max_id))
+                for tweet in tweets:
+                    self._publish_tweet(tweet, stream=gap['stream'])
+                with self._backfill_lock:
+                    if gap['max_id'] != max_id:
+                        # A poll found a newer gap, which reaches down
+                        # to this one, so start again from the top of it.
+                        continue
+                    if len(tweets) >= self._MAX_PAGE_SIZE:
+                        gap['max_id'] = _oldest_id(tweets) - 1
+                        continue
+                    del self._gaps[url]
+                    # Another gap in the same stream holds the mark back
+                    # until it's filled too.
+                    others = [other for other in self._gaps.values()
+                              if other['stream'] == gap['stream']]
+                    for other in others:
+                        other['top'] = max(other['top'], gap['top'])
+                if not others:
+                    self._set_mark(gap['top'], gap['stream'])
+                log.debug('Backfilled {} in {} pages'.format(url, page + 1))
+                return
+            log.info('Stopped backfilling {} after {} pages'.format(
+                url, self._BACKFILL_PAGES))
+        finally:
+            with self._backfill_lock:
+                self._backfilling.discard(url)
+
 # https://dev.twitter.com/docs/api/1.1/get/statuses/home_timeline
     @feature
     def home(self):
         """Gather the user's home timeline."""
-        url = '{}?count={}'.format(
-            self._timeline.format('home'),
-            self._DOWNLOAD_LIMIT)
-        url = self._append_since(url)
-        for tweet in self._get_url(url):
+        timeline = self._timeline.format('home')
+        since = self._poll_since(timeline)
+        url = '{}?count={}'.format(timeline, self._page_size(timeline))
+        url = self._append_since(url, since=since)
+        tweets = self._get_url(url)
+        self._check_page(timeline, tweets, since)
+        for tweet in tweets:
             self._publish_tweet(tweet)
         return self._get_n_rows()
 
@@ -222,11 +412,13 @@ class Twitter(Base):
     @feature
     def mentions(self):
         """Gather the tweets that mention us."""
-        url = '{}?count={}'.format(
-            self._mentions_timeline,
-            self._DOWNLOAD_LIMIT)
-        url = self._append_since(url, 'mentions')
-        for tweet in self._get_url(url):
+        timeline = self._mentions_timeline
+        since = self._poll_since(timeline, 'mentions')
+        url = '{}?count={}'.format(timeline, self._page_size(timeline))
+        url = self._append_since(url, 'mentions', since)
+        tweets = self._get_url(url)
+        self._check_page(timeline, tweets, since, 'mentions')
+        for tweet in tweets:
             self._publish_tweet(tweet, stream='mentions')
         return self._get_n_rows()
 
@@ -239,7 +431,11 @@ class Twitter(Base):
         currently authenticated user.
         """
         url = self._user_timeline.format(screen_name)
-        stream = 'user/{}'.format(screen_name) if screen_name else 'messages'
+        if screen_name:
+            stream = 'user/{}'.format(screen_name)
+            url = self._append_since(url, stream)
+        else:
+            stream = 'messages'
         for tweet in self._get_url(url):
             self._publish_tweet(tweet, stream=stream)
         return self._get_n_rows()
@@ -248,38 +444,94 @@ class Twitter(Base):
     @feature
     def list(self, list_id):
         """Gather the tweets from the specified list_id."""
-        url = self._lists.format(list_id)
+        stream = 'list/{}'.format(list_id)
+        url = self._append_since(self._lists.format(list_id), stream)
         for tweet in self._get_url(url):
-            self._publish_tweet(tweet, stream='list/{}'.format(list_id))
+            self._publish_tweet(tweet, stream=stream)
         return self._get_n_rows()
 
 # https://dev.twitter.com/docs/api/1.1/get/lists/list
     @feature
     def lists(self):
-        """Gather the tweets from the lists that the we are subscribed to."""
+        """Gather the tweets from the lists that the we are subscribed to.
+
+        :return: A JSON object mapping each list id to how many new
+            tweets it added, or to the error that fetching it raised.
+        :rtype: str
+        """
         url = self._api_base.format(endpoint='lists/list')
-        for twitlist in self._get_url(url):
-            self.list(twitlist.get('id_str', ''))
-        return self._get_n_rows()
+        list_ids = [
+            twitlist.get('id_str', '') for twitlist in self._get_url(url)]
+        results = self._fetch_lists(list_ids)
+        log.debug('{} lists refreshed, new tweets per list: {}'.format(
+            len(results), results))
+        return jsoncodec.dumps(results, compact=True)
+
+    def _fetch_lists(self, list_ids):
+        """Fetch several lists at once, with up to _LIST_WORKERS threads.
+
+        All the workers go through the same rate limiter, so together
+        they still keep within the lists/statuses budget.
+
+        :return: How many new tweets each list added to the model,
+            keyed by list id, or the error message for the lists that
+            failed.
+        :rtype: dict
+        """
+        pending = queue.Queue()
+        for list_id in list_ids:
+            pending.put(list_id)
+        results = {}
+        workers = [
+            _OperationThread(
+                id='{}._list_worker'.format(self._Name), quiet=True,
+                target=self._list_worker, args=(pending, results))
+            for i in range(min(self._LIST_WORKERS, len(list_ids)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # Charge the workers' counts to whoever asked for the lists.
+        thread = threading.current_thread()
+        for counter in ('new_rows', 'duplicate_rows', 'bytes_downloaded',
+                        'pages', 'contacts'):
+            if hasattr(thread, counter):
+                setattr(thread, counter, getattr(thread, counter) + sum(
+                    getattr(worker, counter) for worker in workers))
+        return results
+
+    def _list_worker(self, pending, results):
+        """Fetch lists from the pending queue until it is empty."""
+        thread = threading.current_thread()
+        while True:
+            try:
+                list_id = pending.get_nowait()
+            except queue.Empty:
+                return
+            before = thread.new_rows
+            try:
+                self.list(list_id)
+            except Exception as error:
+                log.error('Failed to fetch list {}: {}'.format(
+                    list_id, error))
+                results[list_id] = str(error)
+            else:
+                results[list_id] = thread.new_rows - before
 
 # https://dev.twitter.com/docs/api/1.1/get/direct_messages
 # https://dev.twitter.com/docs/api/1.1/get/direct_messages/sent
     @feature
     def private(self):
         """Gather the direct messages sent to/from us."""
-        url = '{}?count={}'.format(
-            self._api_base.format(endpoint='direct_messages'),
-            self._DOWNLOAD_LIMIT)
-        url = self._append_since(url, 'private')
-        for tweet in self._get_url(url):
-            self._publish_tweet(tweet, stream='private')
-
-        url = '{}?count={}'.format(
-            self._api_base.format(endpoint='direct_messages/sent'),
-            self._DOWNLOAD_LIMIT)
-        url = self._append_since(url, 'private')
-        for tweet in self._get_url(url):
-            self._publish_tweet(tweet, stream='private')
+        for endpoint in ('direct_messages', 'direct_messages/sent'):
+            timeline = self._api_base.format(endpoint=endpoint)
+            since = self._poll_since(timeline, 'private')
+            url = '{}?count={}'.format(timeline, self._page_size(timeline))
+            url = self._append_since(url, 'private', since)
+            tweets = self._get_url(url)
+            self._check_page(timeline, tweets, since, 'private')
+            for tweet in tweets:
+                self._publish_tweet(tweet, stream='private')
         return self._get_n_rows()
 
     @feature
@@ -396,11 +648,13 @@ class Twitter(Base):
     @feature
     def search(self, query):
         """Search for any arbitrary string."""
-        url = self._search
+        stream = 'search/{}'.format(query)
+        url = self._append_since(
+            '{}?q={}'.format(self._search, quote(query, safe='')), stream)
 
-        response = self._get_url('{}?q={}'.format(url, quote(query, safe='')))
+        response = self._get_url(url)
         for tweet in response.get(self._search_result_key, []):
-            self._publish_tweet(tweet, stream='search/{}'.format(query))
+            self._publish_tweet(tweet, stream=stream)
         return self._get_n_rows()
 
     @feature
@@ -428,17 +682,16 @@ class Twitter(Base):
         return len(contacts)
 
 
-class TweetIdCache(JsonCache):
-    """Persist most-recent tweet_ids as JSON."""
+def _oldest_id(tweets):
+    """Return the smallest tweet id in a page of tweets."""
+    return min(int(tweet.get('id_str') or tweet.get('id', 0))
+               for tweet in tweets)
 
-    def __setitem__(self, key, value):
-        if key.find('/') >= 0:
-            # Don't flood the cache with irrelevant "reply_to/..." and
-            # "search/..." streams, we only need the main streams.
-            return
-        value = int(value)
-        if value > self.get(key, 0):
-            JsonCache.__setitem__(self, key, value)
+
+def _newest_id(tweets):
+    """Return the largest tweet id in a page of tweets."""
+    return max(int(tweet.get('id_str') or tweet.get('id', 0))
+               for tweet in tweets)
 
 
 class RateLimiter(BaseRateLimiter):
@@ -446,18 +699,38 @@ class RateLimiter(BaseRateLimiter):
 
     def __init__(self):
         self._limits = JsonCache('twitter-ratelimiter')
+        # Several threads can share this rate limiter, such as when
+        # lists() fetches lists in parallel.  Each request claims the
+        # next free slot for its URL, so that concurrent requests are
+        # spaced out just like consecutive ones would be.
+        self._lock = threading.Lock()
+        self._spacing = {}
+        self._next_slot = {}
 
     def _sanitize_url(self, uri):
         # Cache the URL sans any query parameters.
         return uri.host + uri.path
 
+    def delay(self, url):
+        """Return how long the next access to url will have to wait."""
+        parts = urlsplit(url)
+        return self._limits.get(parts.netloc + parts.path, 0)
+
     def wait(self, message):
-        # If we haven't seen this URL, default to no wait.
-        seconds = self._limits.pop(self._sanitize_url(message.get_uri()), 0)
+        url = self._sanitize_url(message.get_uri())
+        with self._lock:
+            now = time.time()
+            # If we haven't seen this URL, default to no wait.
+            seconds = self._limits.pop(url, 0)
+            if seconds:
+                self._spacing[url] = seconds
+            start = max(now + seconds, self._next_slot.get(url, 0))
+            self._next_slot[url] = start + self._spacing.get(url, 0)
+            # Don't sleep the same length of time more than once!
+            self._limits.write()
+        seconds = start - now
         log.debug('Sleeping for {} seconds!'.format(seconds))
         time.sleep(seconds)
-        # Don't sleep the same length of time more than once!
-        self._limits.write()
 
     def update(self, message):
         info = message.response_headers
@@ -471,17 +744,19 @@ class RateLimiter(BaseRateLimiter):
             rate_reset = int(rate_reset)
             rate_count = int(rate_count)
             rate_delta = abs(rate_reset - time.time())
-            if rate_count > 5:
-                # If there are more than 5 calls allowed in this window, then
-                # do no rate limiting.
-                pass
-            elif rate_count < 1:
-                # There are no calls remaining, so wait until the close of the
-                # current window.
-                self._limits[url] = rate_delta
-            else:
-                wait_secs = rate_delta / rate_count
-                self._limits[url] = wait_secs
+            with self._lock:
+                if rate_count > 5:
+                    # If there are more than 5 calls allowed in this window,
+                    # then do no rate limiting.
+                    self._spacing.pop(url, None)
+                    self._next_slot.pop(url, None)
+                elif rate_count < 1:
+                    # There are no calls remaining, so wait until the close
+                    # of the current window.
+                    self._limits[url] = rate_delta
+                else:
+                    wait_secs = rate_delta / rate_count
+                    self._limits[url] = wait_secs
             log.debug(
                 'Next access to {} must wait {} seconds!'.format(
                     url, self._limits.get(url, 0)))
@@ -20,22 +20,30 @@ __all__ = [
     ]
 
 
-import json
+import gc
 import logging
 import threading
 
+from collections import Counter
+
 import dbus
 import dbus.service
 
 from gi.repository import GLib
 from contextlib import ContextDecorator
 
+from friends.utils import jsoncodec
 from friends.utils.account import find_accounts
+from friends.utils.avatar import Avatar
+from friends.utils.base import SNAPSHOT_PATH, STREAM_IDX, _OperationThread
+from friends.utils.base import persist_caches, persist_snapshot
 from friends.utils.manager import protocol_manager
 from friends.utils.menus import MenuManager
 from friends.utils.model import Model, persist_model
+from friends.utils.scheduler import PollScheduler
 from friends.utils.shorteners import Short
-from friends.errors import ignored
+from friends.utils.stream import StreamReceiver
+from friends.errors import FriendsError, ignored
 
 
 log = logging.getLogger(__name__)
@@ -43,16 +51,36 @@ log = logging.getLogger(__name__)
 DBUS_INTERFACE = 'com.canonical.Friends.Dispatcher'
 STUB = lambda *ignore, **kwignore: None
 
+# Only new rows in these streams count as unread, not the search
+# results, lists and threads that somebody explicitly asked for.
+UNREAD_STREAMS = ('messages', 'mentions', 'private', 'images')
+
+# Update the messaging menu's unread count at most once this many
+# milliseconds, rather than once for every row of a refresh.
+UNREAD_DELAY = 1000
+
+# Rewrite the model snapshot this many seconds after the model changes,
+# so that a whole refresh ends up in one new snapshot.
+SNAPSHOT_DELAY = 10
+
 
 # Avoid race condition during shut-down
 _exit_lock = threading.Lock()
 
 
 class ManageTimers(ContextDecorator):
-    """Exit the dispatcher 30s after the most recent method call returns."""
+    """Exit the dispatcher 30s after the most recent method call returns.
+
+    In resident mode, the dispatcher stays alive instead, keeping its
+    accounts logged in and its caches warm for the next refresh, and
+    only trims back its memory use once it has gone idle.
+    """
     timers = set()
     callback = STUB
     timeout = 30
+    resident = False
+    # Callables that release cached data when we go idle in resident mode.
+    trimmers = []
 
     def __enter__(self):
         self.clear_all_timers()
@@ -76,14 +104,33 @@ class ManageTimers(ContextDecorator):
     def terminate(self, *ignore):
         """Exit the dispatcher, but only if there are no active subthreads."""
         with _exit_lock:
-            if threading.activeCount() < 2:
-                log.debug('No threads found, shutting down.')
-                persist_model()
-                self.timers.add(GLib.idle_add(self.callback))
+            # Streaming connections never finish, so don't wait for them,
+            # and prefetching avatars can start again next time.
+            busy = StreamReceiver.running + Avatar.running
+            if threading.activeCount() - busy < 2:
+                if self.resident:
+                    log.debug('No threads found, trimming caches.')
+                    persist_model()
+                    # The timer that called us is finished now.
+                    self.timers.clear()
+                    self.trim()
+                else:
+                    log.debug('No threads found, shutting down.')
+                    persist_model()
+                    self.timers.add(GLib.idle_add(self.callback))
             else:
                 log.debug('Delaying shutdown because active threads found.')
                 self.set_new_timer()
 
+    def trim(self):
+        """Release memory that is cheap to get back, while we sit idle."""
+        # Keep the model index fresh, in case we get killed at logout.
+        persist_caches()
+        Avatar.persist()
+        for trimmer in self.trimmers:
+            trimmer()
+        gc.collect()
+
 
 exit_after_idle = ManageTimers()
 
@@ -100,22 +147,105 @@ class Dispatcher(dbus.service.Object):
         self.mainloop = mainloop
 
         self.accounts = find_accounts()
+        self.scheduler = PollScheduler(self.accounts, self._polled)
 
-        self._unread_count = 0
+        self._unread_counts = Counter()
+        self._unread_timer = None
         self.menu_manager = MenuManager(self.Refresh, self.mainloop.quit)
         Model.connect('row-added', self._increment_unread_count)
 
+        self._snapshot_timer = None
+        for signal in ('row-added', 'row-removed', 'row-changed'):
+            Model.connect(signal, self._snapshot_later)
+
         ManageTimers.callback = mainloop.quit
+        _OperationThread.reporter = self._report_operation
+
+    def _polled(self):
+        # Only method calls set the idle timer, so a resident dispatcher
+        # that is just polling by itself would never trim its caches.
+        if ManageTimers.resident:
+            exit_after_idle.set_new_timer()
+
+    def start_streams(self):
+        """Have every account that can push new messages start doing so."""
+        for account in self.accounts.values():
+            if account.protocol._start_stream():
+                log.info('Streaming {} account {}'.format(
+                    account.protocol._Name, account.id))
+
+    def _report_operation(self, operation_id, state, counts):
+        # Operations report from their own threads, but signals are
+        # best sent from the main loop.
+        GLib.idle_add(self._signal_operation, operation_id, state,
+                      jsoncodec.dumps(counts, compact=True))
+
+    def _signal_operation(self, operation_id, state, counts):
+        if state == 'started':
+            self.OperationStarted(operation_id)
+        elif state == 'progress':
+            self.OperationProgress(operation_id, counts)
+        else:
+            self.OperationCompleted(operation_id, state == 'completed', counts)
+        return False
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='s')
+    def OperationStarted(self, operation_id):
+        """An operation, such as a Refresh() or Do(), has started.
+
+        Operation ids look like 'Facebook.contacts.12', that is, the
+        protocol, the operation and a number unique to this dispatcher.
+        """
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='ss')
+    def OperationProgress(self, operation_id, counts):
+        """An operation has made some progress, at most once a second.
+
+        The counts are a json object with the number of pages that it
+        has downloaded, new_rows that it has published, and contacts
+        that it has pushed to the address book so far.
+        """
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='sbs')
+    def OperationCompleted(self, operation_id, succeeded, counts):
+        """An operation has finished, with its final counts."""
+
+    def _snapshot_later(self, model, itr):
+        if self._snapshot_timer is None:
+            self._snapshot_timer = GLib.timeout_add_seconds(
+                SNAPSHOT_DELAY, self._update_snapshot)
+
+    def _update_snapshot(self):
+        self._snapshot_timer = None
+        version = persist_snapshot()
+        if version is not None:
+            self.SnapshotUpdated(SNAPSHOT_PATH, version)
+        return False
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='st')
+    def SnapshotUpdated(self, path, version):
+        """A new snapshot of the model has been written to path."""
 
     def _increment_unread_count(self, model, itr):
-        self._unread_count += 1
-        self.menu_manager.update_unread_count(self._unread_count)
+        stream = model.get_value(itr, STREAM_IDX)
+        if stream not in UNREAD_STREAMS:
+            return
+        self._unread_counts[stream] += 1
+        if self._unread_timer is None:
+            self._unread_timer = GLib.timeout_add(
+                UNREAD_DELAY, self._update_unread_count)
+
+    def _update_unread_count(self):
+        self._unread_timer = None
+        self.menu_manager.update_unread_count(
+            sum(self._unread_counts.values()))
+        return False
 
     @exit_after_idle
     @dbus.service.method(DBUS_INTERFACE)
     def Refresh(self):
         """Download new messages from each connected protocol."""
-        self._unread_count = 0
+        self._unread_counts.clear()
 
         log.debug('Refresh requested')
 
@@ -126,6 +256,23 @@ class Dispatcher(dbus.service.Object):
             with ignored(NotImplementedError):
                 account.protocol('receive')
 
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE)
+    def RefreshDue(self):
+        """Download new messages from the streams that are due a poll.
+
+        This is for callers that refresh on a timer, such as
+        friends-service, so that they don't poll on top of the poll
+        scheduler.  Only the streams that it finds due are polled,
+        which is every stream when the dispatcher has just started.
+        Use Refresh() when the user asks for new messages.
+        """
+        log.debug('Refresh of due streams requested')
+
+        # This starts a new thread for each stream and then returns
+        # immediately, like Refresh().
+        self.scheduler.poll()
+
     @exit_after_idle
     @dbus.service.method(DBUS_INTERFACE)
     def ClearIndicators(self):
@@ -162,26 +309,213 @@ class Dispatcher(dbus.service.Object):
             service.Do('search', '', 'search terms') # Searches all accounts.
             service.Do('list', '6', 'list_id') # Fetch a single list.
         """
+        try:
+            self._start(action, account_id, arg, success, failure)
+        except FriendsError as error:
+            failure(str(error))
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='sss',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def Start(self, action, account_id='', arg='',
+              success=STUB, failure=STUB):
+        """Start an operation like Do(), but reply as soon as it starts.
+
+        The reply is a json array of the operation ids of the
+        operations that were started, one for each account, which the
+        OperationStarted(), OperationProgress() and OperationCompleted()
+        signals about them carry.  It is sent before any of those
+        signals, so that they can be told apart from other clients'
+        operations.  Use Do() to get the result of an operation.
+
+        example:
+            import dbus, json
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            operation_ids = json.loads(service.Start('contacts', '3', ''))
+        """
+        try:
+            operation_ids = self._start(action, account_id, arg)
+        except FriendsError as error:
+            failure(str(error))
+        else:
+            success(jsoncodec.dumps(operation_ids, compact=True))
+
+    def _start(self, action, account_id, arg, success=STUB, failure=STUB):
+        """Start an operation on one account, or on all that support it.
+
+        :return: The operation ids of the operations that were started.
+        :rtype: list
+        :raises: FriendsError if there is no such account, or no account
+            that supports the action.
+        """
         if account_id:
             accounts = [self.accounts.get(int(account_id))]
             if None in accounts:
                 message = 'Could not find account: {}'.format(account_id)
-                failure(message)
                 log.error(message)
-                return
+                raise FriendsError(message)
         else:
             accounts = list(self.accounts.values())
 
-        called = False
+        operation_ids = []
         for account in accounts:
             log.debug('{}: {} {}'.format(account.id, action, arg))
             args = (action, arg) if arg else (action,)
             # Not all accounts are expected to implement every action.
             with ignored(NotImplementedError):
-                account.protocol(*args, success=success, failure=failure)
-                called = True
-        if not called:
-            failure('No accounts supporting {} found.'.format(action))
+                operation_ids.append(account.protocol(
+                    *args, success=success, failure=failure))
+        if not operation_ids:
+            raise FriendsError(
+                'No accounts supporting {} found.'.format(action))
+        return operation_ids
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def DoBatch(self, batch, success=STUB, failure=STUB):
+        """Performs several operations, replying once they are all done.
+
+        The batch is a json array of objects, each with the action,
+        account_id and optional arg that Do() would take.  Each
+        account's operations run in order, in one thread per account,
+        so that they share a single login and rate limit, instead of
+        each starting a thread of its own.
+
+        The reply is a json array with one object per operation, in the
+        same order, holding either the 'result' of the operation or the
+        'error' that it failed with, how many 'new_rows' it added, and
+        the 'operation_id' of the thread that ran it, which the
+        Operation signals carried.
+
+        example:
+            import dbus, json
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            results = json.loads(service.DoBatch(json.dumps([
+                dict(action='like', account_id='3', arg='post_id'),
+                dict(action='list', account_id='6', arg='list_id'),
+                ])))
+        """
+        try:
+            operations = [
+                (item['action'], int(item['account_id']), item.get('arg'))
+                for item in jsoncodec.loads(batch)]
+        except (ValueError, TypeError, KeyError, AttributeError) as error:
+            message = 'Invalid batch: {}'.format(error)
+            failure(message)
+            log.error(message)
+            return
+
+        results = [None] * len(operations)
+        indices = {}
+        batches = {}
+        for index, (action, account_id, arg) in enumerate(operations):
+            if account_id in self.accounts:
+                log.debug('{}: {} {}'.format(account_id, action, arg))
+                indices.setdefault(account_id, []).append(index)
+                batches.setdefault(account_id, []).append(
+                    (action, (arg,) if arg else ()))
+            else:
+                results[index] = dict(
+                    error='Could not find account: {}'.format(account_id))
+
+        def finish(account_results):
+            for account_id, outcomes in account_results.items():
+                for index, outcome in zip(indices[account_id], outcomes):
+                    results[index] = outcome
+            success(jsoncodec.dumps(results, compact=True))
+        self._run_batches(batches, finish)
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='asas',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def RefreshStreams(self, account_ids, streams,
+                       success=STUB, failure=STUB):
+        """Download new messages from only some streams of some accounts.
+
+        Streams are the ones that GetPollSchedule() lists, such as
+        'home' or 'mentions'.  An empty list of account ids means every
+        account, and an empty list of streams means every stream that
+        each account has.  Streams that an account doesn't have are
+        skipped.
+
+        The reply is a json object mapping each account id to an object
+        mapping each stream that was refreshed to the number of new
+        messages that it got, or to null if refreshing it failed.
+
+        example:
+            import dbus, json
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            counts = json.loads(service.RefreshStreams(['6'], ['mentions']))
+        """
+        log.debug('Refresh requested for {} {}'.format(
+            list(account_ids) or 'all accounts',
+            list(streams) or 'all streams'))
+        accounts = []
+        for account_id in account_ids:
+            account = self.accounts.get(int(account_id))
+            if account is None:
+                message = 'Could not find account: {}'.format(account_id)
+                failure(message)
+                log.error(message)
+                return
+            accounts.append(account)
+
+        batches = {}
+        for account in accounts or self.accounts.values():
+            wanted = [stream for stream in account.protocol._POLL_STREAMS
+                      if not streams or stream in streams]
+            if wanted:
+                batches[account.id] = [(stream, ()) for stream in wanted]
+
+        def finish(account_results):
+            counts = {}
+            for account_id, outcomes in account_results.items():
+                counts[str(account_id)] = {
+                    stream: None if 'error' in outcome else outcome['new_rows']
+                    for (stream, args), outcome
+                    in zip(batches[account_id], outcomes)}
+            success(jsoncodec.dumps(counts, compact=True))
+        self._run_batches(batches, finish)
+
+    def _run_batches(self, batches, callback):
+        """Run each account's batch of operations in its own thread.
+
+        :param batches: Lists of (operation, args) pairs, keyed by
+            account id.
+        :type batches: dict
+        :param callback: Called once every batch is done, with the
+            list of outcomes from Base._batch(), keyed by account id.
+        :type callback: callable
+        """
+        results = {}
+        lock = threading.Lock()
+        def make_callback(account_id):
+            def done(outcomes):
+                with lock:
+                    results[account_id] = outcomes
+                    if len(results) < len(batches):
+                        return
+                callback(results)
+            return done
+
+        if not batches:
+            callback(results)
+        for account_id, operations in batches.items():
+            self.accounts[account_id].protocol._batch(
+                operations, make_callback(account_id))
 
     @exit_after_idle
     @dbus.service.method(DBUS_INTERFACE,
@@ -323,7 +657,72 @@ class Dispatcher(dbus.service.Object):
             features = json.loads(service.GetFeatures('facebook'))
         """
         protocol = protocol_manager.protocols.get(protocol_name)
-        return json.dumps(protocol.get_features() if protocol else [])
+        return jsoncodec.dumps(
+            protocol.get_features() if protocol else [], compact=True)
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE, out_signature='s')
+    def GetPollSchedule(self):
+        """Returns each stream's poll interval and yield as json string.
+
+        Intervals are in seconds.  This is only interesting while the
+        dispatcher is resident, since otherwise it exits long before
+        any stream is due to be polled again.
+
+        example:
+            import dbus, json
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            schedule = json.loads(service.GetPollSchedule())
+        """
+        return jsoncodec.dumps(self.scheduler.stats(), compact=True)
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE, out_signature='s')
+    def GetAvatarStats(self):
+        """Returns the avatar cache's size and hit rate as json string.
+
+        Sizes are in bytes.  Hits and misses are counted since the
+        dispatcher started.
+
+        example:
+            import dbus, json
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            stats = json.loads(service.GetAvatarStats())
+        """
+        return jsoncodec.dumps(Avatar.stats(), compact=True)
+
+    @exit_after_idle
+    @dbus.service.method(DBUS_INTERFACE, out_signature='st')
+    def GetSnapshot(self):
+        """Returns the path and version of a snapshot of the model.
+
+        The snapshot holds every row of the model, in a columnar file
+        that friends.utils.snapshot.SnapshotReader reads by mapping it
+        into memory, which is much cheaper than synchronizing a copy of
+        the model over DBus.  The version is the model's sequence
+        number, and a snapshot is written first if the last one is out
+        of date.  The SnapshotUpdated signal announces new snapshots.
+
+        The path is empty until the model has been synchronized.
+
+        example:
+            import dbus
+            from friends.utils.snapshot import SnapshotReader
+            obj = dbus.SessionBus().get_object(DBUS_INTERFACE,
+                '/com/canonical/friends/Dispatcher')
+            service = dbus.Interface(obj, DBUS_INTERFACE)
+            path, version = service.GetSnapshot()
+            with SnapshotReader(path) as snapshot:
+                senders = list(snapshot.column('sender'))
+        """
+        version = persist_snapshot()
+        if version is None:
+            return '', 0
+        return SNAPSHOT_PATH, version
 
     @exit_after_idle
     @dbus.service.method(DBUS_INTERFACE, in_signature='s', out_signature='s')
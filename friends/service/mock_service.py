@@ -47,10 +47,30 @@ class Dispatcher(dbus.service.Object):
     def Refresh(self):
         pass
 
+    @dbus.service.method(DBUS_INTERFACE)
+    def RefreshDue(self):
+        pass
+
     @dbus.service.method(DBUS_INTERFACE)
     def ClearIndicators(self):
         self._succeed = False
 
+    @dbus.service.signal(DBUS_INTERFACE, signature='s')
+    def OperationStarted(self, operation_id):
+        pass
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='st')
+    def SnapshotUpdated(self, path, version):
+        pass
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='ss')
+    def OperationProgress(self, operation_id, counts):
+        pass
+
+    @dbus.service.signal(DBUS_INTERFACE, signature='sbs')
+    def OperationCompleted(self, operation_id, succeeded, counts):
+        pass
+
     @dbus.service.method(DBUS_INTERFACE,
                          in_signature='sss',
                          out_signature='s',
@@ -61,6 +81,37 @@ class Dispatcher(dbus.service.Object):
             action, account_id, arg)
         success(message) if self._succeed else failure(message)
 
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='sss',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def Start(self, action, account_id='', arg='',
+              success=STUB, failure=STUB):
+        message = "Called with: action={}, account_id={}, arg={}".format(
+            action, account_id, arg)
+        if self._succeed:
+            success('["Mock.{}.1"]'.format(action))
+        else:
+            failure(message)
+
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def DoBatch(self, batch, success=STUB, failure=STUB):
+        message = "Called with: batch={}".format(batch)
+        success(message) if self._succeed else failure(message)
+
+    @dbus.service.method(DBUS_INTERFACE,
+                         in_signature='asas',
+                         out_signature='s',
+                         async_callbacks=('success','failure'))
+    def RefreshStreams(self, account_ids, streams,
+                       success=STUB, failure=STUB):
+        message = "Called with: account_ids={}, streams={}".format(
+            list(account_ids), list(streams))
+        success(message) if self._succeed else failure(message)
+
     @dbus.service.method(DBUS_INTERFACE,
                          in_signature='s',
                          out_signature='s',
@@ -92,6 +143,18 @@ class Dispatcher(dbus.service.Object):
     def GetFeatures(self, protocol_name):
         return json.dumps(protocol_name.split())
 
+    @dbus.service.method(DBUS_INTERFACE, out_signature='s')
+    def GetPollSchedule(self):
+        return json.dumps([])
+
+    @dbus.service.method(DBUS_INTERFACE, out_signature='s')
+    def GetAvatarStats(self):
+        return json.dumps({})
+
+    @dbus.service.method(DBUS_INTERFACE, out_signature='st')
+    def GetSnapshot(self):
+        return '', 0
+
     @dbus.service.method(DBUS_INTERFACE, in_signature='s', out_signature='s')
     def URLShorten(self, url):
         return str(len(url))
@@ -22,6 +22,7 @@ __all__ = [
     'FakeSoupMessage',
     'LogMock',
     'mock',
+    'mute_notifications',
     ]
 
 
@@ -61,6 +62,12 @@ TestModel = Dee.SharedModel.new('com.canonical.Friends.TestSharedModel')
 TestModel.set_schema_full(SCHEMA.TYPES)
 
 
+# Decorate test classes with this to keep the messages that they publish
+# from being queued for notification.
+mute_notifications = mock.patch(
+    'friends.utils.base.queue_notification', mock.Mock())
+
+
 @mock.patch('friends.utils.http._soup', mock.Mock())
 @mock.patch('friends.utils.base.Model', TestModel)
 @mock.patch('friends.utils.base.Base._get_access_token',
@@ -118,6 +125,7 @@ class FakeAccount:
         self.consumer_secret = 'secret'
         self.consumer_key = 'consume'
         self.access_token = None
+        self.token_expires = None
         self.secret_token = None
         self.user_full_name = None
         self.user_name = None
@@ -128,9 +136,21 @@ class FakeAccount:
         self.protocol = Base(self)
 
 
+class FakeSoupBuffer:
+    """Mimic a Soup.Buffer."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def get_data(self):
+        return self._data
+
+
 class FakeSoupMessage:
     """Mimic a Soup.Message that returns canned data."""
 
+    chunk_size = 100
+
     def __init__(self, path, resource, charset='utf-8', headers=None,
                  response_code=200):
         # resource_string() always returns bytes.
@@ -161,6 +181,11 @@ class FakeSoupMessage:
     def get_as_bytes(self):
         return self._data
 
+    def get_chunk(self, offset):
+        # libsoup hands the body over in the pieces it arrived in.
+        data = self._data[offset:offset + self.chunk_size]
+        return FakeSoupBuffer(data) if data else None
+
     def get_content_type(self):
         return 'application/x-mock-data', dict(charset=self._charset)
 
@@ -93,6 +93,16 @@ class TestAccount(unittest.TestCase):
             Account(self.account_service)
         self.assertEqual(cm.exception.protocol, 'no service')
 
+    @mock.patch('friends.utils.manager.importlib.import_module',
+                side_effect=ImportError('No module named flickr'))
+    def test_account_protocol_not_installed(self, import_module):
+        # So do protocols whose package isn't installed.
+        from friends.utils.manager import protocol_manager
+        protocol_manager.protocols._classes.pop('flickr', None)
+        with self.assertRaises(UnsupportedProtocolError) as cm:
+            Account(self.account_service)
+        self.assertEqual(cm.exception.protocol, 'flickr')
+
     def test_on_account_changed(self):
         # Account.on_account_changed() gets called during the Account
         # constructor.  Test that it has the expected original key value.
@@ -127,6 +137,19 @@ class TestAccount(unittest.TestCase):
         self.assertFalse(hasattr(self.account, 'bee'))
         self.assertFalse(hasattr(self.account, 'cat'))
 
+    def test_new_credentials_forget_token(self):
+        # Signing in again gives the account new credentials, and the
+        # token that the old ones got is dropped.
+        self.account.protocol._forget_token = mock.Mock()
+        self._callback(self.account_service, self._callback_account)
+        self.assertFalse(self.account.protocol._forget_token.called)
+        new_auth = mock.Mock(**{
+            'get_credentials_id.return_value': 'new credentials'})
+        self.account_service.get_auth_data.return_value = new_auth
+        self._callback(self.account_service, self._callback_account)
+        self.account.protocol._forget_token.assert_called_once_with()
+        self.assertIs(self.account.auth, new_auth)
+
     @mock.patch('friends.utils.account.Account._on_account_changed')
     @mock.patch('friends.utils.account.protocol_manager')
     def test_account_consumer_key(self, *mocks):
@@ -147,10 +170,11 @@ class TestAccount(unittest.TestCase):
         self.assertEqual(acct.consumer_key, 'key')
         self.assertEqual(acct.consumer_secret, 'secret')
 
+    @mock.patch('friends.utils.account.TokenCache')
     @mock.patch('friends.utils.account.manager')
     @mock.patch('friends.utils.account.Account')
     @mock.patch('friends.utils.account.Accounts')
-    def test_find_accounts(self, accts, acct, manager):
+    def test_find_accounts(self, accts, acct, manager, token_cache):
         service = mock.Mock()
         get_enabled = manager.get_enabled_account_services
         get_enabled.return_value = [service]
@@ -159,6 +183,8 @@ class TestAccount(unittest.TestCase):
         get_enabled.assert_called_once_with()
         acct.assert_called_once_with(service)
         self.assertEqual(accounts, {acct().id: acct()})
+        # The saved tokens of any other accounts are deleted.
+        token_cache.prune.assert_called_once_with(accounts)
         self.assertEqual(self.log_mock.empty(),
                          'Flickr (fake_id) got send_enabled: True\n'
                          'Accounts found: 1\n')
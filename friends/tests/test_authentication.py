@@ -21,12 +21,19 @@ authentication service.
 
 __all__ = [
     'TestAuthentication',
+    'TestTokenCache',
     ]
 
 
+import os
+import stat
+import shutil
+import tempfile
 import unittest
+import threading
 
-from friends.utils.authentication import Authentication
+from friends.utils.authentication import Authentication, TokenCache
+from friends.utils.cache import JsonCache
 from friends.tests.mocks import FakeAccount, LogMock, mock
 from friends.errors import AuthorizationError
 
@@ -60,6 +67,23 @@ class FailingSignon:
         results = dict(NoAccessToken='fail')
 
 
+class SlowSignon:
+    class AuthSession(FakeAuthSession):
+        results = dict(AccessToken='slow reply')
+
+        def process(self, parameters, mechanism, callback, ignore):
+            # Answer from another thread, the way the real callback
+            # arrives in MainThread while login() blocks a subthread.
+            threading.Timer(
+                0.05, callback, (None, self.results, None, None)).start()
+
+
+class SilentSignon:
+    class AuthSession(FakeAuthSession):
+        def process(self, parameters, mechanism, callback, ignore):
+            pass
+
+
 class TestAuthentication(unittest.TestCase):
     """Test authentication."""
 
@@ -123,3 +147,69 @@ class TestAuthentication(unittest.TestCase):
         authenticator._login_cb('session', 'reply', 'error', 'data')
         self.assertEqual(authenticator._reply, 'reply')
         self.assertEqual(authenticator._error, 'error')
+
+    @mock.patch('friends.utils.authentication.Signon', SlowSignon)
+    @mock.patch('friends.utils.authentication.manager')
+    @mock.patch('friends.utils.authentication.Accounts')
+    def test_login_waits_for_callback(self, accounts, manager):
+        manager.get_account().list_services.return_value = ['foo']
+        accounts.AccountService.new().get_auth_data(
+            ).get_parameters.return_value = False
+        authenticator = Authentication(self.account.id)
+        self.assertEqual(authenticator.login(), dict(AccessToken='slow reply'))
+
+    @mock.patch.dict('friends.utils.authentication.__dict__',
+                     LOGIN_TIMEOUT=0.1)
+    @mock.patch('friends.utils.authentication.Signon', SilentSignon)
+    @mock.patch('friends.utils.authentication.manager')
+    @mock.patch('friends.utils.authentication.Accounts')
+    def test_login_timeout(self, accounts, manager):
+        manager.get_account().list_services.return_value = ['foo']
+        authenticator = Authentication(self.account.id)
+        with self.assertRaises(AuthorizationError) as cm:
+            authenticator.login()
+        self.assertEqual(cm.exception.message, 'Login timed out.')
+
+
+class TestTokenCache(unittest.TestCase):
+    """Test the saved access tokens."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_cache)
+
+    def test_only_readable_by_owner(self):
+        cache = TokenCache('token-88')
+        cache['access_token'] = 'secret'
+        mode = stat.S_IMODE(os.stat(self._root.format('token-88')).st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_remove(self):
+        cache = TokenCache('token-88')
+        cache['access_token'] = 'secret'
+        cache.remove()
+        self.assertEqual(cache, {})
+        self.assertFalse(os.path.exists(self._root.format('token-88')))
+        # Removing it twice is harmless.
+        cache.remove()
+
+    def test_prune(self):
+        for account_id in (88, 89):
+            TokenCache('token-{}'.format(account_id))['access_token'] = 'x'
+        JsonCache('other')
+        TokenCache.prune({88: 'account'})
+        self.assertTrue(os.path.exists(self._root.format('token-88')))
+        self.assertFalse(os.path.exists(self._root.format('token-89')))
+        # Other caches are left alone.
+        self.assertTrue(os.path.exists(self._root.format('other')))
+
+    def test_survives_restart(self):
+        cache = TokenCache('token-88')
+        cache.update(access_token='secret', expires=1234.5)
+        cache.write()
+        self.assertEqual(TokenCache('token-88'),
+                         dict(access_token='secret', expires=1234.5))
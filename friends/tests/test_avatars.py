@@ -16,7 +16,10 @@
 """Test the Avatar cacher."""
 
 __all__ = [
+    'TestAvatarFetcher',
+    'TestAvatarIndex',
     'TestAvatars',
+    'TestPixbufCache',
     ]
 
 
@@ -24,14 +27,15 @@ import os
 import time
 import shutil
 import tempfile
+import threading
 import unittest
 
 from datetime import date, timedelta
 from gi.repository import GdkPixbuf
-from pkg_resources import resource_filename
+from pkg_resources import resource_filename, resource_string
 
 from friends.tests.mocks import FakeSoupMessage, mock
-from friends.utils.avatar import Avatar
+from friends.utils.avatar import Avatar, AvatarIndex, PixbufCache
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
@@ -49,6 +53,7 @@ class TestAvatars(unittest.TestCase):
     def tearDown(self):
         # Clean up the temporary cache directory.
         shutil.rmtree(self._temp_cache)
+        Avatar._index = None
 
     def test_noop(self):
         # If a tweet is missing a profile image, silently ignore it.
@@ -130,3 +135,318 @@ class TestAvatars(unittest.TestCase):
             # This is the PNG file format magic number, living in the first 8
             # bytes of the file.
             self.assertEqual(raw.read(8), bytes.fromhex('89504E470D0A1A0A'))
+
+    @mock.patch('friends.utils.http.Soup.Message',
+                FakeSoupMessage('friends.tests.data', 'ubuntu.png'))
+    def test_damaged_avatar_downloaded_again(self):
+        # An avatar that doesn't match its index entry is replaced.
+        with mock.patch('friends.utils.avatar.CACHE_DIR',
+                        self._avatar_cache):
+            path = Avatar.get_image('http://example.com')
+            with open(path, 'r+b') as fd:
+                fd.truncate(100)
+            self.assertEqual(Avatar.get_image('http://example.com'), path)
+            from friends.utils.http import Soup
+            self.assertEqual(Soup.Message.call_count, 2)
+            self.assertEqual(Avatar.stats()['misses'], 2)
+        with open(path, 'rb') as raw:
+            self.assertEqual(raw.read(), resource_string(
+                'friends.tests.data', 'ubuntu.png'))
+
+
+class TestAvatarIndex(unittest.TestCase):
+    """Test keeping the avatar cache within its budget."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self.directory = os.path.join(self._temp_cache, 'avatars')
+        os.makedirs(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_cache)
+
+    def store(self, index, key, data, files=()):
+        """Write an avatar and its derived files, then index them."""
+        with open(os.path.join(self.directory, key), 'wb') as fd:
+            fd.write(data)
+        sizes = {}
+        for suffix in files:
+            with open(os.path.join(self.directory, key + suffix), 'wb') as fd:
+                fd.write(b'x' * 10)
+            sizes[suffix] = 10
+        index.add(key, data, sizes)
+
+    def test_hit_and_miss(self):
+        index = AvatarIndex(self.directory, 1000)
+        self.store(index, 'a', b'a' * 100, ['.100px'])
+        self.assertTrue(index.lookup('a'))
+        self.assertFalse(index.lookup('b'))
+        self.assertEqual(index.stats(), dict(
+            entries=1, bytes=110, budget=1000, hits=1, misses=1,
+            hit_rate=0.5, evictions=0, bytes_downloaded=100))
+        # The index is written next to the avatars, not among them.
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a', 'a.100px'])
+
+    def test_least_recently_used_evicted(self):
+        index = AvatarIndex(self.directory, 250)
+        self.store(index, 'a', b'a' * 100)
+        self.store(index, 'b', b'b' * 100)
+        self.assertTrue(index.lookup('a'))
+        self.store(index, 'c', b'c' * 100, ['.100px'])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a', 'c', 'c.100px'])
+        self.assertEqual(index.total, 210)
+        self.assertEqual(index.evictions, 1)
+        self.assertFalse(index.lookup('b'))
+
+    def test_oversized_avatar_kept(self):
+        index = AvatarIndex(self.directory, 50)
+        self.store(index, 'a', b'a' * 100)
+        self.assertTrue(index.lookup('a'))
+
+    def test_damaged_avatar_discarded(self):
+        index = AvatarIndex(self.directory, 1000)
+        self.store(index, 'a', b'a' * 100, ['.100px'])
+        index.persist()
+        # Same size, different contents.
+        with open(os.path.join(self.directory, 'a'), 'wb') as fd:
+            fd.write(b'b' * 100)
+        index = AvatarIndex(self.directory, 1000)
+        self.assertFalse(index.lookup('a'))
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(index.total, 0)
+
+    def test_missing_avatar_discarded(self):
+        index = AvatarIndex(self.directory, 1000)
+        self.store(index, 'a', b'a' * 100)
+        os.remove(os.path.join(self.directory, 'a'))
+        self.assertFalse(index.lookup('a'))
+        self.assertEqual(index.stats()['entries'], 0)
+
+    def test_order_persisted(self):
+        index = AvatarIndex(self.directory, 250)
+        self.store(index, 'a', b'a' * 100)
+        self.store(index, 'b', b'b' * 100)
+        self.assertTrue(index.lookup('a'))
+        index.persist()
+        index = AvatarIndex(self.directory, 250)
+        self.assertEqual(index.total, 200)
+        self.store(index, 'c', b'c' * 100)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'c'])
+
+    def test_rebuilt_without_index(self):
+        for name, data in (('a', b'a' * 100), ('a.100px', b'x' * 10),
+                           ('b', b''), ('c.part', b'c'), ('d.100px', b'd')):
+            with open(os.path.join(self.directory, name), 'wb') as fd:
+                fd.write(data)
+        with open(os.path.join(self._temp_cache, 'avatar-index.json'),
+                  'w') as fd:
+            fd.write('{"a": ')
+        index = AvatarIndex(self.directory, 1000)
+        # Empty, partial and orphaned files are gone.
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a', 'a.100px'])
+        self.assertEqual(index.total, 110)
+        self.assertTrue(index.lookup('a'))
+
+
+class TestAvatarFetcher(unittest.TestCase):
+    """Test downloading avatars without blocking the caller."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self._temp_cache, 'avatars')
+        self._patches = [
+            mock.patch('friends.utils.avatar.CACHE_DIR', self.cache_dir),
+            mock.patch('friends.utils.avatar.Avatar._store', self.store),
+            ]
+        for patch in self._patches:
+            patch.start()
+        self.stored = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def tearDown(self):
+        self.release.set()
+        self.wait_for_workers()
+        for patch in self._patches:
+            patch.stop()
+        Avatar._index = None
+        Avatar.prefetching = False
+        shutil.rmtree(self._temp_cache)
+
+    def store(self, url, local_path):
+        self.stored.append(url)
+        self.release.wait(5)
+        with open(local_path, 'wb') as fd:
+            fd.write(b'avatar')
+        Avatar.get_index().add(os.path.basename(local_path), b'avatar')
+
+    def wait_for_workers(self):
+        for i in range(500):
+            if not Avatar._workers:
+                return
+            time.sleep(0.01)
+        self.fail('Avatar workers never finished')
+
+    def test_get_cached(self):
+        # The first time, the avatar is queued and the placeholder returned.
+        self.assertEqual(
+            Avatar.get_cached('http://example.com', 'friends'), 'friends')
+        self.wait_for_workers()
+        self.assertEqual(self.stored, ['http://example.com'])
+        # Then it's there.
+        self.assertEqual(Avatar.get_cached('http://example.com'),
+                         Avatar.get_path('http://example.com'))
+        self.assertEqual(self.stored, ['http://example.com'])
+
+    def test_concurrent_downloads_deduplicated(self):
+        self.release.clear()
+        threads = [
+            threading.Thread(target=Avatar.get_image,
+                             args=('http://example.com',))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        # A queued prefetch doesn't download it again either.
+        Avatar.prefetching = True
+        Avatar.prefetch('http://example.com')
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.wait_for_workers()
+        self.assertEqual(self.stored, ['http://example.com'])
+        self.assertEqual(Avatar._downloads, {})
+
+    @mock.patch('friends.utils.avatar.DOWNLOAD_WAIT', 0.01)
+    def test_download_wait_times_out(self):
+        self.release.clear()
+        downloader = threading.Thread(target=Avatar.get_image,
+                                      args=('http://example.com',))
+        downloader.start()
+        while not self.stored:
+            time.sleep(0.01)
+        with mock.patch('friends.utils.avatar.log') as log:
+            self.assertEqual(Avatar.get_image('http://example.com'), '')
+        log.error.assert_called_once_with(
+            'Gave up waiting for avatar http://example.com')
+        self.release.set()
+        downloader.join(5)
+        self.assertEqual(Avatar.get_image('http://example.com'),
+                         Avatar.get_path('http://example.com'))
+
+    def test_workers_running(self):
+        self.release.clear()
+        Avatar.prefetching = True
+        Avatar.prefetch('http://example.com')
+        while not self.stored:
+            time.sleep(0.01)
+        self.assertEqual(Avatar.running, 1)
+        self.release.set()
+        self.wait_for_workers()
+        self.assertEqual(Avatar.running, 0)
+
+    def test_prefetch(self):
+        Avatar.prefetching = True
+        for url in ('http://example.com/{}'.format(i) for i in range(10)):
+            Avatar.prefetch(url)
+            Avatar.prefetch(url)
+        self.assertLessEqual(Avatar._workers, 4)
+        self.wait_for_workers()
+        self.assertEqual(len(self.stored), 10)
+        self.assertEqual(Avatar.stats()['entries'], 10)
+        # Prefetching doesn't count towards the hit rate.
+        self.assertEqual(Avatar.stats()['misses'], 0)
+
+    def test_prefetch_disabled(self):
+        Avatar.prefetch('http://example.com')
+        self.assertEqual(Avatar._queued, {})
+        self.assertEqual(self.stored, [])
+
+
+class TestPixbufCache(unittest.TestCase):
+    """Test keeping scaled avatars around, on disk and in memory."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self._temp_cache, 'avatars')
+        self._patches = [
+            mock.patch('friends.utils.avatar.CACHE_DIR', self.cache_dir),
+            mock.patch('friends.utils.avatar.GdkPixbuf'),
+            ]
+        for patch in self._patches:
+            patch.start()
+        from friends.utils.avatar import GdkPixbuf
+        self.Pixbuf = GdkPixbuf.Pixbuf
+        self.Pixbuf.new_from_file_at_scale().savev.side_effect = self.save
+        self.Pixbuf.new_from_file.side_effect = self.load
+
+    def tearDown(self):
+        for patch in self._patches:
+            patch.stop()
+        Avatar._index = None
+        shutil.rmtree(self._temp_cache)
+
+    def save(self, path, *ignore):
+        with open(path, 'wb') as fd:
+            fd.write(b'scaled')
+
+    def load(self, path):
+        pixbuf = mock.Mock(name=os.path.basename(path))
+        pixbuf.get_width.return_value = pixbuf.get_height.return_value = 48
+        return pixbuf
+
+    def cache(self, url):
+        """Store an avatar as if it had been downloaded."""
+        index = Avatar.get_index()
+        path = Avatar.get_path(url)
+        with open(path, 'wb') as fd:
+            fd.write(b'avatar')
+        index.add(os.path.basename(path), b'avatar')
+        return path
+
+    def test_derived_once(self):
+        path = self.cache('http://example.com')
+        self.Pixbuf.new_from_file_at_scale.reset_mock()
+        for i in range(2):
+            self.assertEqual(
+                Avatar.get_cached('http://example.com', size=48),
+                path + '.48px')
+        self.Pixbuf.new_from_file_at_scale.assert_called_once_with(
+            path, 48, 48, True)
+        self.assertEqual(Avatar.stats()['bytes'], 12)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         [os.path.basename(path),
+                          os.path.basename(path) + '.48px'])
+
+    def test_decoded_once(self):
+        self.cache('http://example.com')
+        cache = PixbufCache(10000)
+        pixbuf = cache.get('http://example.com', 48)
+        self.assertIs(cache.get('http://example.com', 48), pixbuf)
+        self.assertEqual(self.Pixbuf.new_from_file.call_count, 1)
+        self.assertEqual(cache.stats(), dict(
+            pixbufs=1, pixbuf_pixels=2304, pixbuf_hits=1, pixbuf_misses=1))
+
+    def test_pixel_budget(self):
+        cache = PixbufCache(2 * 48 * 48)
+        for url in ('http://example.com/a', 'http://example.com/b'):
+            self.cache(url)
+            cache.get(url, 48)
+        cache.get('http://example.com/a', 48)
+        self.cache('http://example.com/c')
+        cache.get('http://example.com/c', 48)
+        # b was the least recently used.
+        self.assertEqual(sorted(url for url, size in cache._pixbufs),
+                         ['http://example.com/a', 'http://example.com/c'])
+        self.assertEqual(cache.pixels, 2 * 48 * 48)
+        cache.clear()
+        self.assertEqual(cache.stats()['pixbufs'], 0)
+
+    @mock.patch('friends.utils.avatar.Avatar._enqueue')
+    def test_not_cached(self, enqueue):
+        cache = PixbufCache(10000)
+        self.assertIsNone(cache.get('http://example.com', 48))
+        enqueue.assert_called_once_with('http://example.com')
+        self.assertEqual(cache.stats()['pixbufs'], 0)
@@ -17,6 +17,7 @@
 
 __all__ = [
     'TestJsonCache',
+    'TestMarkCache',
     ]
 
 
@@ -26,7 +27,7 @@ import tempfile
 import unittest
 
 from pkg_resources import resource_filename
-from friends.utils.cache import JsonCache
+from friends.utils.cache import JsonCache, MarkCache
 
 
 class TestJsonCache(unittest.TestCase):
@@ -78,3 +79,60 @@ class TestJsonCache(unittest.TestCase):
             os.path.join(self._temp_cache, 'corrupt.json'))
         cache = JsonCache('corrupt')
         self.assertEqual(repr(cache), '{}')
+
+
+class TestMarkCache(unittest.TestCase):
+    """Test which stream positions MarkCache remembers."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_cache)
+
+    def test_only_newer(self):
+        cache = MarkCache('marks')
+        cache['messages'] = '2013-01-02'
+        cache['messages'] = '2013-01-01'
+        self.assertEqual(cache['messages'], '2013-01-02')
+
+    def test_convert(self):
+        cache = MarkCache('marks', int)
+        cache['messages'] = '99'
+        cache['messages'] = '100'
+        cache['messages'] = '98'
+        self.assertEqual(cache['messages'], 100)
+        # Values read back from disk are compared as converted, too.
+        cache = MarkCache('marks', int)
+        cache['messages'] = '99'
+        self.assertEqual(cache['messages'], 100)
+        cache['messages'] = '101'
+        self.assertEqual(cache['messages'], 101)
+
+    def test_substreams(self):
+        cache = MarkCache('marks')
+        cache['list/1'] = 'a'
+        cache['user/bob'] = 'b'
+        cache['search/foo'] = 'c'
+        cache['reply_to/1'] = 'd'
+        self.assertEqual(
+            sorted(cache), ['list/1', 'search/foo', 'user/bob'])
+
+    def test_least_recently_used_evicted(self):
+        cache = MarkCache('marks')
+        cache._max_substreams = 3
+        cache['messages'] = 'x'
+        for i in range(3):
+            cache['list/{}'.format(i)] = 'a'
+        # Reading list/0 makes list/1 the least recently used one.
+        self.assertEqual(cache.get('list/0'), 'a')
+        cache['list/3'] = 'a'
+        self.assertEqual(
+            sorted(cache), ['list/0', 'list/2', 'list/3', 'messages'])
+        # The eviction made it to disk, too.
+        self.assertEqual(
+            sorted(MarkCache('marks')),
+            ['list/0', 'list/2', 'list/3', 'messages'])
+
@@ -27,6 +27,7 @@ import json
 from dbus.mainloop.glib import DBusGMainLoop
 
 from friends.service.dispatcher import Dispatcher, ManageTimers, STUB
+from friends.utils.base import _OperationThread
 from friends.tests.mocks import LogMock, mock
 
 
@@ -52,6 +53,7 @@ class TestDispatcher(unittest.TestCase):
 
     def tearDown(self):
         self.log_mock.stop()
+        _OperationThread.reporter = STUB
 
     @mock.patch('friends.service.dispatcher.threading')
     def test_refresh(self, threading_mock):
@@ -59,17 +61,107 @@ class TestDispatcher(unittest.TestCase):
         threading_mock.activeCount.return_value = 1
         self.dispatcher.accounts = mock.Mock()
         self.dispatcher.accounts.values.return_value = [account]
+        self.dispatcher.scheduler = mock.Mock()
 
         self.assertIsNone(self.dispatcher.Refresh())
 
+        # Asking for a refresh polls everything, whether it's due or not.
         self.dispatcher.accounts.values.assert_called_once_with()
         account.protocol.assert_called_once_with('receive')
+        self.assertFalse(self.dispatcher.scheduler.poll.called)
 
         self.assertEqual(self.log_mock.empty(),
                          'Clearing timer id: 42\n'
                          'Refresh requested\n'
                          'Starting new shutdown timer...\n')
 
+    def test_refresh_due(self):
+        self.dispatcher.accounts = mock.Mock()
+        self.dispatcher.scheduler = mock.Mock()
+
+        self.assertIsNone(self.dispatcher.RefreshDue())
+
+        # Only the streams that are due get polled.
+        self.dispatcher.scheduler.poll.assert_called_once_with()
+        self.assertFalse(self.dispatcher.accounts.values.called)
+
+    @mock.patch('friends.service.dispatcher.exit_after_idle')
+    @mock.patch('friends.service.dispatcher.ManageTimers.resident', True)
+    def test_polled_resident(self, exit_after_idle):
+        # Polls that the scheduler starts by itself get trimmed after.
+        self.dispatcher._polled()
+        exit_after_idle.set_new_timer.assert_called_once_with()
+
+    @mock.patch('friends.service.dispatcher.exit_after_idle')
+    def test_polled_not_resident(self, exit_after_idle):
+        # Which mustn't keep a dispatcher that should exit alive.
+        self.dispatcher._polled()
+        self.assertFalse(exit_after_idle.set_new_timer.called)
+
+    def test_start_streams(self):
+        streaming = mock.Mock(id=6)
+        streaming.protocol._Name = 'Twitter'
+        streaming.protocol._start_stream.return_value = True
+        polled = mock.Mock(id=7)
+        polled.protocol._start_stream.return_value = False
+        self.dispatcher.accounts = {6: streaming, 7: polled}
+
+        self.dispatcher.start_streams()
+
+        streaming.protocol._start_stream.assert_called_once_with()
+        polled.protocol._start_stream.assert_called_once_with()
+        self.assertEqual(self.log_mock.empty(),
+                         'Streaming Twitter account 6\n')
+
+    @mock.patch('friends.service.dispatcher.GLib.timeout_add',
+                return_value=43)
+    def test_unread_count_throttled(self, timeout_add):
+        self.dispatcher.menu_manager = mock.Mock()
+        model = mock.Mock()
+        model.get_value.side_effect = lambda itr, column: itr
+        for stream in ('messages', 'mentions', 'search/foo', 'messages',
+                       'reply_to/1234', 'private'):
+            self.dispatcher._increment_unread_count(model, stream)
+        timeout_add.assert_called_once_with(
+            1000, self.dispatcher._update_unread_count)
+        self.assertFalse(self.dispatcher.menu_manager.mock_calls)
+
+        self.assertFalse(self.dispatcher._update_unread_count())
+        update = self.dispatcher.menu_manager.update_unread_count
+        update.assert_called_once_with(4)
+        self.assertEqual(self.dispatcher._unread_counts,
+                         dict(messages=2, mentions=1, private=1))
+
+        # The next row starts the next interval.
+        self.dispatcher._increment_unread_count(model, 'images')
+        self.assertEqual(timeout_add.call_count, 2)
+
+    @mock.patch('friends.service.dispatcher.GLib.idle_add',
+                lambda function, *args: function(*args))
+    def test_operation_signals(self):
+        self.assertEqual(_OperationThread.reporter,
+                         self.dispatcher._report_operation)
+        self.dispatcher.OperationStarted = mock.Mock()
+        self.dispatcher.OperationProgress = mock.Mock()
+        self.dispatcher.OperationCompleted = mock.Mock()
+        counts = dict(pages=2, new_rows=30, contacts=0)
+
+        self.dispatcher._report_operation('Twitter.home.3', 'started', {})
+        self.dispatcher._report_operation('Twitter.home.3', 'progress',
+                                          counts)
+        self.dispatcher._report_operation('Twitter.home.3', 'failed',
+                                          counts)
+
+        self.dispatcher.OperationStarted.assert_called_once_with(
+            'Twitter.home.3')
+        self.dispatcher.OperationProgress.assert_called_once_with(
+            'Twitter.home.3', mock.ANY)
+        self.dispatcher.OperationCompleted.assert_called_once_with(
+            'Twitter.home.3', False, mock.ANY)
+        self.assertEqual(
+            json.loads(self.dispatcher.OperationCompleted.call_args[0][2]),
+            counts)
+
     def test_clear_indicators(self):
         self.dispatcher.menu_manager = mock.Mock()
         self.dispatcher.ClearIndicators()
@@ -91,6 +183,34 @@ class TestDispatcher(unittest.TestCase):
                          '345: like 23346356767354626\n'
                          'Starting new shutdown timer...\n')
 
+    def test_start(self):
+        twitter = mock.Mock(id=6)
+        twitter.protocol.return_value = 'Twitter.contacts.7'
+        facebook = mock.Mock(id=3)
+        facebook.protocol.side_effect = NotImplementedError('contacts')
+        self.dispatcher.accounts = mock.Mock()
+        self.dispatcher.accounts.values.return_value = [twitter, facebook]
+
+        success = mock.Mock()
+        failure = mock.Mock()
+        self.dispatcher.Start('contacts', '', '',
+                              success=success, failure=failure)
+        # The reply comes right away, with only the operations started.
+        success.assert_called_once_with('["Twitter.contacts.7"]')
+        self.assertFalse(failure.called)
+        twitter.protocol.assert_called_once_with(
+            'contacts', success=STUB, failure=STUB)
+
+    def test_failing_start(self):
+        self.dispatcher.accounts = mock.Mock()
+        self.dispatcher.accounts.get.return_value = None
+        success = mock.Mock()
+        failure = mock.Mock()
+        self.dispatcher.Start('contacts', '6', '',
+                              success=success, failure=failure)
+        failure.assert_called_once_with('Could not find account: 6')
+        self.assertFalse(success.called)
+
     def test_failing_do(self):
         account = mock.Mock()
         self.dispatcher.accounts = mock.Mock()
@@ -105,6 +225,89 @@ class TestDispatcher(unittest.TestCase):
                          'Could not find account: 6\n'
                          'Starting new shutdown timer...\n')
 
+    def test_do_batch(self):
+        facebook = mock.Mock()
+        twitter = mock.Mock()
+        self.dispatcher.accounts = {3: facebook, 6: twitter}
+        success = mock.Mock()
+
+        self.dispatcher.DoBatch(json.dumps([
+            dict(action='like', account_id='3', arg='1234'),
+            dict(action='list', account_id='6', arg='99'),
+            dict(action='like', account_id='9', arg='1234'),
+            dict(action='receive', account_id='3'),
+            ]), success=success)
+
+        facebook.protocol._batch.assert_called_once_with(
+            [('like', ('1234',)), ('receive', ())], mock.ANY)
+        twitter.protocol._batch.assert_called_once_with(
+            [('list', ('99',))], mock.ANY)
+
+        # Only the last account to finish replies.
+        callback = facebook.protocol._batch.call_args[0][1]
+        callback([dict(result='True'), dict(error='Boom')])
+        self.assertEqual(success.call_count, 0)
+        callback = twitter.protocol._batch.call_args[0][1]
+        callback([dict(result='20')])
+        success.assert_called_once_with(mock.ANY)
+        self.assertEqual(json.loads(success.call_args[0][0]), [
+            dict(result='True'),
+            dict(result='20'),
+            dict(error='Could not find account: 9'),
+            dict(error='Boom'),
+            ])
+
+    def test_do_batch_invalid(self):
+        success = mock.Mock()
+        failure = mock.Mock()
+        self.dispatcher.DoBatch('[{"action": "like"}]',
+                                success=success, failure=failure)
+        failure.assert_called_once_with("Invalid batch: 'account_id'")
+        self.assertEqual(success.call_count, 0)
+
+    def test_refresh_streams(self):
+        twitter = mock.Mock(id=6)
+        twitter.protocol._POLL_STREAMS = ('home', 'mentions', 'private')
+        facebook = mock.Mock(id=3)
+        facebook.protocol._POLL_STREAMS = ('home', 'wall')
+        self.dispatcher.accounts = {3: facebook, 6: twitter}
+        success = mock.Mock()
+
+        self.dispatcher.RefreshStreams([], ['mentions', 'wall'],
+                                       success=success)
+
+        twitter.protocol._batch.assert_called_once_with(
+            [('mentions', ())], mock.ANY)
+        facebook.protocol._batch.assert_called_once_with(
+            [('wall', ())], mock.ANY)
+        twitter.protocol._batch.call_args[0][1](
+            [dict(result='20', new_rows=4)])
+        facebook.protocol._batch.call_args[0][1](
+            [dict(error='Boom', new_rows=0)])
+        self.assertEqual(json.loads(success.call_args[0][0]),
+                         {'6': dict(mentions=4), '3': dict(wall=None)})
+
+    def test_refresh_streams_one_account(self):
+        twitter = mock.Mock(id=6)
+        twitter.protocol._POLL_STREAMS = ('home', 'mentions', 'private')
+        facebook = mock.Mock(id=3)
+        self.dispatcher.accounts = {3: facebook, 6: twitter}
+        success = mock.Mock()
+
+        self.dispatcher.RefreshStreams(['6'], [], success=success)
+
+        twitter.protocol._batch.assert_called_once_with(
+            [('home', ()), ('mentions', ()), ('private', ())], mock.ANY)
+        self.assertEqual(facebook.protocol._batch.call_count, 0)
+
+    def test_refresh_streams_missing_account(self):
+        success = mock.Mock()
+        failure = mock.Mock()
+        self.dispatcher.RefreshStreams(['9'], [],
+                                       success=success, failure=failure)
+        failure.assert_called_once_with('Could not find account: 9')
+        self.assertEqual(success.call_count, 0)
+
     def test_send_message(self):
         account1 = mock.Mock()
         account2 = mock.Mock()
@@ -207,6 +410,36 @@ class TestDispatcher(unittest.TestCase):
         self.assertEqual(json.loads(self.dispatcher.GetFeatures('foursquare')),
                          ['delete_contacts', 'receive'])
 
+    @mock.patch('friends.service.dispatcher.Avatar')
+    def test_get_avatar_stats(self, avatar):
+        avatar.stats.return_value = dict(hits=3, misses=1, hit_rate=0.75)
+        self.assertEqual(json.loads(self.dispatcher.GetAvatarStats()),
+                         dict(hits=3, misses=1, hit_rate=0.75))
+
+    @mock.patch('friends.service.dispatcher.persist_snapshot',
+                return_value=42)
+    @mock.patch('friends.service.dispatcher.SNAPSHOT_PATH', '/tmp/snap.bin')
+    def test_get_snapshot(self, persist_snapshot):
+        self.assertEqual(self.dispatcher.GetSnapshot(), ('/tmp/snap.bin', 42))
+        persist_snapshot.return_value = None
+        self.assertEqual(self.dispatcher.GetSnapshot(), ('', 0))
+
+    @mock.patch('friends.service.dispatcher.persist_snapshot',
+                return_value=42)
+    @mock.patch('friends.service.dispatcher.SNAPSHOT_PATH', '/tmp/snap.bin')
+    def test_snapshot_updated(self, persist_snapshot):
+        self.dispatcher.SnapshotUpdated = mock.Mock()
+        with mock.patch('friends.service.dispatcher.GLib.timeout_add_seconds',
+                        return_value=44) as timeout_add_seconds:
+            for i in range(3):
+                self.dispatcher._snapshot_later(mock.Mock(), mock.Mock())
+        timeout_add_seconds.assert_called_once_with(
+            10, self.dispatcher._update_snapshot)
+        self.assertFalse(self.dispatcher._update_snapshot())
+        persist_snapshot.assert_called_once_with()
+        self.dispatcher.SnapshotUpdated.assert_called_once_with(
+            '/tmp/snap.bin', 42)
+
     @mock.patch('friends.service.dispatcher.logging')
     def test_urlshorten_already_shortened(self, logging_mock):
         self.assertEqual(
@@ -263,6 +496,18 @@ class TestDispatcher(unittest.TestCase):
         persist.assert_called_once_with()
         glib.idle_add.assert_called_once_with(manager.callback)
 
+    @mock.patch('friends.service.dispatcher.Avatar.running', 2)
+    @mock.patch('friends.service.dispatcher.persist_model')
+    @mock.patch('friends.service.dispatcher.threading')
+    @mock.patch('friends.service.dispatcher.GLib')
+    def test_manage_timers_ignore_avatar_workers(self, glib, thread, persist):
+        manager = ManageTimers()
+        manager.timers = set()
+        thread.activeCount.return_value = 3
+        manager.terminate()
+        persist.assert_called_once_with()
+        glib.idle_add.assert_called_once_with(manager.callback)
+
     @mock.patch('friends.service.dispatcher.persist_model')
     @mock.patch('friends.service.dispatcher.threading')
     @mock.patch('friends.service.dispatcher.GLib')
@@ -274,3 +519,27 @@ class TestDispatcher(unittest.TestCase):
         manager.terminate()
         thread.activeCount.assert_called_once_with()
         manager.set_new_timer.assert_called_once_with()
+
+    @mock.patch('friends.service.dispatcher.Avatar')
+    @mock.patch('friends.service.dispatcher.gc')
+    @mock.patch('friends.service.dispatcher.persist_caches')
+    @mock.patch('friends.service.dispatcher.persist_model')
+    @mock.patch('friends.service.dispatcher.threading')
+    @mock.patch('friends.service.dispatcher.GLib')
+    def test_manage_timers_resident(self, glib, thread, persist, caches, gc,
+                                    avatar):
+        manager = ManageTimers()
+        manager.timers = {42}
+        manager.resident = True
+        trimmer = mock.Mock()
+        manager.trimmers = [trimmer]
+        avatar.running = 0
+        thread.activeCount.return_value = 1
+        manager.terminate()
+        persist.assert_called_once_with()
+        caches.assert_called_once_with()
+        avatar.persist.assert_called_once_with()
+        trimmer.assert_called_once_with()
+        gc.collect.assert_called_once_with()
+        self.assertFalse(glib.idle_add.called)
+        self.assertEqual(manager.timers, set())
@@ -34,6 +34,7 @@ from wsgiref.util import setup_testing_defaults
 from pkg_resources import resource_filename
 
 from friends.tests.mocks import FakeSoupMessage, LogMock, mock
+from friends.utils.base import _OperationThread
 from friends.utils.http import Downloader, Uploader
 
 
@@ -139,6 +140,19 @@ class TestDownloader(unittest.TestCase):
         self.assertEqual(Downloader('http://example.com').get_json(),
                          dict(yes='ÑØ'))
 
+    @mock.patch('friends.utils.http._soup', mock.Mock())
+    @mock.patch('friends.utils.http.Soup.Message',
+                FakeSoupMessage('friends.tests.data',
+                                'json-utf-8.dat', 'utf-8'))
+    def test_bytes_counted(self):
+        # Protocol operations keep count of how much they download.
+        thread = _OperationThread(
+            target=Downloader('http://example.com').get_json)
+        thread.start()
+        thread.join()
+        self.assertEqual(thread.bytes_downloaded, 23)
+        self.assertEqual(thread.pages, 1)
+
     @mock.patch('friends.utils.http._soup', mock.Mock())
     @mock.patch('friends.utils.http.Soup.Message',
                 FakeSoupMessage('friends.tests.data', 'json-utf-8.dat', None))
@@ -183,6 +197,40 @@ class TestDownloader(unittest.TestCase):
         self.assertEqual(Downloader('http://example.com').get_json(),
                          dict(yes='ÑØ'))
 
+    @mock.patch('friends.utils.http._soup', mock.Mock())
+    @mock.patch('friends.utils.http.Soup.Message',
+                FakeSoupMessage('friends.tests.data', 'facebook-full.dat'))
+    def test_iter_json(self):
+        rest = {}
+        entries = Downloader('http://example.com').iter_json('data', rest)
+        self.assertEqual(
+            [entry['id'] for entry in entries],
+            ['userid_postid1', '270843027745_10151370303782746',
+             '161247843901324_629147610444676', '104443_100085049977'])
+        self.assertEqual(sorted(rest), ['data', 'paging'])
+        self.assertEqual(rest['data'], [])
+
+    @mock.patch('friends.utils.http._soup', mock.Mock())
+    def test_iter_json_implicit_utf_32be(self):
+        # The encoding is still detected when the first chunk is too short.
+        message = FakeSoupMessage('friends.tests.data',
+                                  'json-utf-32be.dat', None)
+        message.chunk_size = 1
+        with mock.patch('friends.utils.http.Soup.Message', message):
+            rest = {}
+            self.assertEqual(
+                list(Downloader('http://example.com').iter_json('no', rest)),
+                [])
+        self.assertEqual(rest, dict(yes='ÑØ'))
+
+    @mock.patch('friends.utils.http._soup', mock.Mock())
+    @mock.patch('friends.utils.http.Soup.Message',
+                FakeSoupMessage('friends.tests.data', 'json-utf-8.dat'))
+    def test_iter_json_wrong_shape(self):
+        # The top level is an object, not an array.
+        self.assertRaises(
+            ValueError, list, Downloader('http://example.com').iter_json())
+
     def test_simple_text_download(self):
         # Test simple downloading of text data.
         self.assertEqual(Downloader('http://localhost:9180/text').get_string(),
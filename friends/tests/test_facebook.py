@@ -31,14 +31,14 @@ from pkg_resources import resource_filename
 
 from friends.protocols.facebook import Facebook
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
 from friends.tests.mocks import EDSBookClientMock, EDSRegistry
 from friends.errors import ContactsError, FriendsError, AuthorizationError
 from friends.utils.cache import JsonCache
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestFacebook(unittest.TestCase):
     """Test the Facebook API."""
 
@@ -91,11 +91,11 @@ class TestFacebook(unittest.TestCase):
     @mock.patch('friends.utils.authentication.Accounts')
     @mock.patch('friends.utils.authentication.Authentication.login',
                 return_value=dict(AccessToken='abc'))
-    @mock.patch('friends.protocols.facebook.Downloader.get_json',
-                return_value=dict(
+    @mock.patch('friends.protocols.facebook.Downloader.iter_json',
+                lambda self, path, rest: rest.update(
                     error=dict(message='Bad access token',
                                type='OAuthException',
-                               code=190)))
+                               code=190)) or [])
     def test_error_response(self, *mocks):
         with LogMock('friends.utils.base',
                      'friends.protocols.facebook') as log_mock:
@@ -240,7 +240,7 @@ class TestFacebook(unittest.TestCase):
         self.account.secret_token = 'secret'
         self.assertEqual(self.protocol.home(), 12)
 
-        with open(self._root.format('facebook_ids'), 'r') as fd:
+        with open(self._root.format('marks-88'), 'r') as fd:
             self.assertEqual(fd.read(), '{"messages": "2013-03-15T19:57:14Z"}')
 
         follow = self.protocol._follow_pagination = mock.Mock()
@@ -480,8 +480,8 @@ class TestFacebook(unittest.TestCase):
             name='Joe Blow', username='jblow', link='example.com', gender='male')
         downloader.reset_mock()
         self.protocol._get_access_token = mock.Mock(return_value='broken')
-        follow = self.protocol._follow_pagination = mock.Mock(
-            return_value=[dict(id='contact1'), dict(id='contact2')])
+        follow = self.protocol._iter_pagination = mock.Mock(
+            return_value=iter([dict(id='contact1'), dict(id='contact2')]))
         prev = self.protocol._previously_stored_contact = mock.Mock(return_value=False)
         push = self.protocol._push_to_eds = mock.Mock()
         self.assertEqual(self.protocol.contacts(), 2)
@@ -20,20 +20,27 @@ __all__ = [
     ]
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from friends.errors import AuthorizationError, FriendsError
 from friends.protocols.flickr import Flickr
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
+from friends.utils.cache import JsonCache
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestFlickr(unittest.TestCase):
     """Test the Flickr API."""
 
     def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
         self.maxDiff = None
         self.account = FakeAccount()
         self.protocol = Flickr(self.account)
@@ -46,6 +53,7 @@ class TestFlickr(unittest.TestCase):
         self.log_mock.stop()
         # Reset the database.
         TestModel.clear()
+        shutil.rmtree(self._temp_cache)
 
     def test_features(self):
         # The set of public features.
@@ -152,6 +160,19 @@ class TestFlickr(unittest.TestCase):
             self.assertEqual(self.protocol.receive(), 0)
         self.assertEqual(TestModel.get_n_rows(), 0)
 
+    @mock.patch('friends.utils.http.Soup.Message',
+                FakeSoupMessage('friends.tests.data', 'flickr-full.dat'))
+    @mock.patch('friends.utils.base.Model', TestModel)
+    def test_older_photos_skipped(self):
+        # The newest photo in the test data was uploaded at 1363117902.
+        self.protocol._set_mark(1363117000, 'images')
+        publish = self.protocol._publish = mock.Mock()
+        with mock.patch.object(self.protocol, '_get_access_token',
+                               return_value='token'):
+            self.protocol.receive()
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual(self.protocol._get_mark('images'), 1363117902)
+
     @mock.patch('friends.utils.http.Soup.Message',
                 FakeSoupMessage('friends.tests.data', 'flickr-full.dat'))
     @mock.patch('friends.utils.base.Model', TestModel)
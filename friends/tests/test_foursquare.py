@@ -20,20 +20,27 @@ __all__ = [
     ]
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from friends.protocols.foursquare import FourSquare
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
+from friends.utils.cache import JsonCache
 from friends.errors import AuthorizationError
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestFourSquare(unittest.TestCase):
     """Test the FourSquare API."""
 
     def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
         self.account = FakeAccount()
         self.protocol = FourSquare(self.account)
         self.log_mock = LogMock('friends.utils.base',
@@ -45,6 +52,7 @@ class TestFourSquare(unittest.TestCase):
         self.log_mock.stop()
         # Reset the database.
         TestModel.clear()
+        shutil.rmtree(self._temp_cache)
 
     def test_features(self):
         # The set of public features.
@@ -79,6 +87,20 @@ class TestFourSquare(unittest.TestCase):
         self.assertEqual(self.account.user_name, 'Bob Loblaw')
         self.assertEqual(self.account.user_id, '1234567')
 
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.protocols.foursquare.FourSquare._login',
+                return_value=True)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_receive_after_timestamp(self, *mocks):
+        self.account.access_token = 'tokeny goodness'
+        fake = FakeSoupMessage('friends.tests.data', 'foursquare-full.dat')
+        with mock.patch('friends.utils.http.Soup.Message', fake):
+            self.protocol.receive()
+            self.assertNotIn('afterTimestamp', fake.url)
+            # The second poll only asks for what's newer than the first.
+            self.protocol.receive()
+        self.assertTrue(fake.url.endswith('&afterTimestamp=1347898524'))
+
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.http.Soup.Message',
                 FakeSoupMessage('friends.tests.data', 'foursquare-full.dat'))
@@ -28,12 +28,13 @@ import shutil
 
 from friends.protocols.identica import Identica
 from friends.tests.mocks import FakeAccount, LogMock, TestModel, mock
+from friends.tests.mocks import mute_notifications
 from friends.utils.cache import JsonCache
 from friends.errors import AuthorizationError
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 @mock.patch('friends.utils.base.Model', TestModel)
 class TestIdentica(unittest.TestCase):
     """Test the Identica API."""
@@ -107,6 +108,9 @@ class TestIdentica(unittest.TestCase):
         self.assertRaises(NotImplementedError,
                           self.protocol.list, 'some_list_id')
 
+    def test_no_stream(self):
+        self.assertFalse(self.protocol._start_stream())
+
     def test_lists(self):
         self.protocol._get_url = mock.Mock(
             return_value=[dict(id_str='twitlist')])
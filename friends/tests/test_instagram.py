@@ -28,14 +28,14 @@ import shutil
 
 from friends.protocols.instagram import Instagram
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
 from friends.tests.mocks import EDSRegistry
 from friends.errors import FriendsError, AuthorizationError
 from friends.utils.cache import JsonCache
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestInstagram(unittest.TestCase):
     """Test the Instagram API."""
 
@@ -102,6 +102,25 @@ class TestInstagram(unittest.TestCase):
             contents = log_mock.empty(trim=False)
         self.assertEqual(contents, 'Logging in to Instagram\n')
 
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.protocols.instagram.Instagram._login',
+                return_value=True)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_home_min_id(self, *mocks):
+        self.account.access_token = 'abc'
+        fake = FakeSoupMessage('friends.tests.data', 'instagram-full.dat')
+        with mock.patch('friends.utils.http.Soup.Message', fake):
+            self.protocol.home()
+            self.assertNotIn('min_id', fake.url)
+            self.protocol.home()
+        self.assertTrue(fake.url.endswith('&min_id=431474591469914097'))
+
+    def test_marks_sort_by_media(self):
+        self.protocol._set_mark('999_223207800')
+        self.protocol._set_mark('1000_11')
+        self.protocol._set_mark('998_223207800')
+        self.assertEqual(self.protocol._get_mark(), 1000)
+
     @mock.patch('friends.utils.http.Soup.Message',
                 FakeSoupMessage('friends.tests.data', 'instagram-full.dat'))
     @mock.patch('friends.utils.base.Model', TestModel)
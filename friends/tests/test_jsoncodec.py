@@ -0,0 +1,70 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the JSON codec, with and without a fast backend."""
+
+__all__ = [
+    'TestJsonCodec',
+    'TestJsonCodecFallback',
+    ]
+
+
+import unittest
+
+from pkg_resources import resource_string
+
+from friends.tests.mocks import mock
+from friends.utils import jsoncodec
+
+
+class TestJsonCodec(unittest.TestCase):
+    """Test the codec with whatever backend is installed."""
+
+    def test_loads_str(self):
+        self.assertEqual(jsoncodec.loads('{"yes": "\\u00d1"}'), dict(yes='Ñ'))
+
+    def test_loads_bytes(self):
+        payload = resource_string('friends.tests.data', 'json-utf-8.dat')
+        self.assertEqual(jsoncodec.loads(payload), dict(yes='ÑØ'))
+
+    def test_loads_utf_16(self):
+        payload = resource_string('friends.tests.data', 'json-utf-16le.dat')
+        self.assertEqual(
+            jsoncodec.loads(payload, 'utf-16le'), dict(yes='ÑØ'))
+
+    def test_loads_big_integer(self):
+        # Too big for orjson, but still valid JSON.
+        self.assertEqual(jsoncodec.loads(b'[18446744073709551616]'),
+                         [18446744073709551616])
+
+    def test_loads_invalid(self):
+        self.assertRaises(ValueError, jsoncodec.loads, b'{"a": ')
+
+    def test_dumps(self):
+        # JsonCache files keep the exact format they always had.
+        self.assertEqual(jsoncodec.dumps(dict(hello='world')),
+                         '{"hello": "world"}')
+
+    def test_dumps_compact(self):
+        self.assertEqual(jsoncodec.dumps(dict(a=[1, 2]), compact=True),
+                         '{"a":[1,2]}')
+
+    def test_dumps_compact_integer_keys(self):
+        self.assertEqual(jsoncodec.dumps({1: 2}, compact=True), '{"1":2}')
+
+
+@mock.patch('friends.utils.jsoncodec._orjson', None)
+class TestJsonCodecFallback(TestJsonCodec):
+    """Test the codec when only the json module is available."""
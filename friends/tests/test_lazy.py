@@ -0,0 +1,63 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the deferred typelib loading."""
+
+__all__ = [
+    'TestLazyRepository',
+    ]
+
+
+import unittest
+
+from friends.tests.mocks import mock
+from friends.utils.lazy import LazyRepository
+
+
+class TestLazyRepository(unittest.TestCase):
+    """Test LazyRepository."""
+
+    @mock.patch('friends.utils.lazy.importlib')
+    @mock.patch('friends.utils.lazy.gi')
+    def test_nothing_loaded_until_used(self, gi, importlib):
+        EBook = LazyRepository('EBook', '1.2')
+        self.assertFalse(gi.require_version.called)
+        self.assertFalse(importlib.import_module.called)
+        self.assertEqual(
+            EBook.BookClient, importlib.import_module().BookClient)
+        gi.require_version.assert_called_once_with('EBook', '1.2')
+        importlib.import_module.assert_called_with('gi.repository.EBook')
+
+    @mock.patch('friends.utils.lazy.importlib')
+    @mock.patch('friends.utils.lazy.gi')
+    def test_loaded_only_once(self, gi, importlib):
+        Notify = LazyRepository('Notify', '0.7')
+        Notify.init('friends')
+        Notify.get_server_caps()
+        self.assertEqual(gi.require_version.call_count, 1)
+        self.assertEqual(importlib.import_module.call_count, 1)
+
+    @mock.patch('friends.utils.lazy.gi')
+    def test_missing_typelib(self, gi):
+        gi.require_version.side_effect = ValueError(
+            'Namespace Notify not available')
+        Notify = LazyRepository('Notify', '0.7')
+        with self.assertRaises(ImportError):
+            Notify.init('friends')
+
+    def test_real_module(self):
+        GLib = LazyRepository('GLib')
+        from gi.repository import GLib as RealGLib
+        self.assertIs(GLib.MainLoop, RealGLib.MainLoop)
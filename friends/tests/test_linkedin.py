@@ -21,20 +21,27 @@ __all__ = [
     ]
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from friends.protocols.linkedin import LinkedIn, make_fullname
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
+from friends.utils.cache import JsonCache
 from friends.errors import AuthorizationError
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestLinkedIn(unittest.TestCase):
     """Test the LinkedIn API."""
 
     def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
         TestModel.clear()
         self.account = FakeAccount()
         self.protocol = LinkedIn(self.account)
@@ -45,6 +52,7 @@ class TestLinkedIn(unittest.TestCase):
         # Ensure that any log entries we haven't tested just get consumed so
         # as to isolate out test logger from other tests.
         self.log_mock.stop()
+        shutil.rmtree(self._temp_cache)
 
     def test_name_logic(self):
         self.assertEqual('', make_fullname())
@@ -110,6 +118,19 @@ class TestLinkedIn(unittest.TestCase):
              '&authToken=-LNy&trk=api*a26127*s26893*',
              1, False, '', '', '', '', '', '', '', 0.0, 0.0])
 
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.protocols.linkedin.LinkedIn._login',
+                return_value=True)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_home_after(self, *mocks):
+        self.account.access_token = 'access'
+        fake = FakeSoupMessage('friends.tests.data', 'linkedin_receive.json')
+        with mock.patch('friends.utils.http.Soup.Message', fake):
+            self.protocol.home()
+            self.assertNotIn('after=', fake.url)
+            self.protocol.home()
+        self.assertTrue(fake.url.endswith('&type=STAT&after=1373935626874'))
+
     @mock.patch('friends.utils.http.Soup.Message',
                 FakeSoupMessage('friends.tests.data', 'linkedin_contacts.json'))
     @mock.patch('friends.protocols.linkedin.LinkedIn._login',
@@ -21,13 +21,14 @@ done in test_dbus.py so as to be isolated from the user's environment.
 
 __all__ = [
     'TestModel',
+    'TestSchema',
     ]
 
 
 import unittest
 
 from friends.utils.model import prune_model, persist_model
-from friends.tests.mocks import LogMock, mock
+from friends.tests.mocks import SCHEMA, LogMock, mock
 
 
 class TestModel(unittest.TestCase):
@@ -57,9 +58,11 @@ class TestModel(unittest.TestCase):
         def side_effect(arg):
             model.get_n_rows.return_value -= 1
         model.remove.side_effect = side_effect
-        prune_model(8000)
+        model.get_row.return_value = ['1234', 'messages']
+        self.assertEqual(prune_model(8000), [('1234', 'messages')])
         persist.assert_called_once_with()
         model.get_first_iter.assert_called_once_with()
+        model.get_row.assert_called_once_with(model.get_first_iter())
         model.remove.assert_called_once_with(model.get_first_iter())
         self.assertEqual(self.log_mock.empty(),
                          'Deleted 1 rows from Dee.SharedModel.\n')
@@ -86,9 +89,37 @@ class TestModel(unittest.TestCase):
         def side_effect(arg):
             model.get_n_rows.return_value -= 1
         model.remove.side_effect = side_effect
-        prune_model(8000)
+        self.assertEqual(prune_model(8000), [])
         model.get_n_rows.assert_called_once_with()
         self.assertFalse(persist.called)
         self.assertFalse(model.get_first_iter.called)
         self.assertFalse(model.remove.called)
         self.assertEqual(self.log_mock.empty(), '')
+
+
+class TestSchema(unittest.TestCase):
+    """Test the row builder compiled from our schema."""
+
+    def test_defaults(self):
+        row = SCHEMA.build_row()
+        self.assertEqual(len(row), len(SCHEMA.COLUMNS))
+        for value, (name, variant) in zip(row, SCHEMA.COLUMNS):
+            self.assertEqual(value, SCHEMA.DEFAULTS[variant])
+
+    def test_keywords(self):
+        row = SCHEMA.build_row(message_id='1234', from_me=True, likes=5)
+        self.assertEqual(row[SCHEMA.INDICES['message_id']], '1234')
+        self.assertEqual(row[SCHEMA.INDICES['from_me']], True)
+        self.assertEqual(row[SCHEMA.INDICES['likes']], 5)
+        self.assertEqual(row[SCHEMA.INDICES['sender']], '')
+
+    def test_positional(self):
+        row = SCHEMA.build_row('twitter', 88, '1234')
+        self.assertEqual(row[:3], ('twitter', 88, '1234'))
+        self.assertEqual(row[3:], SCHEMA.build_row()[3:])
+
+    def test_unexpected_columns(self):
+        with self.assertRaises(TypeError) as cm:
+            SCHEMA.build_row(message_id='1234', wrong='yes', bad='no')
+        self.assertEqual(str(cm.exception),
+                         'Unexpected keyword arguments: bad, wrong')
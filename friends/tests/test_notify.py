@@ -16,6 +16,7 @@
 """Test our libnotify support."""
 
 __all__ = [
+    'TestNotificationQueue',
     'TestNotifications',
     ]
 
@@ -24,7 +25,7 @@ import unittest
 
 from friends.tests.mocks import FakeAccount, TestModel, mock
 from friends.utils.base import Base
-from friends.utils.notify import notify
+from friends.utils.notify import NotificationQueue, _queue, notify
 
 from datetime import datetime, timedelta
 
@@ -41,9 +42,8 @@ class TestNotifications(unittest.TestCase):
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
     @mock.patch('friends.utils.notify.Avatar')
-    @mock.patch('friends.utils.notify.GdkPixbuf')
     @mock.patch('friends.utils.notify.Notify')
-    def test_publish_avatar_cache(self, notify, gdkpixbuf, avatar):
+    def test_publish_avatar_cache(self, notify, avatar):
         Base._do_notify = lambda protocol, stream: True
         base = Base(FakeAccount())
         base._publish(
@@ -53,13 +53,43 @@ class TestNotifications(unittest.TestCase):
             timestamp=RIGHT_NOW,
             icon_uri='http://example.com/bob.jpg',
             )
-        avatar.get_image.assert_called_once_with('http://example.com/bob.jpg')
-        gdkpixbuf.Pixbuf.new_from_file_at_size.assert_called_once_with(
-            avatar.get_image(), 48, 48)
+        # The notification is only shown from the main loop.
+        self.assertFalse(avatar.get_pixbuf.called)
+        _queue.flush()
+        avatar.get_pixbuf.assert_called_once_with(
+            'http://example.com/bob.jpg', 48)
+        notify.Notification.new().set_icon_from_pixbuf.assert_called_once_with(
+            avatar.get_pixbuf())
+
+    @mock.patch('friends.utils.notify.Avatar')
+    @mock.patch('friends.utils.notify.Notify')
+    def test_notify_avatar_not_cached(self, Notify, avatar):
+        # Rather than wait for the avatar, show the default icon.
+        avatar.get_pixbuf.return_value = None
+        notify('Bob Loblaw', 'hello, friend!', 'http://example.com/bob.jpg')
+        self.assertFalse(
+            Notify.Notification.new().set_icon_from_pixbuf.called)
+        Notify.Notification.new().show.assert_called_once_with()
+
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    @mock.patch('friends.utils.base.Avatar')
+    def test_publish_prefetches_avatar(self, avatar):
+        base = Base(FakeAccount())
+        for i in range(2):
+            base._publish(
+                message='hello',
+                message_id='1234',
+                sender='Benjamin',
+                timestamp=RIGHT_NOW,
+                icon_uri='http://example.com/bob.jpg',
+                )
+        # Only new rows are worth fetching an avatar for.
+        avatar.prefetch.assert_called_once_with('http://example.com/bob.jpg')
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_no_html(self, notify):
         Base._do_notify = lambda protocol, stream: True
         base = Base(FakeAccount())
@@ -69,11 +99,12 @@ class TestNotifications(unittest.TestCase):
             sender='Benjamin',
             timestamp=RIGHT_NOW,
             )
-        notify.assert_called_once_with('Benjamin', 'http://example.com!', '')
+        notify.assert_called_once_with(
+            'Benjamin', 'http://example.com!', '', '')
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_no_stale(self, notify):
         Base._do_notify = lambda protocol, stream: True
         base = Base(FakeAccount())
@@ -87,7 +118,7 @@ class TestNotifications(unittest.TestCase):
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_all(self, notify):
         Base._do_notify = lambda protocol, stream: True
         base = Base(FakeAccount())
@@ -97,11 +128,11 @@ class TestNotifications(unittest.TestCase):
             sender='Benjamin',
             timestamp=YESTERDAY,
             )
-        notify.assert_called_once_with('Benjamin', 'notify!', '')
+        notify.assert_called_once_with('Benjamin', 'notify!', '', '')
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_mentions_private(self, notify):
         Base._do_notify = lambda protocol, stream: stream in (
             'mentions', 'private')
@@ -113,11 +144,12 @@ class TestNotifications(unittest.TestCase):
             stream='private',
             timestamp=RIGHT_NOW,
             )
-        notify.assert_called_once_with('Benjamin', 'This message is private!', '')
+        notify.assert_called_once_with(
+            'Benjamin', 'This message is private!', '', 'private')
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_mention_fail(self, notify):
         Base._do_notify = lambda protocol, stream: stream in (
             'mentions', 'private')
@@ -133,7 +165,7 @@ class TestNotifications(unittest.TestCase):
 
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
-    @mock.patch('friends.utils.base.notify')
+    @mock.patch('friends.utils.base.queue_notification')
     def test_publish_mention_none(self, notify):
         Base._do_notify = lambda protocol, stream: False
         base = Base(FakeAccount())
@@ -161,3 +193,80 @@ class TestNotifications(unittest.TestCase):
         notification = Notify.Notification.new()
         notification.set_icon_from_pixbuf.assert_called_once_with('hi!')
         notification.show.assert_called_once_with()
+
+
+@mock.patch('friends.utils.notify.GLib')
+@mock.patch('friends.utils.notify.notify')
+class TestNotificationQueue(unittest.TestCase):
+    """Test batching notifications."""
+
+    def test_batched(self, notify, glib):
+        queue = NotificationQueue()
+        queue.add('Alice', 'Hi!', 'http://example.com/alice.jpg', 'messages')
+        queue.add('Bob', 'Hello!', '', 'mentions')
+        queue.add('', 'No sender', '', 'messages')
+        # Only one timer is needed for the whole batch.
+        glib.timeout_add.assert_called_once_with(2000, queue.flush)
+        self.assertEqual(notify.call_count, 0)
+        self.assertFalse(queue.flush())
+        self.assertEqual(notify.call_args_list, [
+            mock.call('Alice', 'Hi!', 'http://example.com/alice.jpg'),
+            mock.call('Bob', 'Hello!', ''),
+            ])
+        queue.add('Carol', 'Hey!')
+        self.assertEqual(glib.timeout_add.call_count, 2)
+
+    def test_summaries(self, notify, glib):
+        queue = NotificationQueue()
+        queue.add('Dave', 'First!', '', 'messages')
+        for i in range(5):
+            queue.add('Alice', 'Message {}'.format(i), 'alice.jpg', 'mentions')
+        for sender in ('Bob', 'Carol', 'Dave', 'Erin', 'Bob'):
+            queue.add(sender, 'Hello', '', 'private')
+        queue.add('Frank', 'Last!', '', 'messages')
+        queue.flush()
+        self.assertEqual(notify.call_args_list, [
+            mock.call('Dave', 'First!', ''),
+            mock.call('Alice', 'Message 4\n(and 4 more)', 'alice.jpg'),
+            mock.call('5 new private messages',
+                      'From Bob, Carol and 2 others', ''),
+            mock.call('Frank', 'Last!', ''),
+            ])
+
+    def test_budget(self, notify, glib):
+        queue = NotificationQueue(per_minute=4)
+        for sender in ('Alice', 'Bob', 'Carol'):
+            queue.add(sender, 'Hello', '', sender)
+        queue.flush(now=1000)
+        self.assertEqual(notify.call_count, 3)
+        notify.reset_mock()
+        # Only one notification left for this minute.
+        for sender in ('Dave', 'Erin', 'Dave'):
+            queue.add(sender, 'Hello', '', sender)
+        queue.flush(now=1010)
+        notify.assert_called_once_with(
+            '3 more new messages', 'From Dave and Erin', '')
+        notify.reset_mock()
+        queue.add('Frank', 'Hello')
+        queue.flush(now=1030)
+        self.assertEqual(notify.call_count, 0)
+        self.assertEqual(queue.dropped, 1)
+        # A minute after the first batch, there's room again.
+        queue.add('Frank', 'Hello again')
+        queue.flush(now=1060)
+        notify.assert_called_once_with('Frank', 'Hello again', '')
+
+    def test_overflow_names_senders(self, notify, glib):
+        # Summaries that don't fit are summed up by who sent them, not
+        # by their titles.
+        queue = NotificationQueue(per_minute=2)
+        queue.add('Alice', 'Hello', '', 'messages')
+        for sender in ('Bob', 'Carol', 'Dave', 'Bob'):
+            queue.add(sender, 'Hello', '', 'private')
+        queue.add('Erin', 'Hello', '', 'mentions')
+        queue.flush(now=1000)
+        self.assertEqual(notify.call_args_list, [
+            mock.call('Alice', 'Hello', ''),
+            mock.call('5 more new messages',
+                      'From Bob, Carol and 2 others', ''),
+            ])
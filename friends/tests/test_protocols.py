@@ -18,17 +18,35 @@
 __all__ = [
     'TestProtocolManager',
     'TestProtocols',
+    'TestPublishQueue',
     ]
 
 
+import os
+import json
+import shutil
+import importlib
+import time
+import tempfile
 import unittest
 import threading
 
+from pkg_resources import resource_listdir
+
+import friends.utils.base
+
+from friends.errors import AuthorizationError, FriendsError
 from friends.protocols.flickr import Flickr
 from friends.protocols.twitter import Twitter
 from friends.tests.mocks import SCHEMA, FakeAccount, LogMock, TestModel, mock
-from friends.utils.base import Base, feature, linkify_string
+from friends.tests.mocks import mute_notifications
+from friends.utils.authentication import TokenCache
+from friends.utils.base import Base, _OperationThread, feature
+from friends.utils.base import _PublishQueue, _publish_lock, _publish_queue
+from friends.utils.base import linkify_string
+from friends.utils.cache import JsonCache
 from friends.utils.manager import ProtocolManager
+from friends.utils.snapshot import SnapshotReader, write_snapshot
 from friends.utils.model import Model
 
 
@@ -53,6 +71,56 @@ class TestProtocolManager(unittest.TestCase):
         for protocol_class in self.manager.protocols.values():
             self.assertNotEqual(protocol_class, Base)
 
+    def test_manifest_is_complete(self):
+        # Every protocol class in friends/protocols is in the manifest.
+        found = {}
+        for filename in resource_listdir('friends', 'protocols'):
+            basename, extension = os.path.splitext(filename)
+            if extension != '.py':
+                continue
+            module = importlib.import_module('friends.protocols.' + basename)
+            for name in getattr(module, '__all__', []):
+                obj = getattr(module, name)
+                if issubclass(obj, Base):
+                    found[obj.__name__.lower()] = obj
+        self.assertEqual(sorted(found), sorted(self.manager.protocols))
+        for name, protocol_class in found.items():
+            self.assertEqual(self.manager.protocols[name], protocol_class)
+
+    def test_lazy_loading(self):
+        # Protocol classes are only looked up when asked for.
+        self.assertEqual(self.manager.protocols._classes, {})
+        self.assertIn('twitter', self.manager.protocols)
+        self.assertEqual(self.manager.protocols._classes, {})
+        self.assertEqual(self.manager.protocols.get('twitter'), Twitter)
+        self.assertEqual(self.manager.protocols._classes, dict(twitter=Twitter))
+        self.assertIsNone(self.manager.protocols.get('myspace'))
+
+    def test_missing_protocol(self):
+        # A protocol whose package isn't installed is left out.
+        manager = ProtocolManager(dict(
+            twitter='friends.protocols.twitter.Twitter',
+            myspace='friends.protocols.myspace.MySpace',
+            ))
+        self.assertEqual(list(manager.protocols), ['twitter'])
+        self.assertEqual(len(manager.protocols), 1)
+        self.assertNotIn('myspace', manager.protocols)
+        self.assertIsNone(manager.protocols.get('myspace'))
+        self.assertRaises(KeyError, manager.protocols.__getitem__, 'myspace')
+        self.assertEqual(manager.protocols.get('twitter'), Twitter)
+
+    def test_class_name(self):
+        self.assertEqual(self.manager.class_name('foursquare'), 'FourSquare')
+        self.assertEqual(self.manager.class_name('linkedin'), 'LinkedIn')
+
+
+def run_main_loop(thread):
+    """Stand in for the main loop, until thread has finished."""
+    while thread.is_alive():
+        _publish_queue._drain()
+        time.sleep(0.001)
+    thread.join()
+
 
 class MyProtocol(Base):
     """Simplest possible protocol implementation to allow testing of Base."""
@@ -79,7 +147,7 @@ class MyProtocol(Base):
     def non_feature_2(self): pass
 
 
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestProtocols(unittest.TestCase):
     """Test protocol implementations."""
 
@@ -122,9 +190,10 @@ class TestProtocols(unittest.TestCase):
         success = mock.Mock()
         failure = mock.Mock()
         # Using __call__ makes invocation happen asynchronously in a thread.
-        my_protocol('noop', 'one', 'two',
-                    success=success,
-                    failure=failure)
+        operation_id = my_protocol('noop', 'one', 'two',
+                                   success=success,
+                                   failure=failure)
+        self.assertTrue(operation_id.startswith('MyProtocol.noop.'))
         for thread in threading.enumerate():
             # Join all but the main thread.
             if thread != threading.current_thread():
@@ -133,6 +202,73 @@ class TestProtocols(unittest.TestCase):
         success.assert_called_once_with('one:two')
         self.assertEqual(failure.call_count, 0)
 
+    @mock.patch('friends.utils.base._OperationThread.reporter')
+    def test_operation_reported(self, reporter):
+        def work():
+            thread = threading.current_thread()
+            thread.pages += 1
+            thread.contacts += 2
+            # Too soon after starting to report.
+            thread.progress()
+        thread = _OperationThread(id='Test.work', target=work)
+        thread.start()
+        thread.join()
+        counts = dict(pages=1, new_rows=0, contacts=2)
+        self.assertEqual(reporter.mock_calls, [
+            mock.call(thread.operation_id, 'started',
+                      dict(pages=0, new_rows=0, contacts=0)),
+            mock.call(thread.operation_id, 'completed', counts),
+            ])
+        self.assertRegex(thread.operation_id, r'^Test\.work\.\d+$')
+
+    @mock.patch('friends.utils.base._OperationThread.reporter')
+    def test_operation_failure_reported(self, reporter):
+        def work():
+            raise ValueError('Boom')
+        thread = _OperationThread(id='Test.work', target=work)
+        with LogMock('friends.utils.base'):
+            thread.start()
+            thread.join()
+        self.assertEqual(reporter.call_args[0][1], 'failed')
+
+    @mock.patch('friends.utils.base._OperationThread.reporter')
+    @mock.patch('friends.utils.base.time')
+    def test_progress_rate_limited(self, time_mock, reporter):
+        time_mock.monotonic.side_effect = [10, 10.5, 11.5, 11.6]
+        thread = _OperationThread(target=mock.Mock())
+        for i in range(4):
+            thread.progress()
+        self.assertEqual(reporter.call_count, 2)
+        quiet = _OperationThread(target=mock.Mock(), quiet=True)
+        time_mock.monotonic.side_effect = [20]
+        quiet.progress()
+        self.assertEqual(reporter.call_count, 2)
+
+    def test_batch(self):
+        my_protocol = MyProtocol(object())
+        callback = mock.Mock()
+        with LogMock('friends.utils.base') as log_mock:
+            my_protocol._batch(
+                [('noop', ('one', 'two')),
+                 ('_private', ()),
+                 ('noop', ('three',))],
+                callback)
+            for thread in threading.enumerate():
+                # Join all but the main thread.
+                if thread != threading.current_thread():
+                    thread.join()
+            self.assertIn('NotImplementedError: _private', log_mock.empty())
+        outcomes = callback.call_args[0][0]
+        operation_id = outcomes[0].pop('operation_id')
+        self.assertTrue(operation_id.startswith('MyProtocol.batch.'))
+        for outcome in outcomes[1:]:
+            self.assertEqual(outcome.pop('operation_id'), operation_id)
+        callback.assert_called_once_with([
+            dict(result='one:two', new_rows=0),
+            dict(error='_private', new_rows=0),
+            dict(result='three:None', new_rows=0),
+            ])
+
     @mock.patch('friends.utils.base.Model', TestModel)
     def test_shared_model_successfully_mocked(self):
         count = Model.get_n_rows()
@@ -165,6 +301,170 @@ class TestProtocols(unittest.TestCase):
                  )
             )
 
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_seen_dicts_loaded_from_index(self):
+        from friends.utils.base import _seen_ids
+        from friends.utils.base import initialize_caches
+        base = Base(FakeAccount())
+        base._publish(message_id='alpha', sender='a', message='a')
+        base._publish(message_id='beta', sender='a', message='a')
+        base._publish(message_id='omega', sender='a', message='b')
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        index_path = os.path.join(temp_cache, 'model-index.json')
+        with open(index_path, 'w') as fd:
+            fd.write(json.dumps(dict(
+                seqnum=TestModel.get_seqnum(),
+                ids=['alpha', 'beta', 'omega'])))
+        with mock.patch('friends.utils.base.INDEX_PATH', index_path):
+            with LogMock('friends.utils.base') as log_mock:
+                initialize_caches()
+                self.assertRegex(log_mock.empty(),
+                                 '_seen_ids: 3 from index in')
+        self.assertEqual(_seen_ids, dict(alpha=0, beta=1, omega=2))
+
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_stale_index_ignored(self):
+        from friends.utils.base import _seen_ids
+        from friends.utils.base import initialize_caches
+        base = Base(FakeAccount())
+        base._publish(message_id='alpha', sender='a', message='a')
+        base._publish(message_id='beta', sender='a', message='a')
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        index_path = os.path.join(temp_cache, 'model-index.json')
+        with open(index_path, 'w') as fd:
+            fd.write(json.dumps(dict(
+                seqnum=TestModel.get_seqnum() - 1,
+                ids=['alpha', 'gamma'])))
+        with mock.patch('friends.utils.base.INDEX_PATH', index_path):
+            with LogMock('friends.utils.base') as log_mock:
+                initialize_caches()
+                self.assertRegex(log_mock.empty(),
+                                 'Model index is stale, rescanning the model.'
+                                 '\n_seen_ids: 2 from model in')
+        self.assertEqual(_seen_ids, dict(alpha=0, beta=1))
+
+    def test_persist_caches(self):
+        from friends.utils.base import persist_caches
+        model = mock.MagicMock()
+        model.is_synchronized.return_value = True
+        model.get_seqnum.return_value = 42
+        model.__iter__.return_value = iter([
+            SCHEMA.build_row(message_id='alpha', stream='messages',
+                             timestamp='2013-04-16T00:00:00Z'),
+            SCHEMA.build_row(message_id='beta', stream='mentions',
+                             timestamp='2013-04-17T00:00:00Z'),
+            ])
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        index_path = os.path.join(temp_cache, 'friends', 'model-index.json')
+        with mock.patch('friends.utils.base.INDEX_PATH', index_path):
+            with mock.patch('friends.utils.base.Model', model):
+                persist_caches()
+        with open(index_path) as fd:
+            self.assertEqual(json.loads(fd.read()), dict(
+                seqnum=42,
+                ids=['alpha', 'beta'],
+                streams=['messages', 'mentions'],
+                timestamps=['2013-04-16T00:00:00Z', '2013-04-17T00:00:00Z'],
+                ))
+
+    @mock.patch('friends.utils.base._snapshot_version', None)
+    def test_persist_snapshot(self):
+        from friends.utils.base import persist_snapshot
+        rows = [
+            SCHEMA.build_row(message_id='alpha', stream='messages',
+                             likes=2, latitude=1.5),
+            SCHEMA.build_row(message_id='beta', from_me=True),
+            ]
+        model = mock.MagicMock()
+        model.is_synchronized.return_value = True
+        model.get_seqnum.return_value = 42
+        model.__iter__.side_effect = lambda: iter(rows)
+        model.__len__.return_value = len(rows)
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        path = os.path.join(temp_cache, 'friends', 'model-snapshot.bin')
+        with mock.patch('friends.utils.base.SNAPSHOT_PATH', path), \
+             mock.patch('friends.utils.base.Model', model):
+            self.assertEqual(persist_snapshot(), 42)
+            # Nothing has changed since.
+            with mock.patch('friends.utils.base.write_snapshot') as write:
+                self.assertEqual(persist_snapshot(), 42)
+                self.assertEqual(write.call_count, 0)
+            model.is_synchronized.return_value = False
+            self.assertIsNone(persist_snapshot())
+        with SnapshotReader(path) as snapshot:
+            self.assertEqual(snapshot.version, 42)
+            self.assertEqual(snapshot.columns, SCHEMA.NAMES)
+            self.assertEqual(list(snapshot), rows)
+
+    @mock.patch('friends.utils.base._snapshot_version', None)
+    @mock.patch('friends.utils.base._pruned_rows', [])
+    def test_prune_into_snapshot(self):
+        from friends.utils.base import _pruned_rows
+        from friends.utils.base import persist_snapshot, prune_into_snapshot
+        old, alpha, beta = [
+            SCHEMA.build_row(message_id=message_id)
+            for message_id in ('old', 'alpha', 'beta')]
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        path = os.path.join(temp_cache, 'friends', 'model-snapshot.bin')
+        # The last run had already pruned 'old' from the model.
+        write_snapshot(path, SCHEMA.COLUMNS, [old, alpha, beta], 41)
+        model = mock.MagicMock()
+        model.is_synchronized.return_value = True
+        model.get_seqnum.return_value = 42
+        model.__iter__.side_effect = lambda: iter([beta])
+        with mock.patch('friends.utils.base.SNAPSHOT_PATH', path), \
+             mock.patch('friends.utils.base.Model', model), \
+             mock.patch('friends.utils.base.prune_model',
+                        return_value=[alpha]) as prune:
+            # Pruning doesn't read the snapshot.
+            with mock.patch('friends.utils.base.SnapshotReader') as reader:
+                prune_into_snapshot(1)
+            self.assertFalse(reader.called)
+            prune.assert_called_once_with(1)
+            self.assertEqual(persist_snapshot(), 42)
+            with SnapshotReader(path) as snapshot:
+                self.assertEqual(list(snapshot), [old, alpha, beta])
+            # Which is where the pruned rows are kept from now on.
+            self.assertEqual(_pruned_rows, [])
+            # The snapshot's budget drops the oldest rows first.
+            model.get_seqnum.return_value = 43
+            with mock.patch('friends.utils.base.SNAPSHOT_ROWS', 2):
+                self.assertEqual(persist_snapshot(), 43)
+            with SnapshotReader(path) as snapshot:
+                self.assertEqual(list(snapshot), [alpha, beta])
+
+    @mock.patch('friends.utils.base._snapshot_version', None)
+    @mock.patch('friends.utils.base._pruned_rows', [])
+    def test_prune_into_stale_snapshot(self):
+        from friends.utils.base import persist_snapshot, prune_into_snapshot
+        old, alpha, beta = [
+            SCHEMA.build_row(message_id=message_id)
+            for message_id in ('old', 'alpha', 'beta')]
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        path = os.path.join(temp_cache, 'friends', 'model-snapshot.bin')
+        # The last run didn't get to snapshot 'alpha' before it exited.
+        write_snapshot(path, SCHEMA.COLUMNS, [old], 40)
+        model = mock.MagicMock()
+        model.is_synchronized.return_value = True
+        model.get_seqnum.return_value = 42
+        model.__iter__.side_effect = lambda: iter([beta])
+        with mock.patch('friends.utils.base.SNAPSHOT_PATH', path), \
+             mock.patch('friends.utils.base.Model', model), \
+             mock.patch('friends.utils.base.prune_model',
+                        return_value=[alpha]):
+            prune_into_snapshot(1)
+            self.assertEqual(persist_snapshot(), 42)
+        with SnapshotReader(path) as snapshot:
+            self.assertEqual(list(snapshot), [old, alpha, beta])
+
     @mock.patch('friends.utils.base.Model', TestModel)
     def test_invalid_argument(self):
         base = Base(FakeAccount())
@@ -411,6 +711,63 @@ class TestProtocols(unittest.TestCase):
             ['base', 88, '5678', '', '', '', '', False, '', '', '', '', 500,
              False, '', '', '', '', '', '', '', 0.0, 0.0])
 
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_publish_counted(self):
+        # Operations keep count of new and duplicate rows.
+        base = Base(FakeAccount())
+        def publish():
+            base._publish(message_id='1234')
+            base._publish(message_id='1234')
+            base._publish(message_id='5678')
+        thread = _OperationThread(target=publish)
+        thread.start()
+        run_main_loop(thread)
+        self.assertEqual(thread.new_rows, 2)
+        self.assertEqual(thread.duplicate_rows, 1)
+
+    def test_marks(self):
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        JsonCache._root = os.path.join(temp_cache, '{}.json')
+        base = Base(FakeAccount())
+        self.assertIsNone(base._get_mark())
+        base._set_mark(1234)
+        base._set_mark('abc', 'images')
+        # Marks never move backwards.
+        base._set_mark(1233)
+        base._set_mark('abb', 'images')
+        # Marks persist, per account.
+        self.assertEqual(Base(FakeAccount())._get_mark(), 1234)
+        self.assertEqual(Base(FakeAccount())._get_mark('images'), 'abc')
+        self.assertIsNone(Base(FakeAccount(account_id=2))._get_mark())
+
+    def test_old_marks_adopted(self):
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        JsonCache._root = os.path.join(temp_cache, '{}.json')
+        old = JsonCache('base_ids')
+        old.update(messages=1234, mentions=99)
+        old['reply_to/5'] = 6
+        base = Base(FakeAccount())
+        self.assertEqual(base._get_mark(), 1234)
+        self.assertEqual(base._get_mark('mentions'), 99)
+        self.assertIsNone(base._get_mark('reply_to/5'))
+        # The old file goes, so no other account takes them over too.
+        self.assertFalse(os.path.exists(JsonCache._root.format('base_ids')))
+        self.assertIsNone(Base(FakeAccount(account_id=2))._get_mark())
+
+    def test_old_marks_not_adopted_twice(self):
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        JsonCache._root = os.path.join(temp_cache, '{}.json')
+        Base(FakeAccount())._set_mark(5000)
+        JsonCache('base_ids')['messages'] = 1234
+        # Marks that the account already has win over the old ones.
+        base = Base(FakeAccount())
+        self.assertEqual(base._get_mark(), 5000)
+        self.assertFalse(os.path.exists(JsonCache._root.format('base_ids')))
+
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
     def test_fetch_cell(self):
@@ -435,6 +792,121 @@ class TestProtocols(unittest.TestCase):
         my_protocol = FailingProtocol(FakeAccount())
         self.assertFalse(my_protocol._login())
 
+    def _temp_token_cache(self):
+        temp_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_cache)
+        JsonCache._root = os.path.join(temp_cache, '{}.json')
+
+    @mock.patch('friends.utils.base.time.time', return_value=1000.0)
+    def test_saved_token_reused(self, time):
+        self._temp_token_cache()
+        saved = TokenCache('token-88')
+        saved.update(access_token='saved token', user_id='1234',
+                     expires=5000.0, credentials='fakeauth id', saved=900.0)
+        saved.write()
+        my_protocol = MyProtocol(FakeAccount())
+        my_protocol._login = mock.Mock()
+        self.assertEqual(my_protocol._get_access_token(), 'saved token')
+        self.assertEqual(my_protocol._account.user_id, '1234')
+        self.assertEqual(my_protocol._account.token_expires, 5000.0)
+        self.assertFalse(my_protocol._login.called)
+
+    @mock.patch('friends.utils.base.time.time', return_value=6000.0)
+    def test_expired_saved_token_ignored(self, time):
+        self._temp_token_cache()
+        saved = TokenCache('token-88')
+        saved.update(access_token='saved token', expires=5000.0)
+        saved.write()
+        my_protocol = MyProtocol(FakeAccount())
+        self.assertEqual(my_protocol._get_access_token(), 'fake_token')
+
+    @mock.patch('friends.utils.base.time.time', return_value=1000.0)
+    def test_saved_token_of_other_credentials_ignored(self, time):
+        self._temp_token_cache()
+        saved = TokenCache('token-88')
+        saved.update(access_token='saved token', expires=5000.0,
+                     credentials='old credentials')
+        saved.write()
+        my_protocol = MyProtocol(FakeAccount())
+        self.assertEqual(my_protocol._get_access_token(), 'fake_token')
+        # The stale token doesn't outlive the credentials it came from.
+        self.assertNotEqual(TokenCache('token-88').get('access_token'),
+                            'saved token')
+
+    def test_refused_token_forgotten(self):
+        self._temp_token_cache()
+        class RefusingProtocol(MyProtocol):
+            _AUTH_ERROR_CODES = frozenset((89,))
+        my_protocol = RefusingProtocol(FakeAccount())
+        my_protocol._account.access_token = 'revoked token'
+        my_protocol._account.token_expires = None
+        cache = TokenCache('token-88')
+        cache.update(access_token='revoked token')
+        cache.write()
+        with self.assertRaises(AuthorizationError) as cm:
+            my_protocol._is_error(dict(errors=[
+                dict(code=89, message='Invalid or expired token.')]))
+        self.assertEqual(cm.exception.account, 88)
+        self.assertIsNone(my_protocol._account.access_token)
+        self.assertFalse(os.path.exists(JsonCache._root.format('token-88')))
+        # So the next request logs in again.
+        self.assertEqual(my_protocol._get_access_token(), 'fake_token')
+
+    def test_other_errors_keep_token(self):
+        class RefusingProtocol(MyProtocol):
+            _AUTH_ERROR_CODES = frozenset((89,))
+        my_protocol = RefusingProtocol(FakeAccount())
+        my_protocol._account.access_token = 'good token'
+        with self.assertRaises(FriendsError) as cm:
+            my_protocol._is_error(dict(errors=[
+                dict(code=88, message='Rate limit exceeded')]))
+        self.assertNotIsInstance(cm.exception, AuthorizationError)
+        self.assertEqual(my_protocol._account.access_token, 'good token')
+
+    @mock.patch('friends.utils.base._OperationThread')
+    @mock.patch('friends.utils.base.time.time', return_value=4900.0)
+    def test_token_refreshed_before_expiry(self, time, thread):
+        self._temp_token_cache()
+        my_protocol = MyProtocol(FakeAccount())
+        my_protocol._account.access_token = 'old token'
+        my_protocol._account.token_expires = 5000.0
+        # The old token is still handed out while a new one is fetched.
+        self.assertEqual(my_protocol._get_access_token(), 'old token')
+        thread.assert_called_once_with(
+            id='MyProtocol._refresh_token', quiet=True,
+            target=my_protocol._login)
+        thread().start.assert_called_once_with()
+
+    @mock.patch('friends.utils.base.GLib')
+    @mock.patch('friends.utils.authentication.Authentication.__init__',
+                return_value=None)
+    @mock.patch('friends.utils.authentication.Authentication.login',
+                return_value=dict(AccessToken='token', ExpiresIn='3600'))
+    def test_one_refresh_timer(self, login, init, glib):
+        self._temp_token_cache()
+        glib.timeout_add_seconds.side_effect = [11, 12]
+        base = Base(FakeAccount())
+        base._whoami = mock.Mock()
+        # Every login asks the main loop to schedule the next refresh.
+        base._locked_login(None)
+        base._locked_login('token')
+        self.assertFalse(glib.timeout_add_seconds.called)
+        self.assertEqual(glib.idle_add.call_args_list, [
+            mock.call(base._schedule_refresh, 3300),
+            mock.call(base._schedule_refresh, 3300),
+            ])
+        # Which keeps only the latest timer.
+        for args, kws in glib.idle_add.call_args_list:
+            self.assertFalse(args[0](*args[1:]))
+        glib.source_remove.assert_called_once_with(11)
+        self.assertEqual(base._refresh_timer, 12)
+        glib.timeout_add_seconds.assert_called_with(
+            3300, base._refresh_timer_expired)
+        with mock.patch.object(base, '_refresh_token') as refresh:
+            self.assertFalse(base._refresh_timer_expired())
+        refresh.assert_called_once_with()
+        self.assertIsNone(base._refresh_timer)
+
     # XXX I think there's a threading test that should be performed, but it
     # hurts my brain too much.  See the comment at the bottom of the
     # with-statement in Base._login().
@@ -533,3 +1005,152 @@ class TestProtocols(unittest.TestCase):
             linkify_string(
                 '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" '
                 '"http://www.w3.org/TR/REC-html40/strict.dtd">'))
+
+    def test_poll_floor(self):
+        base = Base(FakeAccount())
+        self.assertEqual(base._poll_floor('receive', 10), 0)
+        with mock.patch.object(Base, '_HOURLY_LIMIT', 200), \
+             mock.patch.object(Base, '_POLL_STREAMS', ('home', 'wall')):
+            # Each stream gets a quarter of the limit, 50 requests an hour.
+            self.assertEqual(base._poll_floor('home'), 72)
+            self.assertEqual(base._poll_floor('wall', 3), 216)
+            self.assertEqual(base._poll_floor('wall', 0), 72)
+
+
+@mock.patch('friends.utils.base.GLib')
+@mock.patch('friends.utils.base.Model', TestModel)
+@mock.patch('friends.utils.base._seen_ids', {})
+@mute_notifications
+class TestPublishQueue(unittest.TestCase):
+    """Test changing the model from the main loop only."""
+
+    def setUp(self):
+        TestModel.clear()
+        self.queue = _PublishQueue()
+
+    def in_thread(self, function, *args):
+        """Start a thread calling function(*args), and return its outcome.
+
+        The outcome is a list, holding the return value or exception
+        once the thread has finished.
+        """
+        outcome = []
+        queued = len(self.queue._changes)
+        def run():
+            try:
+                outcome.append(function(*args))
+            except Exception as error:
+                outcome.append(error)
+        thread = threading.Thread(target=run)
+        thread.start()
+        # Give the thread a moment to queue its change.
+        while len(self.queue._changes) == queued and thread.is_alive():
+            time.sleep(0.001)
+        return thread, outcome
+
+    def test_main_thread_applies_now(self, glib):
+        appended = []
+        self.assertEqual(self.queue.call(appended.append, 1), None)
+        self.assertEqual(appended, [1])
+        self.assertFalse(glib.idle_add.called)
+
+    def test_main_thread_queues_until_synchronized(self, glib):
+        # friends-dispatcher holds the lock until the model is ready, and
+        # the main thread can't wait for itself.
+        appended = []
+        with _publish_lock:
+            self.assertIsNone(self.queue.call(appended.append, 1))
+        self.assertEqual(appended, [])
+        self.queue._drain()
+        self.assertEqual(appended, [1])
+
+    def test_other_threads_wait(self, glib):
+        thread, outcome = self.in_thread(self.queue.call, len, [1, 2])
+        self.assertEqual(outcome, [])
+        glib.idle_add.assert_called_once_with(self.queue._drain)
+        self.assertFalse(self.queue._drain())
+        thread.join()
+        self.assertEqual(outcome, [2])
+
+    def test_batches(self, glib):
+        appended = []
+        threads = []
+        for i in range(250):
+            threads.append(self.in_thread(
+                self.queue.call, appended.append, i)[0])
+        # The idle handler is only scheduled once.
+        glib.idle_add.assert_called_once_with(self.queue._drain)
+        self.assertTrue(self.queue._drain())
+        self.assertTrue(self.queue._drain())
+        self.assertEqual(len(appended), 200)
+        self.assertFalse(self.queue._drain())
+        self.assertEqual(appended, list(range(250)))
+        for thread in threads:
+            thread.join()
+
+    def test_errors_raised_in_caller(self, glib):
+        thread, outcome = self.in_thread(self.queue.call, int, 'one')
+        self.queue._drain()
+        thread.join()
+        self.assertIsInstance(outcome[0], ValueError)
+        self.assertIn('invalid literal for int()', str(outcome[0]))
+
+    @mock.patch('friends.utils.base.PUBLISH_TIMEOUT', 0.01)
+    def test_timeout(self, glib):
+        appended = []
+        thread, outcome = self.in_thread(self.queue.call, appended.append, 1)
+        thread.join()
+        self.assertIsInstance(outcome[0], FriendsError)
+        # The caller has given up, so the change isn't made after all.
+        self.assertFalse(self.queue._drain())
+        self.assertEqual(appended, [])
+
+    def test_waits_for_synchronized_model(self, glib):
+        appended = []
+        with _publish_lock:
+            thread, outcome = self.in_thread(
+                self.queue.call, appended.append, 1)
+            self.assertFalse(self.queue._drain())
+        self.assertEqual(appended, [])
+        # friends-dispatcher schedules it again once it's ready.
+        self.queue.schedule()
+        self.assertEqual(glib.idle_add.call_count, 2)
+        self.queue._drain()
+        thread.join()
+        self.assertEqual(appended, [1])
+
+    def test_published_from_thread(self, glib):
+        base = Base(FakeAccount())
+        success = mock.Mock()
+        published = []
+        def publish():
+            published.append(base._publish(message_id='1234', sender='fred'))
+            published.append('1234' in friends.utils.base._seen_ids)
+            return base._get_n_rows()
+        thread = _OperationThread(target=publish, success=success)
+        thread.start()
+        run_main_loop(thread)
+        self.assertEqual(published, [True, True])
+        success.assert_called_once_with('1')
+        self.assertEqual(thread.new_rows, 1)
+
+    def test_unpublish_error_from_thread(self, glib):
+        base = Base(FakeAccount())
+        failure = mock.Mock()
+        thread = _OperationThread(
+            target=base._unpublish, args=('5678',), failure=failure)
+        with LogMock('friends.utils.base'):
+            thread.start()
+            run_main_loop(thread)
+        failure.assert_called_once_with(
+            'Tried to delete an invalid message id.')
+
+    def test_inc_cell_error_from_thread(self, glib):
+        base = Base(FakeAccount())
+        failure = mock.Mock()
+        thread = _OperationThread(
+            target=base._inc_cell, args=('5678', 'likes'), failure=failure)
+        with LogMock('friends.utils.base'):
+            thread.start()
+            run_main_loop(thread)
+        failure.assert_called_once_with('Cell could not be found.')
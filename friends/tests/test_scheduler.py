@@ -0,0 +1,196 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the adaptive poll scheduler."""
+
+__all__ = [
+    'TestPollScheduler',
+    'TestStreamSchedule',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from friends.tests.mocks import LogMock, mock
+from friends.utils.base import _OperationThread
+from friends.utils.cache import JsonCache
+from friends.utils.scheduler import PollScheduler, StreamSchedule
+from friends.utils.scheduler import DEFAULT_INTERVAL, MAX_INTERVAL
+from friends.utils.scheduler import MIN_INTERVAL
+
+
+class TestStreamSchedule(unittest.TestCase):
+    """Test how intervals follow the yield of a stream."""
+
+    def test_first_poll_keeps_interval(self):
+        schedule = StreamSchedule(88, 'home')
+        schedule.record(50, 1000)
+        self.assertEqual(schedule.interval, DEFAULT_INTERVAL)
+        self.assertEqual(schedule.next_poll, 1000 + DEFAULT_INTERVAL)
+        self.assertIsNone(schedule.rate)
+
+    def test_busy_stream_polled_often(self):
+        schedule = StreamSchedule(88, 'home')
+        schedule.record(50, 1000)
+        # 100 new messages in 900s is far more than we aim for.
+        schedule.record(100, 1900)
+        self.assertEqual(schedule.interval, MIN_INTERVAL)
+
+    def test_quiet_stream_backs_off(self):
+        schedule = StreamSchedule(88, 'home')
+        now = 1000
+        for i in range(10):
+            schedule.record(0, now)
+            now = schedule.next_poll
+        self.assertEqual(schedule.interval, MAX_INTERVAL)
+        self.assertEqual(schedule.polls, 10)
+
+    def test_rate_limit_wins(self):
+        schedule = StreamSchedule(88, 'home')
+        schedule.record(50, 1000)
+        schedule.record(100, 1900, floor=600)
+        self.assertEqual(schedule.interval, 600)
+
+    def test_failure_backs_off(self):
+        schedule = StreamSchedule(88, 'home', interval=300)
+        schedule.failed(1000)
+        self.assertEqual(schedule.interval, 600)
+        self.assertEqual(schedule.next_poll, 1600)
+
+    def test_as_dict(self):
+        schedule = StreamSchedule(88, 'home')
+        schedule.record(3, 1000)
+        schedule.record(9, 1900)
+        self.assertEqual(schedule.as_dict(2000), dict(
+            account_id=88,
+            stream='home',
+            interval=500,
+            next_poll=400,
+            yield_per_hour=36.0,
+            last_yield=9,
+            last_duplicates=0,
+            last_bytes=0,
+            polls=2,
+            items=12,
+            ))
+
+
+class TestPollScheduler(unittest.TestCase):
+    """Test polling the streams that are due."""
+
+    def setUp(self):
+        self.log_mock = LogMock('friends.utils.scheduler',
+                                'friends.utils.base')
+        self.account = mock.Mock(id=88)
+        self.account.protocol._POLL_STREAMS = ('home', 'mentions')
+        self.account.protocol._poll_floor.return_value = 0
+        self.scheduler = PollScheduler({88: self.account})
+        self._temp_cache = tempfile.mkdtemp()
+        self._root = JsonCache._root = os.path.join(
+            self._temp_cache, '{}.json')
+
+    def tearDown(self):
+        self.log_mock.stop()
+        shutil.rmtree(self._temp_cache)
+
+    def test_everything_due_at_first(self):
+        self.assertEqual(self.scheduler.poll(1000), 2)
+        streams = [call[0][0] for call in self.account.protocol.call_args_list]
+        self.assertEqual(sorted(streams), ['home', 'mentions'])
+
+    @mock.patch('friends.utils.scheduler.time.time', return_value=1000)
+    def test_tick_reports_polls(self, time):
+        polled = mock.Mock()
+        scheduler = PollScheduler({88: self.account}, polled)
+        self.assertTrue(scheduler._tick())
+        polled.assert_called_once_with()
+        # Nothing is due now, so there's nothing to report.
+        self.assertTrue(scheduler._tick())
+        polled.assert_called_once_with()
+
+    def test_no_overlapping_polls(self):
+        self.scheduler.poll(1000)
+        # Neither poll has finished yet.
+        self.assertEqual(self.scheduler.poll(5000), 0)
+
+    @mock.patch('friends.utils.scheduler.time.time', return_value=1000)
+    def test_success_records_new_rows(self, time):
+        self.scheduler.poll(1000)
+        for call in self.account.protocol.call_args_list:
+            stream = call[0][0]
+            # Pretend that the operation published some rows.
+            thread = _OperationThread(
+                id=stream, target=lambda: 'done',
+                success=call[1]['success'])
+            thread.new_rows = 7 if stream == 'home' else 0
+            thread.duplicate_rows = 43 if stream == 'home' else 50
+            thread.bytes_downloaded = 1024
+            thread.start()
+            thread.join()
+        stats = {stats['stream']: stats for stats in self.scheduler.stats()}
+        self.assertEqual(stats['home']['last_yield'], 7)
+        self.assertEqual(stats['home']['polls'], 1)
+        self.assertEqual(stats['home']['last_duplicates'], 43)
+        self.assertEqual(stats['home']['last_bytes'], 1024)
+        self.assertEqual(stats['mentions']['last_yield'], 0)
+        self.assertEqual(stats['mentions']['last_duplicates'], 50)
+        # Neither stream is due again yet.
+        self.assertEqual(self.scheduler.poll(1001), 0)
+
+    @mock.patch('friends.utils.scheduler.time.time', return_value=1000)
+    def test_failure_allows_next_poll(self, time):
+        self.scheduler.poll(1000)
+        for call in self.account.protocol.call_args_list:
+            call[1]['failure']('Boom')
+        intervals = [stats['interval'] for stats in self.scheduler.stats()]
+        self.assertEqual(intervals, [2 * DEFAULT_INTERVAL] * 2)
+        self.assertEqual(self.scheduler.poll(1000 + DEFAULT_INTERVAL), 0)
+        self.assertEqual(self.scheduler.poll(1000 + 4 * DEFAULT_INTERVAL), 2)
+
+    def test_unsupported_stream_dropped(self):
+        self.account.protocol.side_effect = NotImplementedError
+        self.assertEqual(self.scheduler.poll(1000), 0)
+        self.account.protocol.reset_mock()
+        self.scheduler.poll(1000000)
+        self.assertFalse(self.account.protocol.called)
+
+    @mock.patch('friends.utils.scheduler.time.time', return_value=1000)
+    def test_floor_from_requests_made(self, time):
+        self.scheduler.poll(1000)
+        call = self.account.protocol.call_args_list[0]
+        thread = _OperationThread(
+            id=call[0][0], target=lambda: 'done', success=call[1]['success'])
+        thread.pages = 3
+        thread.start()
+        thread.join()
+        self.account.protocol._poll_floor.assert_called_once_with(
+            call[0][0], 3)
+
+    @mock.patch('friends.utils.scheduler.time.time', return_value=1000)
+    def test_schedules_persisted(self, time):
+        self.scheduler.poll(1000)
+        for call in self.account.protocol.call_args_list:
+            call[1]['failure']('Boom')
+        self.scheduler.persist()
+        # The next dispatcher carries on where this one left off.
+        scheduler = PollScheduler({88: self.account})
+        self.assertEqual(scheduler.poll(1000 + DEFAULT_INTERVAL), 0)
+        self.assertEqual(
+            [stats['interval'] for stats in scheduler.stats()],
+            [2 * DEFAULT_INTERVAL] * 2)
+        self.assertEqual(scheduler.poll(1000 + 2 * DEFAULT_INTERVAL), 2)
@@ -0,0 +1,119 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test writing and reading columnar model snapshots."""
+
+__all__ = [
+    'TestSnapshot',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from friends.utils.snapshot import SnapshotReader, write_snapshot
+
+
+COLUMNS = [
+    ('message_id', 's'),
+    ('likes', 't'),
+    ('from_me', 'b'),
+    ('latitude', 'd'),
+    ]
+
+ROWS = [
+    ('1234', 3, False, 1.5),
+    ('', 0, True, -80.25),
+    ('caf\xe9 ☕', 18446744073709551615, False, 0),
+    ]
+
+
+class TestSnapshot(unittest.TestCase):
+    """Test the snapshot file format."""
+
+    def setUp(self):
+        self._temp_cache = tempfile.mkdtemp()
+        self.path = os.path.join(self._temp_cache, 'friends', 'snap.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_cache)
+
+    def test_round_trip(self):
+        write_snapshot(self.path, COLUMNS, ROWS, 42)
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual(snapshot.version, 42)
+            self.assertEqual(len(snapshot), 3)
+            self.assertEqual(snapshot.columns,
+                             ['message_id', 'likes', 'from_me', 'latitude'])
+            self.assertEqual(list(snapshot), ROWS)
+            self.assertEqual(snapshot.row(2), ROWS[2])
+
+    def test_columns(self):
+        write_snapshot(self.path, COLUMNS, ROWS, 42)
+        with SnapshotReader(self.path) as snapshot:
+            ids = snapshot.column('message_id')
+            self.assertEqual(len(ids), 3)
+            self.assertEqual(ids[-1], 'caf\xe9 ☕')
+            self.assertEqual(ids[:2], ['1234', ''])
+            self.assertEqual(list(snapshot.column('from_me')),
+                             [False, True, False])
+            self.assertRaises(IndexError, ids.__getitem__, 3)
+            self.assertRaises(KeyError, snapshot.column, 'sender')
+
+    def test_empty(self):
+        write_snapshot(self.path, COLUMNS, [], 7)
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual(len(snapshot), 0)
+            self.assertEqual(list(snapshot), [])
+            self.assertEqual(list(snapshot.column('likes')), [])
+
+    def test_columns_aligned(self):
+        write_snapshot(self.path, COLUMNS, ROWS, 42)
+        with SnapshotReader(self.path) as snapshot:
+            for name in snapshot.columns:
+                self.assertEqual(snapshot._entries[name][1] % 8, 0)
+
+    def test_long_column_name(self):
+        # Names that don't fit aren't truncated into a different name.
+        columns = COLUMNS + [('x' * 31 + '\xe9', 's')]
+        rows = [row + ('',) for row in ROWS]
+        self.assertRaises(ValueError, write_snapshot,
+                          self.path, columns, rows, 42)
+        self.assertFalse(os.path.exists(self.path))
+        columns[-1] = ('x' * 30 + '\xe9', 's')
+        write_snapshot(self.path, columns, rows, 42)
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual(snapshot.columns[-1], 'x' * 30 + '\xe9')
+
+    def test_not_a_snapshot(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as fd:
+            fd.write(b'{"ids": []}' * 10)
+        self.assertRaises(ValueError, SnapshotReader, self.path)
+
+    def test_open_snapshot_unchanged(self):
+        # Readers keep the version they opened while a new one is written.
+        write_snapshot(self.path, COLUMNS, ROWS, 42)
+        with SnapshotReader(self.path) as old:
+            write_snapshot(self.path, COLUMNS, ROWS[:1], 43)
+            self.assertEqual(old.version, 42)
+            self.assertEqual(list(old), ROWS)
+        with SnapshotReader(self.path) as new:
+            self.assertEqual(new.version, 43)
+            self.assertEqual(list(new), ROWS[:1])
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['snap.bin'])
@@ -0,0 +1,251 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test receiving messages from streaming connections."""
+
+__all__ = [
+    'TestJsonArrayDecoder',
+    'TestJsonLineDecoder',
+    'TestStreamReceiver',
+    ]
+
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen
+
+from pkg_resources import resource_filename
+
+from friends.protocols.twitter import Twitter
+from friends.tests.mocks import FakeAccount, LogMock, mock
+from friends.utils.cache import JsonCache
+from friends.utils.stream import JsonArrayDecoder, JsonLineDecoder
+from friends.utils.stream import StreamReceiver
+
+
+FIXTURES = (
+    'twitter-home.dat',
+    'twitter-send.dat',
+    'twitter-retweet.dat',
+    'twitter-multiple-links.dat',
+    'twitter-hashtags.dat',
+    )
+
+
+def replay():
+    """Return the tweets in the Twitter fixtures, one per stream line."""
+    lines = []
+    for fixture in FIXTURES:
+        with open(resource_filename('friends.tests.data', fixture)) as fd:
+            data = json.load(fd)
+        for tweet in (data if isinstance(data, list) else [data]):
+            lines.append(json.dumps(tweet).encode('utf-8') + b'\r\n')
+    return lines
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Replay the fixtures as a Twitter-style stream, then hang up."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lines = replay()
+        self.connections = 0
+        self.url = 'http://127.0.0.1:{}/1.1/user.json'.format(
+            self.server_port)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # A keep-alive, then each tweet split across two chunks.
+        chunks = [b'\r\n']
+        for line in self.server.lines:
+            chunks.extend((line[:50], line[50:]))
+        for chunk in chunks + [b'']:
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode())
+            self.wfile.write(chunk + b'\r\n')
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class UrllibStream:
+    """Stand in for friends.utils.http._ResponseStream."""
+
+    def __init__(self, url):
+        self._response = urlopen(url)
+
+    def read(self, size):
+        return self._response.read1(size)
+
+    def close(self):
+        self._response.close()
+
+
+class TestJsonArrayDecoder(unittest.TestCase):
+    """Test picking array items out of a JSON document."""
+
+    def feed(self, decoder, text, size):
+        items = []
+        for i in range(0, len(text), size):
+            items.extend(decoder.feed(text[i:i + size]))
+        decoder.close()
+        return items
+
+    def test_top_level_array(self):
+        text = ' [12345, "a,b]", {"c": [1, 2]}, null] '
+        for size in (1, 4, len(text)):
+            self.assertEqual(
+                self.feed(JsonArrayDecoder(), text, size),
+                [12345, 'a,b]', dict(c=[1, 2]), None])
+
+    def test_array_in_object(self):
+        text = '{"before": {"a": [1]}, "data": [1, 2], "paging": 3.5}'
+        for size in (1, 5, len(text)):
+            rest = {}
+            self.assertEqual(
+                self.feed(JsonArrayDecoder('data', rest), text, size), [1, 2])
+            self.assertEqual(
+                rest, dict(before=dict(a=[1]), data=[], paging=3.5))
+
+    def test_missing_array(self):
+        rest = {}
+        self.assertEqual(
+            self.feed(JsonArrayDecoder('data', rest), '{"error": {}}', 3), [])
+        self.assertEqual(rest, dict(error={}))
+
+    def test_incomplete(self):
+        decoder = JsonArrayDecoder()
+        self.assertEqual(decoder.feed('[1, 2'), [1])
+        self.assertRaises(ValueError, decoder.close)
+
+
+class TestJsonLineDecoder(unittest.TestCase):
+    """Test splitting a byte stream into JSON objects."""
+
+    def setUp(self):
+        self.log_mock = LogMock('friends.utils.stream')
+
+    def tearDown(self):
+        self.log_mock.stop()
+
+    def test_lines_across_chunks(self):
+        decoder = JsonLineDecoder()
+        self.assertEqual(decoder.feed(b'{"a": 1}\r\n{"b"'), [dict(a=1)])
+        self.assertEqual(decoder.feed(b': 2}'), [])
+        self.assertEqual(decoder.feed(b'\r\n'), [dict(b=2)])
+
+    def test_split_character(self):
+        decoder = JsonLineDecoder()
+        line = '{"text": "caf\xe9"}\n'.encode('utf-8')
+        self.assertEqual(decoder.feed(line[:-3]), [])
+        self.assertEqual(decoder.feed(line[-3:]), [dict(text='caf\xe9')])
+
+    def test_keep_alive(self):
+        decoder = JsonLineDecoder()
+        self.assertEqual(decoder.feed(b'\r\n\r\n[1]\r\n\r\n'), [[1]])
+
+    def test_garbage_skipped(self):
+        decoder = JsonLineDecoder()
+        self.assertEqual(decoder.feed(b'{"a": \n[2]\n'), [[2]])
+        self.assertEqual(
+            self.log_mock.empty(),
+            "Skipping undecodable stream line: b'{\"a\":'\n")
+
+
+class TestStreamReceiver(unittest.TestCase):
+    """Test receiving from a stand-in server."""
+
+    def setUp(self):
+        self.log_mock = LogMock('friends.utils.stream')
+        self.server = StandInServer()
+        self._temp_cache = tempfile.mkdtemp()
+        JsonCache._root = os.path.join(self._temp_cache, '{}.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.log_mock.stop()
+        shutil.rmtree(self._temp_cache)
+
+    def receive(self, callback, connections=1):
+        """Receive until the server has been connected to enough times."""
+        done = threading.Event()
+        def connect():
+            if self.server.connections >= connections:
+                done.set()
+                raise OSError('That will do')
+            return UrllibStream(self.server.url)
+        receiver = StreamReceiver('Test', connect, callback)
+        receiver.start()
+        self.assertTrue(done.wait(5))
+        receiver.stop()
+        receiver.join(5)
+        self.assertFalse(receiver.is_alive())
+        return receiver
+
+    @mock.patch('friends.utils.stream.MIN_BACKOFF', 0)
+    def test_replay(self):
+        received = []
+        receiver = self.receive(received.append)
+        self.assertEqual(
+            [tweet['id_str'] for tweet in received],
+            [json.loads(line.decode())['id_str']
+             for line in self.server.lines])
+        self.assertEqual(receiver.connections, 1)
+        self.assertEqual(StreamReceiver.running, 0)
+
+    @mock.patch('friends.utils.stream.MIN_BACKOFF', 0)
+    def test_reconnect(self):
+        received = []
+        receiver = self.receive(received.append, connections=3)
+        self.assertEqual(receiver.connections, 3)
+        self.assertEqual(len(received), 3 * len(self.server.lines))
+
+    @mock.patch('friends.utils.stream.MIN_BACKOFF', 0)
+    def test_bad_message_survived(self):
+        received = []
+        def callback(tweet):
+            if not received:
+                received.append(None)
+                raise ValueError('Boom')
+            received.append(tweet)
+        self.receive(callback)
+        self.assertEqual(len(received), len(self.server.lines))
+
+    @mock.patch('friends.utils.stream.MIN_BACKOFF', 0)
+    def test_twitter(self):
+        protocol = Twitter(FakeAccount())
+        protocol._publish_tweet = mock.Mock()
+        protocol._unpublish = mock.Mock()
+        self.receive(protocol._stream_event)
+        self.assertEqual(
+            protocol._publish_tweet.call_count, len(self.server.lines))
@@ -23,7 +23,7 @@ __all__ = [
 import unittest
 import threading
 
-from friends.tests.mocks import mock
+from friends.tests.mocks import mock, mute_notifications
 from friends.utils.base import _OperationThread
 
 
@@ -49,7 +49,7 @@ def adder(a, b):
     return a + b
 
 
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestThreads(unittest.TestCase):
     """Test protocol implementations."""
 
@@ -22,21 +22,24 @@ __all__ = [
 
 
 import os
+import json
+import time
 import tempfile
 import unittest
 import shutil
+import threading
 
 from urllib.error import HTTPError
 
 from friends.protocols.twitter import RateLimiter, Twitter
 from friends.tests.mocks import FakeAccount, FakeSoupMessage, LogMock
-from friends.tests.mocks import TestModel, mock
+from friends.tests.mocks import TestModel, mock, mute_notifications
 from friends.utils.cache import JsonCache
 from friends.errors import AuthorizationError
 
 
 @mock.patch('friends.utils.http._soup', mock.Mock())
-@mock.patch('friends.utils.base.notify', mock.Mock())
+@mute_notifications
 class TestTwitter(unittest.TestCase):
     """Test the Twitter API."""
 
@@ -177,7 +180,7 @@ oauth_signature="klnMTp3hH%2Fl3b5%2BmPtBlv%2BCulic%3D"'''
         self.account.secret_token = 'secret'
         self.assertEqual(self.protocol.home(), 3)
 
-        with open(self._root.format('twitter_ids'), 'r') as fd:
+        with open(self._root.format('marks-88'), 'r') as fd:
             self.assertEqual(fd.read(), '{"messages": 240558470661799936}')
 
         get_url = self.protocol._get_url = mock.Mock()
@@ -263,6 +266,26 @@ oauth_signature="klnMTp3hH%2Fl3b5%2BmPtBlv%2BCulic%3D"'''
         get_url.assert_called_with(
         'https://api.twitter.com/1.1/lists/statuses.json?list_id=some_list_id')
 
+    def test_list_since_id(self):
+        self.protocol._set_mark(300, 'list/some_list_id')
+        get_url = self.protocol._get_url = mock.Mock(return_value=[])
+
+        self.protocol.list('some_list_id')
+
+        get_url.assert_called_once_with(
+            'https://api.twitter.com/1.1/lists/statuses.json'
+            '?list_id=some_list_id&since_id=300')
+
+    def test_search_since_id(self):
+        self.protocol._set_mark(300, 'search/hello world')
+        get_url = self.protocol._get_url = mock.Mock(return_value={})
+
+        self.protocol.search('hello world')
+
+        get_url.assert_called_once_with(
+            'https://api.twitter.com/1.1/search/tweets.json'
+            '?q=hello%20world&since_id=300')
+
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
     def test_lists(self):
@@ -270,12 +293,106 @@ oauth_signature="klnMTp3hH%2Fl3b5%2BmPtBlv%2BCulic%3D"'''
             return_value=[dict(id_str='twitlist')])
         publish = self.protocol.list = mock.Mock()
 
-        self.assertEqual(self.protocol.lists(), 0)
+        self.assertEqual(self.protocol.lists(), '{"twitlist":0}')
 
         publish.assert_called_with('twitlist')
         get_url.assert_called_with(
             'https://api.twitter.com/1.1/lists/list.json')
 
+    def test_stream_events(self):
+        self.account.user_id = '1234'
+        publish = self.protocol._publish_tweet = mock.Mock()
+        unpublish = self.protocol._unpublish = mock.Mock()
+        mention = dict(
+            text='@me hi', entities=dict(user_mentions=[dict(id_str='1234')]))
+
+        self.protocol._stream_event(dict(friends=[1, 2, 3]))
+        self.protocol._stream_event(dict(text='hi'))
+        self.protocol._stream_event(mention)
+        self.protocol._stream_event(dict(direct_message=dict(text='psst')))
+        self.protocol._stream_event(dict(delete=dict(status=dict(id_str='9'))))
+
+        self.assertEqual(publish.call_args_list, [
+            mock.call(dict(text='hi'), mark=False),
+            mock.call(mention, stream='mentions', mark=False),
+            mock.call(dict(text='psst'), stream='private', mark=False),
+            ])
+        unpublish.assert_called_once_with('9')
+
+    @mock.patch('friends.utils.base.Model', TestModel)
+    @mock.patch('friends.utils.base._seen_ids', {})
+    def test_streamed_tweets_keep_marks(self):
+        # Polling carries on from the mark, so it picks up whatever was
+        # posted while the stream was disconnected.
+        self.protocol._set_mark(100, 'messages')
+        self.protocol._stream_event(dict(
+            id_str='5000', text='streamed',
+            created_at='Mon Jun 10 17:35:21 +0000 2013',
+            user=dict(screen_name='somebody')))
+        self.assertEqual(TestModel.get_n_rows(), 1)
+        self.assertEqual(self.protocol._get_mark('messages'), 100)
+        self.assertEqual(
+            self.protocol._append_since('http://example.com/?count=50'),
+            'http://example.com/?count=50&since_id=100')
+
+    @mock.patch('friends.protocols.twitter.StreamReceiver')
+    def test_start_stream(self, receiver):
+        self.assertTrue(self.protocol._start_stream())
+        self.assertTrue(self.protocol._start_stream())
+        receiver.assert_called_once_with(
+            'Twitter 88', self.protocol._open_stream,
+            self.protocol._stream_event)
+        receiver().start.assert_called_once_with()
+        self.protocol._stop_stream()
+        receiver().stop.assert_called_once_with()
+
+    def test_lists_concurrently(self):
+        self.protocol._get_url = mock.Mock(
+            return_value=[dict(id_str=str(i)) for i in range(10)])
+        lock = threading.Lock()
+        running = []
+        most = []
+        def fetch(list_id):
+            with lock:
+                running.append(list_id)
+                most.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(list_id)
+        self.protocol.list = mock.Mock(side_effect=fetch)
+
+        self.protocol.lists()
+
+        self.assertEqual(
+            sorted(call[0][0] for call in self.protocol.list.call_args_list),
+            sorted(str(i) for i in range(10)))
+        self.assertEqual(max(most), Twitter._LIST_WORKERS)
+
+    def test_fetch_lists_results(self):
+        def fetch(list_id):
+            if list_id == 'broken':
+                raise ValueError('Boom')
+            # Pretend that list 'bb' published two new tweets.
+            threading.current_thread().new_rows += len(list_id) * 2 - 2
+        self.protocol.list = mock.Mock(side_effect=fetch)
+
+        self.assertEqual(
+            self.protocol._fetch_lists(['a', 'bb', 'broken']),
+            {'a': 0, 'bb': 2, 'broken': 'Boom'})
+
+    def test_lists_results(self):
+        # lists() replies with the outcome of each list, not a row count.
+        self.protocol._get_url = mock.Mock(return_value=[
+            dict(id_str='a'), dict(id_str='bb'), dict(id_str='broken')])
+        def fetch(list_id):
+            if list_id == 'broken':
+                raise ValueError('Boom')
+            threading.current_thread().new_rows += len(list_id) * 2 - 2
+        self.protocol.list = mock.Mock(side_effect=fetch)
+
+        self.assertEqual(json.loads(self.protocol.lists()),
+                         {'a': 0, 'bb': 2, 'broken': 'Boom'})
+
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.utils.base._seen_ids', {})
     def test_private(self):
@@ -293,6 +410,130 @@ oauth_signature="klnMTp3hH%2Fl3b5%2BmPtBlv%2BCulic%3D"'''
                        'direct_messages/sent.json?count=50')
              ])
 
+    @mock.patch('friends.protocols.twitter._OperationThread')
+    def test_home_gap_backfilled(self, thread):
+        self.protocol._set_mark(100, 'messages')
+        tweets = [dict(id_str=str(tweet_id)) for tweet_id in range(1000, 1050)]
+        self.protocol._get_url = mock.Mock(return_value=tweets)
+        self.protocol._publish_tweet = mock.Mock()
+
+        self.protocol.home()
+
+        timeline = 'https://api.twitter.com/1.1/statuses/home_timeline.json'
+        thread.assert_called_once_with(
+            id='Twitter._backfill', quiet=True,
+            target=self.protocol._backfill, args=(timeline,))
+        thread().start.assert_called_once_with()
+        self.assertEqual(self.protocol._gaps[timeline], dict(
+            since=100, max_id=999, top=1049, stream='messages'))
+        # The mark waits for the gap to be filled.
+        self.assertTrue(self.protocol._has_gap('messages'))
+        self.assertEqual(self.protocol._get_mark('messages'), 100)
+        # The next poll asks for a bigger page, of tweets above the gap.
+        self.assertEqual(self.protocol._page_size(timeline), 100)
+        self.protocol._get_url.reset_mock()
+        self.protocol._get_url.return_value = []
+        self.protocol.home()
+        self.protocol._get_url.assert_called_once_with(
+            timeline + '?count=100&since_id=1049')
+
+    @mock.patch('friends.protocols.twitter._OperationThread')
+    def test_first_full_page_not_backfilled(self, thread):
+        tweets = [dict(id_str=str(tweet_id)) for tweet_id in range(1000, 1050)]
+        self.protocol._get_url = mock.Mock(return_value=tweets)
+        self.protocol._publish_tweet = mock.Mock()
+
+        self.protocol.mentions()
+
+        self.assertFalse(thread.called)
+        self.assertEqual(self.protocol._gaps, {})
+
+    def test_backfill(self):
+        timeline = 'https://api.twitter.com/1.1/statuses/home_timeline.json'
+        self.protocol._set_mark(100, 'messages')
+        self.protocol._gaps[timeline] = dict(
+            since=100, max_id=999, top=1049, stream='messages')
+        self.protocol._get_url = mock.Mock(side_effect=[
+            [dict(id_str=str(tweet_id)) for tweet_id in range(700, 900)],
+            [dict(id_str='650'), dict(id_str='600')],
+            ])
+        publish = self.protocol._publish_tweet = mock.Mock()
+        self.protocol._backfilling.add(timeline)
+
+        self.protocol._backfill(timeline)
+
+        self.assertEqual(
+            self.protocol._get_url.mock_calls,
+            [mock.call(timeline + '?count=200&since_id=100&max_id=999'),
+             mock.call(timeline + '?count=200&since_id=100&max_id=699')])
+        self.assertEqual(publish.call_count, 202)
+        publish.assert_called_with(dict(id_str='600'), stream='messages')
+        self.assertNotIn(timeline, self.protocol._backfilling)
+        # Only now that the gap is filled does the mark move past it.
+        self.assertEqual(self.protocol._gaps, {})
+        self.assertEqual(self.protocol._get_mark('messages'), 1049)
+
+    @mock.patch('friends.protocols.twitter._OperationThread')
+    def test_backfill_gives_up(self, thread):
+        timeline = 'https://api.twitter.com/1.1/statuses/home_timeline.json'
+        self.protocol._set_mark(100, 'messages')
+        self.protocol._gaps[timeline] = dict(
+            since=100, max_id=999, top=1049, stream='messages')
+        pages = [[dict(id_str=str(tweet_id))
+                  for tweet_id in range(start, start + 200)]
+                 for start in range(800, 0, -200)]
+        self.protocol._get_url = mock.Mock(
+            side_effect=pages + [ValueError('Boom')])
+        self.protocol._publish_tweet = mock.Mock()
+
+        self.assertRaises(ValueError, self.protocol._backfill, timeline)
+
+        self.assertEqual(self.protocol._get_url.call_count, 5)
+        # The rest of the gap is left for the next poll, and the mark
+        # stays below it.
+        self.assertEqual(self.protocol._gaps[timeline]['max_id'], 199)
+        self.assertEqual(self.protocol._get_mark('messages'), 100)
+        self.assertNotIn(timeline, self.protocol._backfilling)
+
+        self.protocol._get_url = mock.Mock(return_value=[])
+        self.protocol.home()
+        thread.assert_called_once_with(
+            id='Twitter._backfill', quiet=True,
+            target=self.protocol._backfill, args=(timeline,))
+
+    def test_backfill_restarts_from_newer_gap(self):
+        # A poll that finds another full page while the backfill is
+        # running moves the gap's top down to the new page.
+        timeline = 'https://api.twitter.com/1.1/statuses/home_timeline.json'
+        gap = self.protocol._gaps[timeline] = dict(
+            since=100, max_id=999, top=1049, stream='messages')
+        def fetch(url):
+            if fetch.first:
+                fetch.first = False
+                gap.update(max_id=1999, top=2049)
+            return []
+        fetch.first = True
+        self.protocol._get_url = mock.Mock(side_effect=fetch)
+        self.protocol._publish_tweet = mock.Mock()
+
+        self.protocol._backfill(timeline)
+
+        self.assertEqual(
+            self.protocol._get_url.mock_calls,
+            [mock.call(timeline + '?count=200&since_id=100&max_id=999'),
+             mock.call(timeline + '?count=200&since_id=100&max_id=1999')])
+        self.assertEqual(self.protocol._get_mark('messages'), 2049)
+
+    def test_quiet_timeline_page_shrinks(self):
+        timeline = 'https://api.twitter.com/1.1/statuses/home_timeline.json'
+        self.protocol._page_sizes[timeline] = 200
+        self.protocol._get_url = mock.Mock(return_value=[])
+
+        self.protocol.home()
+
+        self.protocol._get_url.assert_called_once_with(timeline + '?count=200')
+        self.assertEqual(self.protocol._page_size(timeline), 100)
+
     def test_private_avatars(self):
         get_url = self.protocol._get_url = mock.Mock(
             return_value=[
@@ -744,6 +985,25 @@ oauth_signature="klnMTp3hH%2Fl3b5%2BmPtBlv%2BCulic%3D"'''
         limiter.wait(message)
         sleep.assert_called_with(0)
 
+    @mock.patch('friends.protocols.twitter.time.sleep')
+    @mock.patch('friends.protocols.twitter.time.time', return_value=1349382153)
+    def test_rate_limiter_concurrent_requests(self, time, sleep):
+        # Requests that start before the previous response has come back
+        # still share the rate limit between them.
+        limiter = RateLimiter()
+        message = FakeSoupMessage(
+            'friends.tests.data', 'twitter-home.dat',
+            headers={
+                'X-Rate-Limit-Reset': 1349382153 + 300,
+                'X-Rate-Limit-Remaining': 3,
+                })
+        limiter.update(message.new('GET', 'http://example.com/beta'))
+        for i in range(3):
+            limiter.wait(message)
+        self.assertEqual(
+            sleep.call_args_list,
+            [mock.call(100.0), mock.call(200.0), mock.call(300.0)])
+
     @mock.patch('friends.utils.base.Model', TestModel)
     @mock.patch('friends.protocols.twitter.Twitter._login',
                 return_value=True)
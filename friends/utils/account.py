@@ -30,7 +30,7 @@ from threading import Lock
 
 from friends.errors import UnsupportedProtocolError
 from friends.utils.manager import protocol_manager
-from friends.utils.authentication import manager
+from friends.utils.authentication import TokenCache, manager
 
 
 log = logging.getLogger(__name__)
@@ -47,6 +47,8 @@ def _find_accounts_uoa():
         else:
             accounts[account.id] = account
     log.info('Accounts found: {}'.format(len(accounts)))
+    # Don't keep the secrets of accounts that have been deleted.
+    TokenCache.prune(accounts)
     return accounts
 
 
@@ -71,6 +73,8 @@ class Account:
     access_token = None
     secret_token = None
     send_enabled = None
+    user_full_name = None
+    token_expires = None
     user_name = None
     user_id = None
     auth = None
@@ -96,6 +100,7 @@ class Account:
         if protocol_class is None:
             raise UnsupportedProtocolError(protocol_name)
         self.protocol = protocol_class(self)
+        self._credentials_id = self.auth.get_credentials_id()
         # Connect responders to changes in the account information.
         account_service.connect('changed', self._on_account_changed, account)
         self._on_account_changed(account_service, account)
@@ -103,6 +108,16 @@ class Account:
         self.login_lock = Lock()
 
     def _on_account_changed(self, account_service, account):
+        auth = account_service.get_auth_data()
+        if auth is not None and (
+                auth.get_credentials_id() != self._credentials_id):
+            # The user signed in again, maybe as somebody else, so the
+            # token that we have is not to be trusted any more.
+            log.debug('{} ({}) got new credentials'.format(
+                self.protocol._Name, self.id))
+            self.auth = auth
+            self._credentials_id = auth.get_credentials_id()
+            self.protocol._forget_token()
         settings = account.get_settings_dict('friends/')
         for (key, value) in settings.items():
             if key in Account._LIBACCOUNTS_PROPERTIES:
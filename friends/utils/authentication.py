@@ -17,23 +17,28 @@
 
 __all__ = [
     'Authentication',
+    'TokenCache',
     ]
 
 
+import os
+import glob
 import logging
-import time
+import threading
 import gi
 
 gi.require_version('Signon', '1.0')
 from gi.repository import Accounts, Signon
 
-from friends.errors import AuthorizationError
+from friends.errors import AuthorizationError, ignored
+from friends.utils import jsoncodec
+from friends.utils.cache import JsonCache
 
 
 log = logging.getLogger(__name__)
 
 
-LOGIN_TIMEOUT = 30 # Currently this is measured in half-seconds.
+LOGIN_TIMEOUT = 15 # Seconds.
 
 
 # Yes, this is not the most logical place to instantiate this, but I
@@ -55,6 +60,7 @@ class Authentication:
                 'No AgService found, is your UOA plugin written correctly?')
         self._reply = None
         self._error = None
+        self._done = threading.Event()
 
     def login(self):
         auth = self.auth
@@ -66,13 +72,10 @@ class Authentication:
             auth.get_mechanism(),
             self._login_cb,
             None)
-        timeout = LOGIN_TIMEOUT
-        while self._reply is None and timeout > 0:
-            # We're building a synchronous API on top of an inherently
-            # async library, so we need to block this thread until the
-            # callback gets called to give us the response to return.
-            time.sleep(0.5)
-            timeout -= 1
+        # We're building a synchronous API on top of an inherently
+        # async library, so we need to block this thread until the
+        # callback gets called to give us the response to return.
+        self._done.wait(LOGIN_TIMEOUT)
         if self._error is not None:
             exception = AuthorizationError(self.account_id, self._error.message)
             # Mardy says this error can happen during normal operation.
@@ -94,4 +97,46 @@ class Authentication:
         if error:
             self._error = error
         self._reply = reply
+        self._done.set()
         log.debug('_login_cb completed')
+
+
+class TokenCache(JsonCache):
+    """Persist an account's access token and when it expires.
+
+    These are secrets, so the file is only readable by its owner, and
+    writes are serialized since logins happen in several threads.
+    """
+    _lock = threading.Lock()
+
+    def write(self):
+        """Write our dict contents to disk, readable only by us."""
+        with self._lock:
+            fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            os.fchmod(fd, 0o600)
+            with open(fd, 'w') as cache:
+                cache.write(jsoncodec.dumps(self))
+
+    def remove(self):
+        """Forget the token, and delete its file."""
+        with self._lock:
+            self.clear()
+            with ignored(FileNotFoundError):
+                os.remove(self._path)
+
+    @classmethod
+    def prune(cls, account_ids):
+        """Delete the saved tokens of accounts that are gone.
+
+        :param account_ids: The ids of the accounts that we still have.
+        :type account_ids: iterable
+        """
+        keep = {cls._root.format('token-{}'.format(account_id))
+                for account_id in account_ids}
+        with cls._lock:
+            for path in glob.glob(cls._root.format('token-*')):
+                if path not in keep:
+                    log.debug('Removing stale token {}'.format(path))
+                    with ignored(FileNotFoundError):
+                        os.remove(path)
@@ -13,64 +13,539 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Utils for downloading, sizing, and caching of avatar images."""
+"""Utils for downloading, sizing, and caching of avatar images.
+
+Avatars live under the user's cache directory, where they survive
+reboots, but they are only allowed to take up Avatar.budget bytes of
+it.  An index file next to the avatars records how big each one is,
+a checksum of its contents, and which were used least recently, so
+that none of that requires walking the directory.
+"""
 
 __all__ = [
     'Avatar',
+    'AvatarIndex',
+    'PixbufCache',
     ]
 
 
 import os
+import zlib
 import logging
+import threading
 
-from gi.repository import Gio, GLib, GdkPixbuf
-from tempfile import gettempdir
+from gi.repository import Gio, GLib
 from hashlib import sha1
 
+from friends.utils import jsoncodec
 from friends.utils.http import Downloader
+from friends.utils.lazy import LazyRepository
 from friends.errors import ignored
 
 
-CACHE_DIR = os.path.join(gettempdir(), 'friends-avatars')
+# Only needed when we actually have to scale a freshly downloaded avatar.
+GdkPixbuf = LazyRepository('GdkPixbuf', '2.0')
+
+
+CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), 'friends', 'avatars')
+
+# How many bytes of avatars to keep on disk, unless gsettings says
+# otherwise.
+CACHE_BUDGET = 32 * 1024 * 1024
+
+# How many pixels of scaled avatars to keep decoded in memory.  That
+# is enough for 256 of the 48px avatars that notifications show.
+PIXBUF_BUDGET = 256 * 48 * 48
 
+# How many avatars to download at once in the background.
+FETCH_WORKERS = 4
 
-with ignored(FileExistsError):
-    os.makedirs(CACHE_DIR)
+# How many seconds to wait for another thread's download of an avatar.
+DOWNLOAD_WAIT = 60
+
+# Files are written under this suffix, then renamed into place, so
+# that a crash can't leave a half-written avatar behind.
+PARTIAL = '.part'
 
 
 log = logging.getLogger(__name__)
 
 
+def _checksum(path):
+    """Return the CRC-32 of a file's contents."""
+    with open(path, 'rb') as fd:
+        return zlib.crc32(fd.read())
+
+
+class AvatarIndex:
+    """Keep track of the avatars stored in one directory.
+
+    Each entry maps the name of an original image to its size and
+    checksum, and to the sizes of the files derived from it, such as
+    the '.100px' thumbnail.  Entries are kept in least recently used
+    order, so the first ones are evicted when the budget is exceeded.
+
+    The index is written whenever avatars are added or removed.  Hits
+    only reorder it, so that is written by persist().
+    """
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self._path = os.path.join(
+            os.path.dirname(directory), 'avatar-index.json')
+        self._entries = {}
+        # Checksums are only verified on the first hit of each session.
+        self._verified = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_downloaded = 0
+        try:
+            with open(self._path, 'rb') as fd:
+                entries = jsoncodec.loads(fd.read())
+            self.total = sum(
+                self._size(entry) for entry in entries.values())
+            self._entries.update(entries)
+        except (FileNotFoundError, ValueError, UnicodeDecodeError,
+                AttributeError, KeyError, TypeError):
+            self._rebuild()
+            self.total = sum(
+                self._size(entry) for entry in self._entries.values())
+
+    @staticmethod
+    def _size(entry):
+        return entry['size'] + sum(entry['files'].values())
+
+    def _rebuild(self):
+        """Index whatever is in the directory, oldest first.
+
+        This only happens when the index is missing or unreadable.
+        """
+        originals, derived = [], {}
+        with ignored(FileNotFoundError):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                key, dot, suffix = name.partition('.')
+                if name.endswith(PARTIAL) or stat.st_size == 0:
+                    os.remove(path)
+                elif dot:
+                    derived.setdefault(key, {})['.' + suffix] = stat.st_size
+                else:
+                    originals.append((stat.st_mtime, key, stat.st_size))
+        for mtime, key, size in sorted(originals):
+            self._entries[key] = dict(
+                size=size,
+                crc=_checksum(os.path.join(self.directory, key)),
+                files=derived.pop(key, {}),
+                )
+        # Derived files without an original are of no use to anyone.
+        for key, files in derived.items():
+            for suffix in files:
+                with ignored(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, key + suffix))
+        self._dirty = True
+        log.debug('Rebuilt avatar index with {} entries.'.format(
+            len(self._entries)))
+
+    def _remove(self, key):
+        """Forget about an avatar and delete its files."""
+        entry = self._entries.pop(key)
+        self._verified.discard(key)
+        self.total -= self._size(entry)
+        for suffix in [''] + list(entry['files']):
+            with ignored(FileNotFoundError):
+                os.remove(os.path.join(self.directory, key + suffix))
+
+    def lookup(self, key, count=True):
+        """Return True if a complete, undamaged copy of key is stored.
+
+        :param count: Whether to count this lookup as a hit or a miss.
+            Prefetching checks the cache too, but nobody is waiting for
+            the answer, so that shouldn't affect the hit rate.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                path = os.path.join(self.directory, key)
+                try:
+                    intact = (os.stat(path).st_size == entry['size'] and (
+                        key in self._verified or
+                        _checksum(path) == entry['crc']))
+                except FileNotFoundError:
+                    intact = False
+                if intact:
+                    self._verified.add(key)
+                    # Dicts keep their insertion order, so this makes it
+                    # the most recently used avatar.
+                    self._entries[key] = self._entries.pop(key)
+                    self._dirty = True
+                    self.hits += count
+                    return True
+                log.info('Discarding damaged avatar: {}'.format(path))
+                self._remove(key)
+                self._write()
+            self.misses += count
+            return False
+
+    def add(self, key, data, files=None):
+        """Record a newly stored avatar, then trim back to the budget.
+
+        :param key: The file name of the original image.
+        :param data: The contents of the original image.
+        :param files: A dict mapping the suffix of each file derived
+            from the original to its size in bytes.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            entry = dict(size=len(data), crc=zlib.crc32(data),
+                         files=files or {})
+            self._entries[key] = entry
+            self._verified.add(key)
+            self.total += self._size(entry)
+            self.bytes_downloaded += len(data)
+            self._trim()
+            self._write()
+
+    def get_file(self, key, suffix):
+        """Return the size of a file derived from key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry['files'].get(suffix)
+
+    def add_file(self, key, suffix, size):
+        """Record a file derived from key, then trim back to the budget."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.total += size - entry['files'].get(suffix, 0)
+            entry['files'][suffix] = size
+            self._trim()
+            self._write()
+
+    def _trim(self):
+        # The newest avatar is the one that was just asked for, so never
+        # evict that.
+        while self.total > self.budget and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _write(self):
+        temp_path = self._path + PARTIAL
+        with open(temp_path, 'w') as fd:
+            fd.write(jsoncodec.dumps(self._entries, compact=True))
+        os.rename(temp_path, self._path)
+        self._dirty = False
+
+    def persist(self):
+        """Save the least recently used order, if it has changed."""
+        with self._lock:
+            if self._dirty:
+                self._write()
+
+    def stats(self):
+        """Return how well the cache is doing, for tuning the budget."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                entries=len(self._entries),
+                bytes=self.total,
+                budget=self.budget,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                evictions=self.evictions,
+                bytes_downloaded=self.bytes_downloaded,
+                )
+
+
+class PixbufCache:
+    """Keep the most recently used scaled avatars decoded in memory.
+
+    The same sender often turns up several times in one refresh, and
+    this saves reading and decoding their avatar every time.  Instead
+    of counting entries, the cache is limited to budget pixels, so
+    that it holds fewer avatars if they are bigger.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+        self._pixbufs = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, size):
+        """Return the pixbuf of url's avatar at size, or None."""
+        key = (url, size)
+        with self._lock:
+            pixbuf = self._pixbufs.pop(key, None)
+            if pixbuf is not None:
+                # Put it back as the most recently used.
+                self._pixbufs[key] = pixbuf
+                self.hits += 1
+                return pixbuf
+            self.misses += 1
+        path = Avatar.get_cached(url, size=size)
+        if not path:
+            return None
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+        except GLib.GError:
+            log.error('Failed to load image: {}'.format(path))
+            return None
+        with self._lock:
+            if key not in self._pixbufs:
+                self._pixbufs[key] = pixbuf
+                self.pixels += pixbuf.get_width() * pixbuf.get_height()
+            while self.pixels > self.budget and len(self._pixbufs) > 1:
+                oldest = self._pixbufs.pop(next(iter(self._pixbufs)))
+                self.pixels -= oldest.get_width() * oldest.get_height()
+        return pixbuf
+
+    def clear(self):
+        """Forget all the pixbufs, to save memory while idle."""
+        with self._lock:
+            self._pixbufs.clear()
+            self.pixels = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                pixbufs=len(self._pixbufs),
+                pixbuf_pixels=self.pixels,
+                pixbuf_hits=self.hits,
+                pixbuf_misses=self.misses,
+                )
+
+
+
 class Avatar:
+    """Download, scale and cache avatars.
+
+    get_image() returns the path of an avatar, downloading it first if
+    it isn't cached.  get_cached() never waits for the network.  It
+    returns the path of the cached avatar if there is one, and
+    otherwise queues it for download and returns a placeholder.
+    prefetch() only queues.  Queued avatars are downloaded by up to
+    FETCH_WORKERS threads, which exit once the queue is empty.  Each
+    URL is downloaded by only one thread at a time, and any other
+    thread that wants it waits for that download instead.
+    """
+    # Set from gsettings by friends-dispatcher.
+    budget = CACHE_BUDGET
+    prefetching = False
+
+    _index = None
+    _index_lock = threading.Lock()
+
+    pixbufs = PixbufCache(PIXBUF_BUDGET)
+
+    # URLs being downloaded, each mapped to an Event that is set when
+    # its download is finished, and URLs waiting for a worker.
+    _downloads = {}
+    _queued = {}
+    _workers = 0
+    _lock = threading.Lock()
+
+    # How many fetch workers are running.  ManageTimers leaves these
+    # out when it waits for every other thread to finish.
+    running = 0
+
     @staticmethod
     def get_path(url):
         return os.path.join(CACHE_DIR, sha1(url.encode('utf-8')).hexdigest())
 
+    @staticmethod
+    def get_index():
+        """Return the index of CACHE_DIR, loading it on first use."""
+        with Avatar._index_lock:
+            if Avatar._index is None or Avatar._index.directory != CACHE_DIR:
+                with ignored(FileExistsError):
+                    os.makedirs(CACHE_DIR)
+                Avatar._index = AvatarIndex(CACHE_DIR, Avatar.budget)
+            return Avatar._index
+
+    @staticmethod
+    def persist():
+        """Save the avatar index, if it has been loaded."""
+        if Avatar._index is not None:
+            Avatar._index.persist()
+
+    @staticmethod
+    def stats():
+        stats = Avatar.get_index().stats()
+        stats.update(Avatar.pixbufs.stats())
+        with Avatar._lock:
+            stats.update(downloading=len(Avatar._downloads),
+                         queued=len(Avatar._queued))
+        return stats
+
     @staticmethod
     def get_image(url):
+        """Return the path of url's avatar, downloading it if need be.
+
+        If another thread is already downloading it and that takes more
+        than DOWNLOAD_WAIT seconds, return an empty string instead.
+        """
         if not url:
             return url
         local_path = Avatar.get_path(url)
-        size = 0
+        if not Avatar.get_index().lookup(os.path.basename(local_path)):
+            if not Avatar._download(url):
+                return ''
+        return local_path
 
-        with ignored(FileNotFoundError):
-            size = os.stat(local_path).st_size
+    @staticmethod
+    def get_cached(url, placeholder='', size=None):
+        """Return the path of url's avatar if it is cached.
+
+        Otherwise, queue it to be downloaded, and return placeholder.
+
+        :param size: If given, return the path of a copy of the avatar
+            that is scaled down to fit a square of this many pixels.
+        :type size: int
+        """
+        if not url:
+            return placeholder
+        local_path = Avatar.get_path(url)
+        if Avatar.get_index().lookup(os.path.basename(local_path)):
+            if size is None:
+                return local_path
+            return Avatar._derive(local_path, size) or placeholder
+        Avatar._enqueue(url)
+        return placeholder
+
+    @staticmethod
+    def get_pixbuf(url, size):
+        """Return url's avatar as a GdkPixbuf that fits size.
 
-        if size == 0:
-            log.debug('Getting: {}'.format(url))
-            image_data = Downloader(url).get_bytes()
+        Like get_cached(), this never waits for a download, and returns
+        None instead if the avatar isn't cached yet.
+        """
+        if not url:
+            return None
+        return Avatar.pixbufs.get(url, size)
 
-            # Save original size at canonical URI
-            with open(local_path, 'wb') as fd:
-                fd.write(image_data)
+    @staticmethod
+    def prefetch(url):
+        """Download url's avatar in the background, if it isn't cached."""
+        if url and Avatar.prefetching:
+            Avatar._enqueue(url)
+
+    @staticmethod
+    def _enqueue(url):
+        with Avatar._lock:
+            if url in Avatar._downloads or url in Avatar._queued:
+                return
+            Avatar._queued[url] = None
+            if Avatar._workers < FETCH_WORKERS:
+                Avatar._workers += 1
+                threading.Thread(name='Avatar fetcher', target=Avatar._work,
+                                 daemon=True).start()
 
-            # Append '.100px' to filename and scale image there.
-            input_stream = Gio.MemoryInputStream.new_from_data(
-                image_data, None)
+    @staticmethod
+    def _work():
+        """Download queued avatars until there are none left."""
+        with Avatar._lock:
+            Avatar.running += 1
+        while True:
+            with Avatar._lock:
+                if not Avatar._queued:
+                    Avatar._workers -= 1
+                    Avatar.running -= 1
+                    return
+                url = next(iter(Avatar._queued))
+                del Avatar._queued[url]
+            key = os.path.basename(Avatar.get_path(url))
             try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_stream_at_scale(
-                    input_stream, 100, 100, True, None)
-                pixbuf.savev(local_path + '.100px', 'png', [], [])
-            except GLib.GError:
-                log.error('Failed to scale image: {}'.format(url))
-        return local_path
+                if not Avatar.get_index().lookup(key, count=False):
+                    Avatar._download(url)
+            except Exception as error:
+                log.error('Failed to fetch avatar {}: {}'.format(url, error))
+
+    @staticmethod
+    def _download(url):
+        """Download url, or wait for the thread that already is.
+
+        :return: False if we gave up waiting for the other thread.
+        """
+        with Avatar._lock:
+            done = Avatar._downloads.get(url)
+            if done is None:
+                done = Avatar._downloads[url] = threading.Event()
+                waiting = False
+            else:
+                waiting = True
+        if waiting:
+            if not done.wait(DOWNLOAD_WAIT):
+                log.error('Gave up waiting for avatar {}'.format(url))
+                return False
+            return True
+        try:
+            # Somebody else may have finished it since we looked.
+            local_path = Avatar.get_path(url)
+            if not Avatar.get_index().lookup(
+                    os.path.basename(local_path), count=False):
+                Avatar._store(url, local_path)
+        finally:
+            with Avatar._lock:
+                del Avatar._downloads[url]
+            done.set()
+        return True
+
+    @staticmethod
+    def _store(url, local_path):
+        log.debug('Getting: {}'.format(url))
+        image_data = Downloader(url).get_bytes()
+
+        # Save original size at canonical URI
+        with open(local_path + PARTIAL, 'wb') as fd:
+            fd.write(image_data)
+        os.rename(local_path + PARTIAL, local_path)
+
+        # Append '.100px' to filename and scale image there.
+        files = {}
+        input_stream = Gio.MemoryInputStream.new_from_data(image_data, None)
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+                input_stream, 100, 100, True, None)
+            Avatar._save(pixbuf, local_path + '.100px')
+            files['.100px'] = os.stat(local_path + '.100px').st_size
+        except GLib.GError:
+            log.error('Failed to scale image: {}'.format(url))
+        Avatar.get_index().add(os.path.basename(local_path), image_data, files)
+
+    @staticmethod
+    def _derive(local_path, size):
+        """Return the path of a copy of an avatar scaled to fit size.
+
+        Each size is only scaled once, and then kept next to the
+        original until that is evicted.
+        """
+        key = os.path.basename(local_path)
+        suffix = '.{}px'.format(size)
+        path = local_path + suffix
+        index = Avatar.get_index()
+        if index.get_file(key, suffix) is not None and os.path.exists(path):
+            return path
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                local_path, size, size, True)
+        except GLib.GError:
+            log.error('Failed to scale image: {}'.format(local_path))
+            return None
+        Avatar._save(pixbuf, path)
+        index.add_file(key, suffix, os.stat(path).st_size)
+        return path
+
+    @staticmethod
+    def _save(pixbuf, path):
+        pixbuf.savev(path + PARTIAL, 'png', [], [])
+        os.rename(path + PARTIAL, path)
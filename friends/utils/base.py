@@ -20,32 +20,40 @@ __all__ = [
     'Base',
     'feature',
     'initialize_caches',
+    'persist_caches',
+    'persist_snapshot',
+    'prune_into_snapshot',
     ]
 
 
+import os
 import re
 import time
 import logging
+import itertools
 import threading
-import gi
 
-gi.require_version('EDataServer', '1.2')
-gi.require_version('EBook', '1.2')
+from collections import deque
 from datetime import datetime, timedelta
 from oauthlib.oauth1 import Client
 
-from gi.repository import GLib, GObject, EDataServer, EBook, EBookContacts
-
-from friends.errors import FriendsError, ContactsError, ignored
-from friends.utils.authentication import Authentication
-from friends.utils.model import Schema, Model, persist_model
-from friends.utils.notify import notify
+from gi.repository import GLib, GObject
+
+from friends.errors import AuthorizationError, ContactsError, FriendsError
+from friends.errors import ignored
+from friends.utils import jsoncodec
+from friends.utils.authentication import Authentication, TokenCache
+from friends.utils.avatar import Avatar
+from friends.utils.cache import JsonCache, MarkCache
+from friends.utils.lazy import LazyRepository
+from friends.utils.model import Schema, Model, persist_model, prune_model
+from friends.utils.notify import queue_notification
+from friends.utils.snapshot import SnapshotReader, write_snapshot
 from friends.utils.time import ISO8601_FORMAT
 
 
 FIVE_DAYS_AGO = (datetime.now() - timedelta(5)).isoformat()
 STUB = lambda *ignore, **kwignore: None
-COMMA_SPACE = ', '
 SCHEMA = Schema()
 AVATAR_IDX = SCHEMA.INDICES['icon_uri']
 FROM_ME_IDX = SCHEMA.INDICES['from_me']
@@ -56,6 +64,25 @@ ID_IDX = SCHEMA.INDICES['message_id']
 ACCT_IDX = SCHEMA.INDICES['account_id']
 TIME_IDX = SCHEMA.INDICES['timestamp']
 
+# These are only needed for contact syncing, so don't load them until then.
+EDataServer = LazyRepository('EDataServer', '1.2')
+EBook = LazyRepository('EBook', '1.2')
+EBookContacts = LazyRepository('EBookContacts', '1.2')
+
+# Snapshot of the _seen_ids index, written alongside the persisted
+# Dee.SharedModel when the dispatcher shuts down.
+INDEX_PATH = os.path.join(
+    GLib.get_user_cache_dir(), 'friends', 'model-index.json')
+
+# Columnar snapshot of the model, for readers that mmap() it; see
+# friends/utils/snapshot.py.
+SNAPSHOT_PATH = os.path.join(
+    GLib.get_user_cache_dir(), 'friends', 'model-snapshot.bin')
+
+# The snapshot isn't sent over D-Bus, so it keeps the rows that are
+# pruned from the model, up to this many rows altogether.
+SNAPSHOT_ROWS = 20000
+
 # See friends/tests/test_protocols.py for further documentation
 LINKIFY_REGEX = re.compile(
     r"""
@@ -90,11 +117,35 @@ LINKIFY_REGEX = re.compile(
 # published multiple times by mistake.
 _seen_ids = {}
 
+# The model sequence number that the snapshot on disk was taken at.
+_snapshot_version = None
+
+# Rows that this run pruned from the model, oldest first, until the
+# next snapshot has them.
+_pruned_rows = []
+
 
-# Protocol __call__() methods run in threads, so we need to serialize
-# publishing new data into the SharedModel.
+# Held by friends-dispatcher until the SharedModel is synchronized, and
+# by whatever is changing the model after that.
 _publish_lock = threading.Lock()
 
+# Makes sure that each protocol loads its marks only once.
+_marks_lock = threading.Lock()
+
+# How long a protocol thread waits for its rows to be published, before
+# giving up on the main loop.
+PUBLISH_TIMEOUT = 60
+
+# How much of a protocol's hourly rate limit the poll scheduler may use.
+POLL_SHARE = 0.5
+
+
+# Log in again this many seconds before an access token expires, so that
+# nobody has to wait for the new one.
+TOKEN_REFRESH_MARGIN = 300
+# Saved tokens that don't have an expiry time are only trusted this long.
+TOKEN_LIFETIME = 86400
+
 
 log = logging.getLogger(__name__)
 
@@ -123,12 +174,145 @@ def initialize_caches():
     Our Dee.SharedModel persists across instances, so we need to
     populate this cache at launch.
     """
+    start = time.time()
     # Don't create a new dict; we need to keep the same dict object in
     # memory since it gets imported into a few different places that
     # would not get the updated reference to the new dict.
     _seen_ids.clear()
-    _seen_ids.update({row[ID_IDX]: i for i, row in enumerate(Model)})
-    log.debug('_seen_ids: {}'.format(len(_seen_ids)))
+    ids = _load_index()
+    source = 'index'
+    if ids is None:
+        ids = [row[ID_IDX] for row in Model]
+        source = 'model'
+    _seen_ids.update({message_id: i for i, message_id in enumerate(ids)})
+    log.debug('_seen_ids: {} from {} in {:.3f}s'.format(
+        len(_seen_ids), source, time.time() - start))
+
+
+def _load_index():
+    """Return the message_ids from the index snapshot, in row order.
+
+    The snapshot is only trusted if the model has not changed since it
+    was taken, apart from prune_model() removing the oldest rows, and
+    it agrees with the model about the first and last message_ids.
+    Otherwise None is returned and the caller has to scan the model.
+    """
+    try:
+        with open(INDEX_PATH, 'rb') as cache:
+            index = jsoncodec.loads(cache.read())
+        seqnum = index['seqnum']
+        ids = index['ids']
+    except (FileNotFoundError, ValueError, UnicodeDecodeError,
+            KeyError, TypeError):
+        return None
+    n_rows = Model.get_n_rows()
+    # Every change to the model bumps its seqnum by one, so rows that
+    # were pruned since the snapshot account for the difference.
+    pruned = len(ids) - n_rows
+    if pruned < 0 or seqnum + pruned != Model.get_seqnum():
+        log.debug('Model index is stale, rescanning the model.')
+        return None
+    ids = ids[pruned:]
+    if n_rows and (ids[0] != Model.get_row(0)[ID_IDX] or
+                   ids[-1] != Model.get_row(n_rows - 1)[ID_IDX]):
+        log.debug('Model index disagrees with model, rescanning.')
+        return None
+    return ids
+
+
+def persist_caches():
+    """Write a snapshot of the model index to disk.
+
+    This records the message_id, stream and timestamp of every row,
+    along with the model sequence number, so that the next launch of
+    the dispatcher can rebuild _seen_ids without walking the model.
+    """
+    if not Model.is_synchronized():
+        return
+    ids, streams, timestamps = [], [], []
+    for row in Model:
+        ids.append(row[ID_IDX])
+        streams.append(row[STREAM_IDX])
+        timestamps.append(row[TIME_IDX])
+    index = dict(
+        seqnum=Model.get_seqnum(),
+        ids=ids,
+        streams=streams,
+        timestamps=timestamps,
+        )
+    temp_path = INDEX_PATH + '.new'
+    with ignored(FileExistsError):
+        os.makedirs(os.path.dirname(INDEX_PATH))
+    with open(temp_path, 'w') as cache:
+        cache.write(jsoncodec.dumps(index, compact=True))
+    os.rename(temp_path, INDEX_PATH)
+    log.debug('Saved model index with {} rows.'.format(len(ids)))
+
+
+def prune_into_snapshot(maximum):
+    """Prune the model to maximum rows, but keep the rest snapshotted.
+
+    The pruned rows are held on to until persist_snapshot() has written
+    them out.  The rows that earlier runs pruned stay on disk.
+    """
+    _pruned_rows.extend(prune_model(maximum))
+
+
+def _archived_rows(ids, keep):
+    """Return up to keep of the newest rows that are not in the model.
+
+    Those are the rows in the snapshot on disk that have been pruned
+    since, followed by any that were pruned before they got into it.
+    The snapshot is only read now, a column at a time, and just the
+    rows that are kept get decoded.
+    """
+    if keep <= 0:
+        return []
+    rows = []
+    try:
+        with SnapshotReader(SNAPSHOT_PATH) as snapshot:
+            if snapshot.columns == SCHEMA.NAMES:
+                columns = [snapshot.column(name) for name in SCHEMA.NAMES]
+                wanted = [i for i, message_id in enumerate(columns[ID_IDX])
+                          if message_id not in ids]
+                rows = [tuple(column[i] for column in columns)
+                        for i in wanted[-keep:]]
+    except (OSError, ValueError) as error:
+        log.info('Not restoring pruned rows: {}'.format(error))
+    archived = {row[ID_IDX] for row in rows}
+    rows.extend(row for row in _pruned_rows
+                if row[ID_IDX] not in archived and row[ID_IDX] not in ids)
+    return rows[-keep:]
+
+
+def persist_snapshot():
+    """Write a snapshot of the model, unless the last one is current.
+
+    The snapshot has the rows that have been pruned from the model,
+    followed by the model's rows, but no more than SNAPSHOT_ROWS
+    altogether.
+
+    :return: The snapshot's version, which is the model's sequence
+        number, or None if the model is not synchronized yet.
+    """
+    global _snapshot_version
+    if not Model.is_synchronized():
+        return None
+    version = Model.get_seqnum()
+    if version != _snapshot_version or not os.path.exists(SNAPSHOT_PATH):
+        start = time.time()
+        model_rows = list(Model)
+        archived = _archived_rows(
+            {row[ID_IDX] for row in model_rows},
+            SNAPSHOT_ROWS - len(model_rows))
+        rows = archived + model_rows
+        write_snapshot(SNAPSHOT_PATH, SCHEMA.COLUMNS, rows, version)
+        _snapshot_version = version
+        # They're on disk now, and get read back from there next time.
+        del _pruned_rows[:]
+        log.debug('Saved model snapshot with {} rows in {:.3f}s.'.format(
+            len(rows), time.time() - start))
+    return version
 
 
 def linkify_string(string):
@@ -136,13 +320,169 @@ def linkify_string(string):
     return LINKIFY_REGEX(r'<a href="\1">\1</a>', string)
 
 
+class _PublishQueue:
+    """Make every change to the SharedModel from the main loop.
+
+    Dee.SharedModel is a GObject, and isn't thread-safe, so protocol
+    threads don't touch it.  They append their changes to a deque,
+    which needs no lock, and wait while an idle handler on the main
+    loop applies up to BATCH_SIZE of them at a time, from all threads.
+    Changes made on the main thread itself are simply applied right
+    away, unless the model isn't synchronized yet.
+    """
+    # Small enough that the main loop stays responsive while a big
+    # refresh is being published.
+    BATCH_SIZE = 100
+
+    def __init__(self):
+        self._changes = deque()
+        # Only guards whether the idle handler is scheduled.
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def call(self, function, *args):
+        """Call function(*args) from the main loop, and return its result.
+
+        The calling thread waits for the change to be applied, and
+        anything that function raises is raised again here, so that
+        protocols see the same errors they would if they had made the
+        change themselves.
+
+        The main thread can't wait for itself, so while friends-dispatcher
+        is still holding _publish_lock at startup, its changes are queued
+        for when the model is synchronized, and None is returned.
+
+        :raises: FriendsError if the main loop doesn't get to the
+            change within PUBLISH_TIMEOUT seconds.  The change is then
+            dropped, rather than being applied behind the caller's back.
+        """
+        if threading.current_thread() is threading.main_thread():
+            if not _publish_lock.acquire(blocking=False):
+                self._changes.append(_Change(function, args))
+                return None
+            try:
+                return function(*args)
+            finally:
+                _publish_lock.release()
+        change = _Change(function, args)
+        self._changes.append(change)
+        self.schedule()
+        if not change.done.wait(PUBLISH_TIMEOUT):
+            if change.cancel():
+                raise FriendsError(
+                    'Gave up waiting for the main loop to publish.')
+            # Too late, it's being applied already.
+            change.done.wait()
+        if change.error is not None:
+            raise change.error
+        return change.result
+
+    def schedule(self):
+        """Make sure the idle handler runs if there are any changes."""
+        with self._lock:
+            if self._scheduled or not self._changes:
+                return
+            self._scheduled = True
+        GLib.idle_add(self._drain)
+
+    def _drain(self):
+        # friends-dispatcher calls schedule() again once the model is
+        # synchronized.
+        if not _publish_lock.acquire(blocking=False):
+            with self._lock:
+                self._scheduled = False
+            return False
+        try:
+            for i in range(self.BATCH_SIZE):
+                try:
+                    change = self._changes.popleft()
+                except IndexError:
+                    break
+                if not change.cancelled:
+                    change.apply()
+        finally:
+            _publish_lock.release()
+        with self._lock:
+            self._scheduled = bool(self._changes)
+            return self._scheduled
+
+
+class _Change:
+    """One change queued by _PublishQueue.call(), and its outcome."""
+
+    # Decides between apply() and cancel(), for every change.
+    _lock = threading.Lock()
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def cancel(self):
+        """Drop the change, unless it is already being applied.
+
+        :return: Whether it was dropped.
+        """
+        with self._lock:
+            self.cancelled = not self.started
+            return self.cancelled
+
+    def apply(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            self.result = self.function(*self.args)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done.set()
+
+
+_publish_queue = _PublishQueue()
+
+
 class _OperationThread(threading.Thread):
     """Manage async callbacks, and log subthread exceptions."""
 
-    def __init__(self, *args, id=None, success=STUB, failure=STUB, **kws):
+    # How many new rows this operation has added to the model so far,
+    # how many it threw away as duplicates, and how many bytes it has
+    # downloaded.  Callbacks run in this same thread, so they can read
+    # these too.
+    new_rows = 0
+    duplicate_rows = 0
+    bytes_downloaded = 0
+
+    # How many responses this operation has downloaded, and how many
+    # contacts it has pushed to the address book.
+    pages = 0
+    contacts = 0
+
+    # Called with each operation's id, its state ('started', 'progress',
+    # 'completed' or 'failed') and its counts as it goes along.  The
+    # dispatcher turns these into D-Bus signals.
+    reporter = STUB
+
+    # Report progress at most once this many seconds, per operation.
+    REPORT_INTERVAL = 1
+
+    _serial = itertools.count(1)
+
+    def __init__(self, *args, id=None, success=STUB, failure=STUB,
+                 quiet=False, **kws):
         self._id = id
         self._success_callback = success
         self._failure_callback = failure
+        # Threads that only do part of another operation's work don't
+        # report on themselves.
+        self._quiet = quiet
+        self._reported = 0
+        self.operation_id = '{}.{}'.format(id, next(self._serial))
 
         # Wrap the real target inside retval_catcher
         method = kws.get('target')
@@ -153,11 +493,31 @@ class _OperationThread(threading.Thread):
 
     def _retval_catcher(self, func, *args, **kwargs):
         """Call the success callback, but only if no exceptions were raised."""
-        self._success_callback(str(func(*args, **kwargs)))
+        result = func(*args, **kwargs)
+        self._success_callback(str(result))
+
+    def counts(self):
+        """Return how much this operation has done so far."""
+        return dict(pages=self.pages, new_rows=self.new_rows,
+                    contacts=self.contacts)
+
+    def progress(self):
+        """Report the counts, unless that was done very recently."""
+        now = time.monotonic()
+        if self._quiet or now - self._reported < self.REPORT_INTERVAL:
+            return
+        self._reported = now
+        self._report('progress')
+
+    def _report(self, state):
+        if not self._quiet:
+            _OperationThread.reporter(self.operation_id, state, self.counts())
 
     def run(self):
         log.debug('{} is starting in a new thread.'.format(self._id))
         start = time.time()
+        self._reported = time.monotonic()
+        self._report('started')
         try:
             super().run()
         except Exception as err:
@@ -165,6 +525,9 @@ class _OperationThread(threading.Thread):
             # operation to avoid triggering the success callback.
             self._failure_callback(str(err))
             log.exception(err)
+            self._report('failed')
+        else:
+            self._report('completed')
         elapsed = time.time() - start
         log.debug('{} has completed in {:.2f}s, thread exiting.'.format(
                 self._id, elapsed))
@@ -195,10 +558,33 @@ class Base:
     _eds_source_registry = None
     _eds_source = None
 
+    # Lazily populated when an access token is needed.
+    _token_cache = None
+
+    # The GLib timeout that refreshes the access token before it expires.
+    _refresh_timer = None
+
+    # Lazily populated when a high-water mark is first needed.
+    _marks = None
+
     # This number serves a guideline (not a hard limit) for the protocol
     # subclasses to download in each refresh.
     _DOWNLOAD_LIMIT = 50
 
+    # The operations that the dispatcher's poll scheduler runs, each on
+    # its own schedule.  Together these should fetch everything that
+    # receive() does.
+    _POLL_STREAMS = ('receive',)
+
+    # How many requests each account may make in an hour, for protocols
+    # that document a rate limit.  The poll scheduler keeps to its share
+    # of that; see _poll_floor().
+    _HOURLY_LIMIT = None
+
+    # The error codes with which the protocol's API refuses an access
+    # token that is no longer valid; see _is_error().
+    _AUTH_ERROR_CODES = frozenset()
+
     # Default to not notify any messages. This gets overridden from main.py,
     # which is the only place we can safely access gsettings from.
     _do_notify = lambda protocol, stream: False
@@ -275,6 +661,94 @@ class Base:
             '{} protocol has no receive() method.'.format(
                 self._Name))
 
+    def _get_mark(self, stream='messages'):
+        """Return the newest position we have fetched a stream up to.
+
+        Protocols pass this back to the server, so that it only sends
+        what is newer, instead of the whole recent window all over
+        again.  What the mark actually is (an id, a timestamp) depends
+        on the protocol.
+
+        :return: The value last given to _set_mark(), or None.
+        """
+        return self._get_marks().get(stream)
+
+    def _set_mark(self, value, stream='messages'):
+        """Remember the newest position in a stream that we have fetched.
+
+        Marks only move forwards, so a value that is older than the
+        stream's mark is ignored.  Only call this once everything up to
+        value has been published.
+        """
+        self._get_marks()[stream] = value
+
+    def _get_marks(self):
+        """Return this account's MarkCache, loading it on first use."""
+        with _marks_lock:
+            if self._marks is None:
+                self._marks = MarkCache(
+                    'marks-{}'.format(self._account.id), self._convert_mark)
+                self._adopt_old_marks()
+            return self._marks
+
+    def _adopt_old_marks(self):
+        """Take over the marks that older versions kept, then delete them.
+
+        Twitter, Identi.ca and Facebook used to keep theirs in one file
+        per protocol, such as twitter_ids.json, which all of its accounts
+        shared.  The first of those accounts to load its marks starts out
+        from them, rather than fetching every stream's recent window again.
+        """
+        name = '{}_ids'.format(self._name)
+        path = JsonCache._root.format(name)
+        if not os.path.exists(path):
+            return
+        if not self._marks:
+            for stream, value in JsonCache(name).items():
+                with ignored(TypeError, ValueError):
+                    self._marks[stream] = value
+        log.debug('Removing old marks file {}'.format(path))
+        with ignored(FileNotFoundError):
+            os.remove(path)
+
+    def _convert_mark(self, value):
+        """Turn a mark into something that sorts in stream order.
+
+        The default suits timestamps, in seconds or as ISO 8601 strings.
+        """
+        return value
+
+    def _start_stream(self):
+        """Start receiving new messages as soon as they are posted.
+
+        Protocols whose service can push messages down a long-lived
+        connection override this, and return True once they are keeping
+        that connection open.  Everything else just keeps being polled.
+        """
+        return False
+
+    def _stop_stream(self):
+        """Close the connection that _start_stream() opened, if any."""
+
+    def _poll_floor(self, stream, requests=1):
+        """Return the fewest seconds allowed between polls of a stream.
+
+        By default, all of the streams together get POLL_SHARE of the
+        protocol's _HOURLY_LIMIT, leaving the rest for whatever the user
+        does.  Protocols that know their remaining rate limit budget
+        should override this so that the poll scheduler doesn't spend
+        it all.
+
+        :param stream: One of the operations in _POLL_STREAMS.
+        :type stream: string
+        :param requests: How many requests the last poll made.
+        :type requests: int
+        """
+        if not self._HOURLY_LIMIT:
+            return 0
+        per_stream = self._HOURLY_LIMIT * POLL_SHARE / len(self._POLL_STREAMS)
+        return 3600 * max(requests, 1) / per_stream
+
     def __call__(self, operation, *args, success=STUB, failure=STUB, **kwargs):
         """Call an operation, i.e. a method, with arguments in a sub-thread.
 
@@ -299,23 +773,65 @@ class Base:
         :param failure: A callback to invoke in the event of an exception being
             raised in the sub-thread.
         :type failure: callable
-        :return: None
+        :return: The operation id that the thread reports with.
+        :rtype: str
         """
         if operation.startswith('_') or not hasattr(self, operation):
             raise NotImplementedError(operation)
         method = getattr(self, operation)
-        _OperationThread(
+        thread = _OperationThread(
             id='{}.{}'.format(self._Name, operation),
             target=method,
             success=success,
             failure=failure,
             args=args,
             kwargs=kwargs,
+            )
+        thread.start()
+        return thread.operation_id
+
+    def _batch(self, operations, callback):
+        """Call several operations in turn, in a single sub-thread.
+
+        They all share one login and one rate limiter, just as if they
+        had been called one after the other, and unlike __call__(), an
+        operation raising an exception doesn't stop the rest.
+
+        :param operations: The operations to call, in order.
+        :type operations: list of (operation, args) pairs
+        :param callback: Called from the sub-thread once they are all
+            done, with a list of dicts, one per operation, each with
+            either the 'result' that it returned or the 'error' that
+            it raised, both as strings, the number of 'new_rows' that
+            it published, and the 'operation_id' of the sub-thread.
+        :type callback: callable
+        """
+        results = []
+        def run():
+            thread = threading.current_thread()
+            for operation, args in operations:
+                before = thread.new_rows
+                try:
+                    if operation.startswith('_') or not hasattr(
+                            self, operation):
+                        raise NotImplementedError(operation)
+                    outcome = dict(
+                        result=str(getattr(self, operation)(*args)))
+                except Exception as error:
+                    log.exception(error)
+                    outcome = dict(error=str(error))
+                outcome['new_rows'] = thread.new_rows - before
+                outcome['operation_id'] = thread.operation_id
+                results.append(outcome)
+        _OperationThread(
+            id='{}.batch'.format(self._Name),
+            target=run,
+            success=lambda ignore: callback(results),
             ).start()
 
     def _get_n_rows(self):
         """Return the number of rows in the Dee.SharedModel."""
-        return len(Model)
+        return _publish_queue.call(len, Model)
 
     def _publish(self, **kwargs):
         """Publish fresh data into the model, ignoring duplicates.
@@ -347,44 +863,48 @@ class Base:
             appended.
         """
         # These bits don't need to be set by the caller; we can infer them.
-        kwargs.update(
-            dict(
-                protocol=self._name,
-                account_id=self._account.id
-                )
-            )
+        kwargs['protocol'] = self._name
+        kwargs['account_id'] = self._account.id
         # linkify the message
         orig_message = kwargs.get('message', '')
         kwargs['message'] = linkify_string(orig_message)
-        args = []
-        # Now iterate through all the column names listed in the
-        # SCHEMA, and pop matching column values from the kwargs, in
-        # the order which they appear in the SCHEMA. If any are left
-        # over at the end of this, raise a TypeError indicating the
-        # unexpected column names.
-        for column_name, column_type in SCHEMA.COLUMNS:
-            args.append(kwargs.pop(column_name, SCHEMA.DEFAULTS[column_type]))
-        if len(kwargs) > 0:
-            raise TypeError('Unexpected keyword arguments: {}'.format(
-                COMMA_SPACE.join(sorted(kwargs))))
-        with _publish_lock:
-            message_id = args[ID_IDX]
-            # Don't let duplicate messages into the model
-            if message_id not in _seen_ids:
-                _seen_ids[message_id] = Model.get_position(Model.append(*args))
-
-                # Don't notify messages from me, or older than five days.
-                if args[FROM_ME_IDX] or args[TIME_IDX] < FIVE_DAYS_AGO:
-                    return True
-
-                # Check if notifications are enabled before notifying.
-                if self._do_notify(args[STREAM_IDX]):
-                    notify(
-                        args[SENDER_IDX],
-                        orig_message,
-                        args[AVATAR_IDX],
-                        )
-            return message_id in _seen_ids
+        # The SCHEMA's compiled row builder orders the column values,
+        # fills in defaults for any missing columns, and raises a
+        # TypeError naming any unexpected column names.
+        args = SCHEMA.build_row(**kwargs)
+        return _publish_queue.call(
+            self._append_row, args, orig_message, threading.current_thread())
+
+    def _append_row(self, args, orig_message, thread):
+        """Append a row built by _publish(), unless it is a duplicate."""
+        counted = isinstance(thread, _OperationThread)
+        message_id = args[ID_IDX]
+        # Don't let duplicate messages into the model
+        if message_id in _seen_ids:
+            if counted:
+                thread.duplicate_rows += 1
+        else:
+            _seen_ids[message_id] = Model.get_position(Model.append(*args))
+            if counted:
+                thread.new_rows += 1
+                thread.progress()
+
+            # Have the avatar ready by the time anybody asks for it.
+            Avatar.prefetch(args[AVATAR_IDX])
+
+            # Don't notify messages from me, or older than five days.
+            if args[FROM_ME_IDX] or args[TIME_IDX] < FIVE_DAYS_AGO:
+                return True
+
+            # Check if notifications are enabled before notifying.
+            if self._do_notify(args[STREAM_IDX]):
+                queue_notification(
+                    args[SENDER_IDX],
+                    orig_message,
+                    args[AVATAR_IDX],
+                    args[STREAM_IDX],
+                    )
+        return message_id in _seen_ids
 
     def _unpublish(self, message_id):
         """Remove message_id from the Dee.SharedModel.
@@ -393,6 +913,10 @@ class Base:
             published.
         :type message_id: string
         """
+        _publish_queue.call(self._remove_row, message_id)
+
+    def _remove_row(self, message_id):
+        """Remove a row published by _publish(), from the main loop."""
         log.debug('Unpublishing {}!'.format(message_id))
 
         row_idx = _seen_ids.pop(message_id, None)
@@ -409,13 +933,104 @@ class Base:
     def _get_access_token(self):
         """Return an access token, logging in if necessary.
 
+        A token saved by an earlier run of the dispatcher is reused while
+        it is still valid.  When the token is about to expire, a new one
+        is requested in a background thread, and the old one is returned
+        in the meantime, so callers only ever wait for a login when there
+        is no usable token at all.
+
         :return: The access_token, if we are successfully logged in.
         """
+        if self._account.access_token is None:
+            self._restore_token()
+
+        expires = self._account.token_expires
         if self._account.access_token is None:
             self._login()
+        elif expires is not None:
+            now = time.time()
+            if now >= expires:
+                self._login()
+            elif now >= expires - TOKEN_REFRESH_MARGIN:
+                self._refresh_token()
 
         return self._account.access_token
 
+    def _refresh_token(self):
+        """Log in again in a background thread.
+
+        Other threads keep using the current access token until the new
+        one arrives.
+        """
+        if self._account.login_lock.locked():
+            # A login is already under way.
+            return
+        _OperationThread(
+            id='{}._refresh_token'.format(self._Name), quiet=True,
+            target=self._login,
+            ).start()
+
+    def _get_token_cache(self):
+        """Return this account's TokenCache, creating it on first use."""
+        if self._token_cache is None:
+            self._token_cache = TokenCache(
+                'token-{}'.format(self._account.id))
+        return self._token_cache
+
+    def _restore_token(self):
+        """Reuse a still valid access token saved by an earlier run."""
+        saved = self._get_token_cache()
+        if not saved.get('access_token'):
+            return
+        now = time.time()
+        expires = saved.get('expires')
+        if expires is None:
+            if now - saved.get('saved', 0) > TOKEN_LIFETIME:
+                return
+        elif now >= expires:
+            return
+        if saved.get('credentials') != self._credentials_id():
+            # Saved for credentials that the account no longer uses.
+            saved.remove()
+            return
+        log.debug('Reusing saved access token for {}'.format(self._Name))
+        self._account.secret_token = saved.get('secret_token')
+        self._account.user_id = saved.get('user_id')
+        self._account.user_name = saved.get('user_name')
+        self._account.user_full_name = saved.get('user_full_name')
+        self._account.token_expires = expires
+        self._account.access_token = saved.get('access_token')
+
+    def _save_token(self):
+        """Save the access token so that later runs can reuse it."""
+        cache = self._get_token_cache()
+        cache.update(
+            access_token=self._account.access_token,
+            secret_token=self._account.secret_token,
+            user_id=self._account.user_id,
+            user_name=self._account.user_name,
+            user_full_name=self._account.user_full_name,
+            expires=self._account.token_expires,
+            credentials=self._credentials_id(),
+            saved=time.time(),
+            )
+        cache.write()
+
+    def _credentials_id(self):
+        auth = self._account.auth
+        return None if auth is None else auth.get_credentials_id()
+
+    def _forget_token(self):
+        """Stop using the access token, and log in again when next needed.
+
+        This is for tokens that have been revoked, or whose account's
+        credentials have changed, so the saved copy goes too.
+        """
+        log.info('Forgetting the access token for {}'.format(self._Name))
+        self._account.access_token = None
+        self._account.token_expires = None
+        self._get_token_cache().remove()
+
     def _login(self):
         """Prevent redundant login attempts.
 
@@ -473,9 +1088,38 @@ class Base:
 
         result = Authentication(self._account.id).login()
 
+        expires_in = result.get('ExpiresIn')
+        self._account.token_expires = (
+            time.time() + int(expires_in) if expires_in else None)
         self._account.access_token = result.get('AccessToken')
         self._whoami(result)
         log.debug('{} UID: {}'.format(self._Name, self._account.user_id))
+        self._save_token()
+
+        if expires_in:
+            # Get a new token before this one expires, even if nobody
+            # happens to ask for one in the meantime.  We're in a
+            # protocol thread here, so leave the timer to the main loop.
+            GLib.idle_add(self._schedule_refresh,
+                          max(int(expires_in) - TOKEN_REFRESH_MARGIN, 1))
+
+    def _schedule_refresh(self, delay):
+        """Refresh the access token in delay seconds, in the main loop.
+
+        This replaces any refresh that an earlier login scheduled, so
+        each account only ever has one timer.
+        """
+        if self._refresh_timer is not None:
+            GLib.source_remove(self._refresh_timer)
+        self._refresh_timer = GLib.timeout_add_seconds(
+            delay, self._refresh_timer_expired)
+        # Only run once as a GLib idle callback.
+        return False
+
+    def _refresh_timer_expired(self):
+        self._refresh_timer = None
+        self._refresh_token()
+        return False
 
     def _get_oauth_headers(self, method, url, data=None, headers=None):
         """Basic wrapper around oauthlib that we use for Twitter and Flickr."""
@@ -512,6 +1156,14 @@ class Base:
             message = error.get('message')
         except AttributeError:
             message = None
+        entries = error if isinstance(error, list) else [error]
+        codes = {entry.get('code') for entry in entries
+                 if isinstance(entry, dict)}
+        if codes & self._AUTH_ERROR_CODES:
+            # The token was revoked, or the password changed, so get a
+            # new one instead of sending this one until it expires.
+            self._forget_token()
+            raise AuthorizationError(self._account.id, message or str(error))
         raise FriendsError(message or str(error))
 
     def _calculate_row_cell(self, message_id, column_name):
@@ -524,25 +1176,33 @@ class Base:
 
     def _fetch_cell(self, message_id, column_name):
         """Find a column value associated with a specific message_id."""
+        return _publish_queue.call(self._read_cell, message_id, column_name)
+
+    def _read_cell(self, message_id, column_name):
+        """Return a column value, from the main loop."""
         row_id, col_idx = self._calculate_row_cell(message_id, column_name)
         return Model.get_row(row_id)[col_idx]
 
     def _set_cell(self, message_id, column_name, value):
         """Set a column value associated with a specific message_id."""
-        row_id, col_idx = self._calculate_row_cell(message_id, column_name)
-        Model.get_row(row_id)[col_idx] = value
-        persist_model()
+        _publish_queue.call(
+            self._change_cell, message_id, column_name, lambda old: value)
 
     def _inc_cell(self, message_id, column_name):
         """Increment a column value associated with a specific message_id."""
-        row_id, col_idx = self._calculate_row_cell(message_id, column_name)
-        Model.get_row(row_id)[col_idx] += 1
-        persist_model()
+        _publish_queue.call(
+            self._change_cell, message_id, column_name, lambda old: old + 1)
 
     def _dec_cell(self, message_id, column_name):
         """Decrement a column value associated with a specific message_id."""
+        _publish_queue.call(
+            self._change_cell, message_id, column_name, lambda old: old - 1)
+
+    def _change_cell(self, message_id, column_name, change):
+        """Replace a column value with change(value), from the main loop."""
         row_id, col_idx = self._calculate_row_cell(message_id, column_name)
-        Model.get_row(row_id)[col_idx] -= 1
+        row = Model.get_row(row_id)
+        row[col_idx] = change(row[col_idx])
         persist_model()
 
     def _prepare_eds_connections(self, allow_creation=True):
@@ -576,6 +1236,10 @@ class Base:
         contact = self._create_contact(**contact_details)
         if not self._book_client.add_contact_sync(contact, None):
             raise ContactsError('Failed to save contact {!r}'.format(contact))
+        thread = threading.current_thread()
+        if isinstance(thread, _OperationThread):
+            thread.contacts += 1
+            thread.progress()
 
     def _previously_stored_contact(self, search_term):
         self._prepare_eds_connections()
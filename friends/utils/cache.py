@@ -17,15 +17,17 @@
 
 __all__ = [
     'JsonCache',
+    'MarkCache',
     ]
 
 import os
-import json
 import logging
+import threading
 
 from gi.repository import GLib
 
 from friends.errors import ignored
+from friends.utils import jsoncodec
 
 
 log = logging.getLogger(__name__)
@@ -58,8 +60,8 @@ class JsonCache(dict):
         self._path = self._root.format(name)
 
         try:
-            with open(self._path, 'r') as cache:
-                self.update(json.loads(cache.read()))
+            with open(self._path, 'rb') as cache:
+                self.update(jsoncodec.loads(cache.read()))
         except (FileNotFoundError, ValueError, UnicodeDecodeError):
             # This writes '{}' to self._filename on first run.
             self.write()
@@ -67,9 +69,67 @@ class JsonCache(dict):
     def write(self):
         """Write our dict contents to disk as a JSON string."""
         with open(self._path, 'w') as cache:
-            cache.write(json.dumps(self))
+            cache.write(jsoncodec.dumps(self))
 
     def __setitem__(self, key, value):
         """Write to disk every time dict is updated."""
         dict.__setitem__(self, key, value)
         self.write()
+
+
+class MarkCache(JsonCache):
+    """Persist the newest position seen in each stream, as JSON.
+
+    Values only ever move forwards; an attempt to store an older value
+    than the one already stored is ignored.  What forwards means is up
+    to convert, which turns each value into something that sorts in
+    stream order, and is applied before values are stored.
+
+    The main streams, such as 'messages' and 'mentions', are always
+    kept.  Lists, users and searches are kept too, but there can be
+    any number of those, so only the _max_substreams most recently
+    used of them are remembered.  Other streams with a '/' in their
+    name, such as 'reply_to/...', are never worth remembering.
+    """
+    _max_substreams = 100
+    _substream_prefixes = ('list/', 'user/', 'search/')
+
+    # Streams can be fetched from several threads at once.
+    _lock = threading.Lock()
+
+    def __init__(self, name, convert=None):
+        if convert is not None:
+            self._convert = convert
+        super().__init__(name)
+
+    def _convert(self, value):
+        """Turn a new value into something that sorts correctly."""
+        return value
+
+    def _touch(self, key):
+        """Mark a substream as the most recently used one."""
+        dict.__setitem__(self, key, dict.pop(self, key))
+
+    def get(self, key, default=None):
+        with self._lock:
+            if '/' in key and key in self:
+                self._touch(key)
+            return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        if '/' in key and not key.startswith(self._substream_prefixes):
+            return
+        value = self._convert(value)
+        with self._lock:
+            if key in self:
+                if '/' in key:
+                    self._touch(key)
+                if not value > self._convert(self[key]):
+                    return
+            dict.__setitem__(self, key, value)
+            substreams = [name for name in self if '/' in name]
+            # Dicts keep their insertion order, so the least recently used
+            # substreams come first.
+            for name in substreams[:-self._max_substreams]:
+                del self[name]
+            self.write()
@@ -22,27 +22,81 @@ __all__ = [
     ]
 
 
-import json
+import codecs
 import logging
+import threading
 import gi
 
 from contextlib import contextmanager
 gi.require_version('SoupGNOME', '2.4')
-from gi.repository import Gio, Soup, SoupGNOME
+from gi.repository import GLib, Gio, Soup, SoupGNOME
 from urllib.parse import urlencode
 
-from friends.errors import FriendsError
+from friends.errors import FriendsError, ignored
+from friends.utils import jsoncodec
+from friends.utils.stream import JsonArrayDecoder
 
 log = logging.getLogger(__name__)
 
 
+# How many requests may be talking to the same host at once, such as
+# when Twitter.lists() fetches several lists in parallel.  libsoup's own
+# default of 2 would quietly serialize everything after that.
+MAX_CONNS_PER_HOST = 4
+
 # Global libsoup session instance.
 _soup = Soup.SessionSync()
+_soup.set_property('max-conns-per-host', MAX_CONNS_PER_HOST)
 # Enable this for full requests and responses dumped to STDOUT.
 #_soup.add_feature(Soup.Logger.new(Soup.LoggerLogLevel.BODY, -1))
 _soup.add_feature(SoupGNOME.ProxyResolverGNOME())
 
 
+def _count_download(payload):
+    """Charge a response body to the protocol operation that asked for it.
+
+    Only the threads that run protocol operations keep count, see
+    friends.utils.base._OperationThread.
+    """
+    thread = threading.current_thread()
+    if hasattr(thread, 'bytes_downloaded'):
+        thread.bytes_downloaded += len(payload)
+    return payload
+
+
+def _json_charset(payload, charset=None):
+    """Work out how a JSON payload is encoded, from its first bytes.
+
+    :param payload: The payload, or at least the first four bytes of it.
+    :type payload: bytes
+    :param charset: The charset that the server declared, if any, which
+        always wins.
+    :type charset: str
+    """
+    if len(payload) < 4 and charset is None:
+        charset = 'utf-8' # Safest assumption
+
+    # RFC 4627 $3.  JSON text SHALL be encoded in Unicode.  The default
+    # encoding is UTF-8.  Since the first two characters of a JSON text
+    # will always be ASCII characters [RFC0020], it is possible to
+    # determine whether an octet stream is UTF-8, UTF-16 (BE or LE), or
+    # UTF-32 (BE or LE) by looking at the pattern of nulls in the first
+    # four octets.
+    if charset is None:
+        octet_0, octet_1, octet_2, octet_3 = payload[:4]
+        if 0 not in (octet_0, octet_1, octet_2, octet_3):
+            charset = 'utf-8'
+        elif (octet_1 == octet_3 == 0) and octet_2 != 0:
+            charset = 'utf-16le'
+        elif (octet_0 == octet_2 == 0) and octet_1 != 0:
+            charset = 'utf-16be'
+        elif (octet_1 == octet_2 == octet_3 == 0):
+            charset = 'utf-32le'
+        elif (octet_0 == octet_1 == octet_2 == 0):
+            charset = 'utf-32be'
+    return charset
+
+
 def _get_charset(message):
     """Extract charset from Content-Type header in a Soup Message."""
     type_header = message.response_headers.get_content_type()[1]
@@ -90,6 +144,11 @@ class HTTP:
         if message is None:
             raise ValueError('Failed to build this HTTP request.')
         _soup.send_message(message)
+        # Let whoever is waiting for a long operation know it's moving.
+        thread = threading.current_thread()
+        if hasattr(thread, 'pages'):
+            thread.pages += 1
+            thread.progress()
         if message.status_code != 200:
             log.error('{}: {} {}'.format(self.url,
                                          message.status_code,
@@ -100,45 +159,72 @@ class HTTP:
     def get_json(self):
         """Interpret and return the results as JSON data."""
         with self._transfer() as message:
-            payload = message.response_body.flatten().get_data()
+            payload = _count_download(
+                message.response_body.flatten().get_data())
             charset = _get_charset(message)
 
         if not payload:
             raise FriendsError('Got zero-length response from server.')
 
-        if len(payload) < 4 and charset is None:
-            charset = 'utf-8' # Safest assumption
-
-        # RFC 4627 $3.  JSON text SHALL be encoded in Unicode.  The default
-        # encoding is UTF-8.  Since the first two characters of a JSON text
-        # will always be ASCII characters [RFC0020], it is possible to
-        # determine whether an octet stream is UTF-8, UTF-16 (BE or LE), or
-        # UTF-32 (BE or LE) by looking at the pattern of nulls in the first
-        # four octets.
-        if charset is None:
-            octet_0, octet_1, octet_2, octet_3 = payload[:4]
-            if 0 not in (octet_0, octet_1, octet_2, octet_3):
-                charset = 'utf-8'
-            elif (octet_1 == octet_3 == 0) and octet_2 != 0:
-                charset = 'utf-16le'
-            elif (octet_0 == octet_2 == 0) and octet_1 != 0:
-                charset = 'utf-16be'
-            elif (octet_1 == octet_2 == octet_3 == 0):
-                charset = 'utf-32le'
-            elif (octet_0 == octet_1 == octet_2 == 0):
-                charset = 'utf-32be'
-
-        return json.loads(payload.decode(charset))
+        return jsoncodec.loads(payload, _json_charset(payload, charset))
+
+    def iter_json(self, path='', rest=None):
+        """Yield the items of a JSON array in the results, one by one.
+
+        The response body is decoded a chunk at a time, straight from
+        the buffers that libsoup received it into, so neither a flat
+        copy of it nor the whole of it as a string is ever made.
+
+        :param path: The key of the array in the top level object, or ''
+            if the whole response is the array.
+        :type path: str
+        :param rest: If given, this is filled in with the other keys in
+            the top level object, such as Facebook's 'paging' or 'error'.
+        :type rest: dict
+        """
+        with self._transfer() as message:
+            body = message.response_body
+            charset = _get_charset(message)
+
+        array = JsonArrayDecoder(path, rest)
+        decoder = None
+        # The encoding can only be told from the first four bytes.
+        head = b''
+        offset = 0
+        while True:
+            buf = body.get_chunk(offset)
+            chunk = None if buf is None else buf.get_data()
+            if not chunk:
+                break
+            offset += len(_count_download(chunk))
+            if decoder is None:
+                head += chunk
+                if len(head) < 4:
+                    continue
+                chunk, head = head, b''
+                decoder = codecs.getincrementaldecoder(
+                    _json_charset(chunk, charset))()
+            yield from array.feed(decoder.decode(chunk))
+
+        if decoder is None:
+            if not head:
+                raise FriendsError('Got zero-length response from server.')
+            decoder = codecs.getincrementaldecoder(
+                _json_charset(head, charset))()
+        yield from array.feed(decoder.decode(head, final=True))
+        array.close()
 
     def get_bytes(self):
         """Return the results as a bytes object."""
         with self._transfer() as message:
-            return message.response_body.flatten().get_data()
+            return _count_download(
+                message.response_body.flatten().get_data())
 
     def get_string(self):
         """Return the results as a string, decoded as per the response."""
         with self._transfer() as message:
-            payload = message.response_body.flatten().get_data()
+            payload = _count_download(
+                message.response_body.flatten().get_data())
             charset = _get_charset(message)
             if charset:
                 return payload.decode(charset)
@@ -189,6 +275,50 @@ class Downloader(HTTP):
         self._rate_limiter.wait(message)
         return message
 
+    def open_stream(self):
+        """Start the download, without waiting for the whole body.
+
+        This returns as soon as the response headers have arrived, which
+        suits streaming APIs whose responses never end.
+
+        :return: The response body, as a _ResponseStream.
+        :raises FriendsError: if the server refused the request.
+        """
+        message = self._build_request()
+        cancellable = Gio.Cancellable()
+        input_stream = _soup.send(message, cancellable)
+        response = _ResponseStream(input_stream, cancellable)
+        if message.status_code != 200:
+            response.close()
+            raise FriendsError('{}: {} {}'.format(
+                self.url, message.status_code, message.reason_phrase))
+        self._rate_limiter.update(message)
+        return response
+
+
+class _ResponseStream:
+    """Read a response body in whatever pieces it arrives in."""
+
+    def __init__(self, input_stream, cancellable):
+        self._input_stream = input_stream
+        self._cancellable = cancellable
+
+    def read(self, size):
+        """Return up to size bytes, or b'' at the end of the body.
+
+        This blocks until at least one byte has arrived.
+        """
+        return _count_download(self._input_stream.read_bytes(
+            size, self._cancellable).get_data())
+
+    def close(self):
+        """End the download, even from another thread."""
+        # Closing fails while another thread is blocked in read(), so
+        # cancel that first.  It then closes the stream on its way out.
+        self._cancellable.cancel()
+        with ignored(GLib.GError):
+            self._input_stream.close(None)
+
 
 class Uploader(HTTP):
     """Convenient uploading wrapper."""
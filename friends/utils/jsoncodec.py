@@ -0,0 +1,81 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Encode and decode JSON, as fast as what's installed allows.
+
+Every response that we download, and every cache that we keep on disk,
+is JSON.  If orjson is installed, it is used to parse all of it, and to
+write compact JSON, which it does several times faster than the json
+module.  Otherwise, or whenever orjson can't cope, such as with
+integers too big for 64 bits, the json module does the work.
+"""
+
+
+__all__ = [
+    'BACKEND',
+    'dumps',
+    'loads',
+    ]
+
+
+import json
+import codecs
+
+from friends.errors import ignored
+
+
+_orjson = None
+with ignored(ImportError):
+    import orjson as _orjson
+
+
+# The name of the module doing the heavy lifting, for the benchmarks.
+BACKEND = 'json' if _orjson is None else 'orjson'
+
+
+def loads(data, encoding='utf-8'):
+    """Decode a JSON document.
+
+    :param data: The document, either already decoded, or as bytes.
+    :type data: str or bytes
+    :param encoding: The encoding of data, if it is bytes.
+    :type encoding: str
+    """
+    if _orjson is not None:
+        # orjson only reads UTF-8 bytes, but it reads them without
+        # making a str copy of the whole document first.
+        if isinstance(data, str) or codecs.lookup(encoding).name == 'utf-8':
+            with ignored(ValueError):
+                return _orjson.loads(data)
+    if not isinstance(data, str):
+        data = data.decode(encoding)
+    return json.loads(data)
+
+
+def dumps(obj, compact=False):
+    """Encode obj as a JSON document.
+
+    :param compact: Leave out all optional whitespace.  Otherwise, the
+        output is exactly what json.dumps() writes, which orjson can't
+        produce, so only compact documents are written with orjson.
+    :type compact: bool
+    :rtype: str
+    """
+    if compact:
+        if _orjson is not None:
+            with ignored(TypeError):
+                return _orjson.dumps(obj).decode('utf-8')
+        return json.dumps(obj, separators=(',', ':'))
+    return json.dumps(obj)
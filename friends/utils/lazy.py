@@ -0,0 +1,75 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred loading of GObject-introspection typelibs.
+
+Some of the libraries we use through gi, such as EDS and libnotify, are
+expensive to load and are not needed at all for a plain refresh. Since
+friends-dispatcher is started over and over again by DBus activation,
+we avoid paying for them until the first time they are actually used.
+"""
+
+
+__all__ = [
+    'LazyRepository',
+    ]
+
+
+import gi
+import logging
+import importlib
+
+
+log = logging.getLogger(__name__)
+
+
+class LazyRepository:
+    """Stand in for a gi.repository module until it is first used.
+
+    Use like so:
+
+    EBook = LazyRepository('EBook', '1.2')
+
+    and then use EBook just like the real module. The typelib is loaded
+    the first time any attribute is looked up, and if it is missing,
+    that lookup raises ImportError.
+    """
+
+    def __init__(self, namespace, version=None):
+        self._namespace = namespace
+        self._version = version
+        self._module = None
+
+    def _load(self):
+        """Import the real module, if that hasn't been done yet."""
+        if self._module is None:
+            log.debug('Loading {} typelib'.format(self._namespace))
+            try:
+                if self._version is not None:
+                    gi.require_version(self._namespace, self._version)
+                self._module = importlib.import_module(
+                    'gi.repository.' + self._namespace)
+            except ValueError as error:
+                # gi.require_version() raises ValueError for typelibs
+                # that aren't installed.
+                raise ImportError(str(error))
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<LazyRepository {} ({})>'.format(
+            self._namespace, 'loaded' if self._module else 'not loaded')
@@ -17,43 +17,98 @@
 
 
 __all__ = [
+    'PROTOCOLS',
     'ProtocolManager',
     'protocol_manager',
     ]
 
 
-import os
+import logging
 import importlib
+import importlib.util
+import threading
 
-from pkg_resources import resource_listdir
+from collections.abc import Mapping
 
-from friends.utils.base import Base
+
+log = logging.getLogger(__name__)
+
+
+# Every protocol plugin we ship, keyed by the libaccounts provider name.
+# If you add a new protocol to friends/protocols, you must add it here
+# too, otherwise the dispatcher will never find it.
+PROTOCOLS = {
+    'facebook': 'friends.protocols.facebook.Facebook',
+    'flickr': 'friends.protocols.flickr.Flickr',
+    'foursquare': 'friends.protocols.foursquare.FourSquare',
+    'identica': 'friends.protocols.identica.Identica',
+    'instagram': 'friends.protocols.instagram.Instagram',
+    'linkedin': 'friends.protocols.linkedin.LinkedIn',
+    'twitter': 'friends.protocols.twitter.Twitter',
+    }
+
+
+class _LazyProtocols(Mapping):
+    """Map provider names to protocol classes, importing on first use.
+
+    Importing a protocol module is relatively expensive, so we only do
+    it when somebody actually asks for that protocol, such as when an
+    account for it is found in Ubuntu Online Accounts.
+
+    Each protocol is packaged on its own, so the ones whose modules
+    aren't installed are left out, just as if they weren't in the
+    manifest at all.
+    """
+
+    def __init__(self, manifest):
+        self._manifest = manifest
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            cls = self._classes.get(name)
+            if cls is None:
+                module_path, dot, class_name = self._manifest[name].rpartition(
+                    '.')
+                log.debug('Loading {} protocol'.format(class_name))
+                try:
+                    module = importlib.import_module(module_path)
+                except ImportError as error:
+                    log.debug('{} protocol is not installed: {}'.format(
+                        class_name, error))
+                    raise KeyError(name) from error
+                cls = self._classes[name] = getattr(module, class_name)
+            return cls
+
+    def _installed(self, name):
+        """Whether the module for a protocol is there, without importing it."""
+        module_path = self._manifest[name].rpartition('.')[0]
+        try:
+            return importlib.util.find_spec(module_path) is not None
+        except ImportError:
+            return False
+
+    def __iter__(self):
+        return (name for name in self._manifest if self._installed(name))
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __contains__(self, name):
+        return name in self._manifest and self._installed(name)
 
 
 class ProtocolManager:
-    """Discover all protocol classes."""
-
-    def __init__(self):
-        self.protocols = dict((cls.__name__.lower(), cls)
-                              for cls in self._protocol_classes)
-
-    @property
-    def _protocol_classes(self):
-        """Search for and return all protocol classes."""
-        for filename in resource_listdir('friends', 'protocols'):
-            basename, extension = os.path.splitext(filename)
-            if extension != '.py':
-                continue
-            module_path = 'friends.protocols.' + basename
-            module = importlib.import_module(module_path)
-            # Scan all the objects in the module's __all__ and add any which
-            # are subclasses of the base protocol class.  Essentially skip any
-            # modules that don't have an __all__ (e.g. the __init__.py).
-            # However, the module better not lie about its __all__ members.
-            for name in getattr(module, '__all__', []):
-                obj = getattr(module, name)
-                if issubclass(obj, Base):
-                    yield obj
+    """Look up protocol classes by name, without importing them all."""
+
+    def __init__(self, manifest=PROTOCOLS):
+        self._manifest = manifest
+        self.protocols = _LazyProtocols(manifest)
+
+    def class_name(self, name):
+        """Return the name of a protocol's class, without importing it."""
+        return self._manifest[name].rpartition('.')[2]
 
 
 protocol_manager = ProtocolManager()
@@ -40,6 +40,21 @@ import logging
 log = logging.getLogger(__name__)
 
 
+COMMA_SPACE = ', '
+
+
+# Template for the row builder that Schema compiles for each schema it
+# loads.  Column defaults are bound as ordinary parameter defaults, so
+# the interpreter's own argument handling does all of the work.
+ROW_BUILDER = """\
+def build_row({params}**_unexpected_columns):
+    if _unexpected_columns:
+        raise TypeError('Unexpected keyword arguments: {{}}'.format(
+            COMMA_SPACE.join(sorted(_unexpected_columns))))
+    return ({names})
+"""
+
+
 class Schema:
     """Represents the DeeModel schema data that we defined in CSV."""
     DEFAULTS = {
@@ -78,6 +93,25 @@ class Schema:
             except IOError:
                 pass
         self.INDICES = {name: i for i, name in enumerate(self.NAMES)}
+        self.build_row = self._compile_row_builder()
+
+    def _compile_row_builder(self):
+        """Generate a function that turns column values into a model row.
+
+        The returned callable accepts column values either positionally
+        in SCHEMA order or by column name, fills in the defaults for any
+        missing columns, and returns a tuple suitable for passing to
+        Model.append().  Unknown column names raise TypeError.
+        """
+        defaults = {'_default_' + name: self.DEFAULTS[variant]
+                    for name, variant in self.COLUMNS}
+        source = ROW_BUILDER.format(
+            params=''.join(
+                '{0}=_default_{0}, '.format(name) for name in self.NAMES),
+            names=''.join(name + ', ' for name in self.NAMES))
+        namespace = dict(defaults, COMMA_SPACE=COMMA_SPACE)
+        exec(compile(source, '<friends row builder>', 'exec'), namespace)
+        return namespace['build_row']
 
 
 MODEL_DBUS_NAME = 'com.canonical.Friends.Streams'
@@ -93,13 +127,18 @@ def persist_model():
 
 
 def prune_model(maximum):
-    """If there are more than maximum rows, remove the oldest ones."""
-    pruned = 0
+    """If there are more than maximum rows, remove the oldest ones.
+
+    :return: The removed rows, oldest first, as tuples.
+    """
+    pruned = []
     while Model.get_n_rows() > maximum:
-        Model.remove(Model.get_first_iter())
-        pruned += 1
+        itr = Model.get_first_iter()
+        pruned.append(tuple(Model.get_row(itr)))
+        Model.remove(itr)
 
     if pruned:
-        log.debug('Deleted {} rows from Dee.SharedModel.'.format(pruned))
+        log.debug('Deleted {} rows from Dee.SharedModel.'.format(len(pruned)))
         # Delete those messages from disk, too, not just memory.
         persist_model()
+    return pruned
@@ -21,21 +21,72 @@ silently ignores all calls.
 
 
 __all__ = [
+    'NotificationQueue',
     'notify',
+    'queue_notification',
     ]
 
-import gi
 
-gi.require_version('GdkPixbuf', '2.0')
-from gi.repository import GObject, GdkPixbuf
+import time
+import logging
+import threading
+
+from collections import Counter, deque
+from gi.repository import GLib, GObject
 
 from friends.utils.avatar import Avatar
+from friends.utils.lazy import LazyRepository
 from friends.errors import ignored
 
 
-# This gets conditionally imported at the end of this file, which
-# allows for easier overriding of the following function definition.
-Notify = None
+# Optional dependency on Notify library, which doesn't get loaded until
+# the first notification is actually displayed.
+Notify = LazyRepository('Notify', '0.7')
+
+
+# Avatars are scaled to fit in a square this many pixels across.
+ICON_SIZE = 48
+
+# How many seconds to collect messages for before notifying about them.
+# That is long enough to catch all the messages from one refresh.
+BATCH_DELAY = 2
+
+# When more than this many messages in one batch come from the same
+# sender, or from the same stream, show a summary of them instead.
+SUMMARY_THRESHOLD = 3
+
+# The most notifications to show in any one minute.
+PER_MINUTE = 10
+
+# How to refer to the messages in each stream, in summaries.
+STREAM_NAMES = dict(
+    mentions='mentions',
+    private='private messages',
+    )
+
+
+log = logging.getLogger(__name__)
+
+
+# None until libnotify has been initialized, then whether or not the
+# notification server lets us append to existing notifications.
+_notify_can_append = None
+_notify_available = None
+
+
+def _initialize():
+    """Initialize libnotify on first use, returning False if it's missing."""
+    global _notify_available, _notify_can_append
+    if _notify_available is None:
+        try:
+            Notify.init('friends')
+        except ImportError:
+            _notify_available = False
+        else:
+            _notify_can_append = (
+                'x-canonical-append' in Notify.get_server_caps())
+            _notify_available = True
+    return _notify_available
 
 
 def notify(title, message, icon_uri='', pixbuf=None):
@@ -43,12 +94,15 @@ def notify(title, message, icon_uri='', pixbuf=None):
     if not (title and message):
         return
 
+    if not _initialize():
+        return
+
     notification = Notify.Notification.new(
         title, message, 'friends')
 
-    with ignored(GObject.GError):
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            Avatar.get_image(icon_uri), 48, 48)
+    # Never wait for an avatar to download.  Until it has, the
+    # notification gets the default icon.
+    pixbuf = Avatar.get_pixbuf(icon_uri, ICON_SIZE) or pixbuf
 
     if pixbuf is not None:
         notification.set_icon_from_pixbuf(pixbuf)
@@ -62,12 +116,122 @@ def notify(title, message, icon_uri='', pixbuf=None):
         notification.show()
 
 
-# Optional dependency on Notify library.
-try:
-    gi.require_version('Notify', '0.7')
-    from gi.repository import Notify
-except ImportError:
-    notify = lambda *ignore, **kwignore: None
-else:
-    Notify.init('friends')
-    _notify_can_append = 'x-canonical-append' in Notify.get_server_caps()
+def _list_senders(senders):
+    """Name the first few senders, in a way that reads well."""
+    names = list(dict.fromkeys(senders))
+    if len(names) == 1:
+        return names[0]
+    if len(names) <= 3:
+        return '{} and {}'.format(', '.join(names[:-1]), names[-1])
+    return '{}, {} and {} others'.format(names[0], names[1], len(names) - 2)
+
+
+class NotificationQueue:
+    """Collect messages to notify about, then show them in batches.
+
+    Messages are added from whichever thread publishes them, and shown
+    by flush(), which runs on the main loop BATCH_DELAY seconds after
+    the first message of a batch arrives.  A sender or stream that has
+    more than SUMMARY_THRESHOLD messages in a batch gets one summary
+    notification for all of them.  No more than PER_MINUTE
+    notifications are shown in any minute; when a batch would go over
+    that, its last notification sums up all the ones that didn't fit.
+    """
+
+    def __init__(self, delay=BATCH_DELAY, threshold=SUMMARY_THRESHOLD,
+                 per_minute=PER_MINUTE):
+        self.delay = delay
+        self.threshold = threshold
+        self.per_minute = per_minute
+        self.dropped = 0
+        self._pending = []
+        # When each notification in the last minute was shown.
+        self._shown = deque()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, title, message, icon_uri='', stream=''):
+        """Notify about a message in the next batch."""
+        if not (title and message):
+            return
+        with self._lock:
+            self._pending.append((title, message, icon_uri, stream))
+            if self._timer is None:
+                self._timer = GLib.timeout_add(
+                    int(self.delay * 1000), self.flush)
+
+    def _summarize(self, pending):
+        """Turn messages into notifications, as (title, body, icon, senders).
+
+        senders names the sender of every message in a notification, so
+        that the notification and the overflow can both be summed up.
+        """
+        senders = Counter(item[0] for item in pending)
+        streams = Counter(
+            item[3] for item in pending if senders[item[0]] <= self.threshold)
+        # Dicts keep their insertion order, so each notification goes
+        # where the first message in it arrived.
+        groups = {}
+        for item in pending:
+            title, message, icon_uri, stream = item
+            if senders[title] > self.threshold:
+                key = ('sender', title)
+            elif streams[stream] > self.threshold:
+                key = ('stream', stream)
+            else:
+                key = ('message', len(groups))
+            groups.setdefault(key, []).append(item)
+        notifications = []
+        for (kind, name), items in groups.items():
+            title, message, icon_uri, stream = items[-1]
+            senders = [item[0] for item in items]
+            if kind == 'sender':
+                message = '{}\n(and {} more)'.format(message, len(items) - 1)
+            elif kind == 'stream':
+                title = '{} new {}'.format(
+                    len(items), STREAM_NAMES.get(stream, 'messages'))
+                message = 'From {}'.format(_list_senders(senders))
+                icon_uri = ''
+            notifications.append((title, message, icon_uri, senders))
+        return notifications
+
+    def flush(self, now=None):
+        """Show the notifications for everything collected so far."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._timer = None
+        if now is None:
+            now = time.time()
+        while self._shown and self._shown[0] <= now - 60:
+            self._shown.popleft()
+        notifications = self._summarize(pending)
+        budget = self.per_minute - len(self._shown)
+        if len(notifications) > budget:
+            # Keep the last notification we may show for the overflow.
+            fits = max(budget - 1, 0)
+            overflow = notifications[fits:]
+            notifications = notifications[:fits]
+            senders = [sender for notification in overflow
+                       for sender in notification[3]]
+            count = len(senders)
+            if budget > 0:
+                notifications.append((
+                    '{} more new messages'.format(count),
+                    'From {}'.format(_list_senders(senders)), '', senders))
+            else:
+                self.dropped += count
+                log.debug('Too many notifications, dropped {}.'.format(
+                    count))
+        for title, message, icon_uri, senders in notifications:
+            notify(title, message, icon_uri)
+            self._shown.append(now)
+        # Don't call us again until there is another batch.
+        return False
+
+
+_queue = NotificationQueue()
+
+
+def queue_notification(title, message, icon_uri='', stream=''):
+    """Notify about a message soon, from the main loop."""
+    _queue.add(title, message, icon_uri, stream)
@@ -0,0 +1,288 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Adaptive polling of each account's streams.
+
+friends-service asks us to refresh every few minutes, no matter whether
+a stream is busy or hasn't changed in days.  This scheduler polls each
+(account, stream) pair on its own interval instead, which follows how
+often new messages have actually been turning up in that stream, and
+Refresh() only polls the streams that are due.  A busy Twitter home
+timeline ends up being polled every couple of minutes, while a quiet
+LinkedIn feed is only polled about once an hour.
+
+The schedules are saved when the dispatcher exits, so that they carry
+on where they left off when friends-service starts it up again.
+"""
+
+
+__all__ = [
+    'PollScheduler',
+    'StreamSchedule',
+    ]
+
+
+import time
+import logging
+import threading
+
+from gi.repository import GLib
+
+from friends.utils.cache import JsonCache
+
+
+log = logging.getLogger(__name__)
+
+
+# All of these are in seconds.
+MIN_INTERVAL = 120
+MAX_INTERVAL = 3600
+DEFAULT_INTERVAL = 900
+TICK = 30
+
+# Aim to find about this many new messages each time a stream is polled.
+TARGET_YIELD = 5
+
+# How much weight the most recent poll gets in the arrival rate.
+SMOOTHING = 0.3
+
+
+class StreamSchedule:
+    """When to poll one stream of one account, and how well it pays off."""
+
+    def __init__(self, account_id, stream, interval=DEFAULT_INTERVAL):
+        self.account_id = account_id
+        self.stream = stream
+        self.interval = interval
+        # New messages per second, smoothed over the recent polls.
+        self.rate = None
+        self.last_poll = None
+        self.last_yield = 0
+        self.last_duplicates = 0
+        self.last_bytes = 0
+        self.next_poll = 0
+        self.polls = 0
+        self.items = 0
+        self.polling = False
+
+    def record(self, new_items, now, floor=0, duplicates=0, size=0):
+        """Adjust the interval after a poll found new_items messages.
+
+        :param new_items: How many new rows the poll added to the model.
+        :type new_items: int
+        :param now: When the poll finished, in seconds since the epoch.
+        :type now: float
+        :param floor: The shortest interval that the protocol's rate
+            limit allows, which beats every other consideration.
+        :type floor: float
+        :param duplicates: How many rows the poll downloaded again.
+        :type duplicates: int
+        :param size: How many bytes the poll downloaded.
+        :type size: int
+        """
+        if self.last_poll is not None:
+            rate = new_items / max(now - self.last_poll, 1)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = SMOOTHING * rate + (1 - SMOOTHING) * self.rate
+        self.last_poll = now
+        self.last_yield = new_items
+        self.last_duplicates = duplicates
+        self.last_bytes = size
+        self.polls += 1
+        self.items += new_items
+
+        if self.rate is None:
+            # The first poll only tells us where the stream was up to.
+            interval = self.interval
+        elif self.rate > 0:
+            interval = TARGET_YIELD / self.rate
+        else:
+            interval = self.interval * 2
+        self.interval = max(
+            min(max(interval, MIN_INTERVAL), MAX_INTERVAL), floor)
+        self.next_poll = now + self.interval
+
+    def failed(self, now):
+        """Back off after a poll raised an exception."""
+        self.interval = min(self.interval * 2, MAX_INTERVAL)
+        self.next_poll = now + self.interval
+
+    def save(self):
+        """Return what's worth remembering across dispatcher restarts."""
+        return dict(interval=self.interval, rate=self.rate,
+                    last_poll=self.last_poll, next_poll=self.next_poll)
+
+    def restore(self, saved):
+        """Carry on from what save() returned."""
+        self.interval = saved.get('interval', self.interval)
+        self.rate = saved.get('rate')
+        self.last_poll = saved.get('last_poll')
+        self.next_poll = saved.get('next_poll', 0)
+
+    def as_dict(self, now):
+        """Summarize this schedule, for tuning the constants above."""
+        return dict(
+            account_id=self.account_id,
+            stream=self.stream,
+            interval=round(self.interval),
+            next_poll=round(max(self.next_poll - now, 0)),
+            yield_per_hour=round((self.rate or 0) * 3600, 2),
+            last_yield=self.last_yield,
+            last_duplicates=self.last_duplicates,
+            last_bytes=self.last_bytes,
+            polls=self.polls,
+            items=self.items,
+            )
+
+
+class PollScheduler:
+    """Poll every stream of every account when it is next due.
+
+    :param accounts: The dispatcher's accounts, keyed by account id.
+    :type accounts: dict
+    :param polled: Called from the main loop whenever the scheduler has
+        started polling some streams by itself, since that keeps the
+        dispatcher busy without any method call.
+    :type polled: callable
+    """
+
+    def __init__(self, accounts, polled=None):
+        self.accounts = accounts
+        self._polled = polled
+        self._schedules = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._saved = None
+
+    def start(self):
+        """Start polling from the GLib main loop."""
+        if self._timer is None:
+            log.debug('Starting the poll scheduler')
+            self._timer = GLib.timeout_add_seconds(TICK, self._tick)
+
+    def stop(self):
+        """Stop polling."""
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+
+    def _tick(self):
+        if self.poll() and self._polled is not None:
+            self._polled()
+        # Keep the GLib timeout running.
+        return True
+
+    def schedules(self):
+        """Return the schedules for the accounts we currently have."""
+        with self._lock:
+            for account in list(self.accounts.values()):
+                for stream in account.protocol._POLL_STREAMS:
+                    key = (account.id, stream)
+                    if key not in self._schedules:
+                        schedule = StreamSchedule(account.id, stream)
+                        saved = self._get_saved().get(
+                            '{}/{}'.format(account.id, stream))
+                        if saved:
+                            schedule.restore(saved)
+                        self._schedules[key] = schedule
+            return [schedule for key, schedule in self._schedules.items()
+                    if key[0] in self.accounts]
+
+    def _get_saved(self):
+        if self._saved is None:
+            self._saved = JsonCache('poll-schedule')
+        return self._saved
+
+    def persist(self):
+        """Save every schedule, for the next time the dispatcher runs."""
+        saved = self._get_saved()
+        with self._lock:
+            saved.clear()
+            saved.update({
+                '{}/{}'.format(*key): schedule.save()
+                for key, schedule in self._schedules.items()
+                if key[0] in self.accounts})
+        saved.write()
+
+    def poll(self, now=None):
+        """Start polling every stream that is due, in sub-threads.
+
+        :return: The number of streams that were started.
+        """
+        if now is None:
+            now = time.time()
+        started = 0
+        for schedule in self.schedules():
+            with self._lock:
+                if schedule.polling or schedule.next_poll > now:
+                    continue
+                schedule.polling = True
+            account = self.accounts[schedule.account_id]
+            log.debug('Polling {} {}'.format(
+                account.protocol._Name, schedule.stream))
+            try:
+                account.protocol(
+                    schedule.stream,
+                    success=self._make_success(account, schedule),
+                    failure=self._make_failure(schedule),
+                    )
+            except NotImplementedError:
+                # This stream can't be polled, so don't ask again.
+                with self._lock:
+                    schedule.polling = False
+                    schedule.next_poll = float('inf')
+            else:
+                started += 1
+        return started
+
+    def _make_success(self, account, schedule):
+        def success(result):
+            # Callbacks run in the operation's own thread, which counts
+            # the rows that it has published and the bytes it fetched.
+            thread = threading.current_thread()
+            new_rows = getattr(thread, 'new_rows', 0)
+            duplicates = getattr(thread, 'duplicate_rows', 0)
+            size = getattr(thread, 'bytes_downloaded', 0)
+            requests = getattr(thread, 'pages', 1)
+            floor = account.protocol._poll_floor(schedule.stream, requests)
+            with self._lock:
+                schedule.polling = False
+                schedule.record(
+                    new_rows, time.time(), floor, duplicates, size)
+            log.debug(
+                '{} {}: {} new, {} duplicates, {} bytes, '
+                'next poll in {:.0f}s'.format(
+                    account.protocol._Name, schedule.stream, new_rows,
+                    duplicates, size, schedule.interval))
+        return success
+
+    def _make_failure(self, schedule):
+        def failure(message):
+            with self._lock:
+                schedule.polling = False
+                schedule.failed(time.time())
+        return failure
+
+    def stats(self, now=None):
+        """Return each stream's interval and yield, for tuning."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return sorted(
+                (schedule.as_dict(now)
+                 for schedule in self._schedules.values()),
+                key=lambda stats: (stats['account_id'], stats['stream']))
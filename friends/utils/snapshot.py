@@ -0,0 +1,270 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar snapshots of the model, for readers that want every row.
+
+Dee.SharedModel copies the whole model to each reader over D-Bus, which
+is why the model is kept small.  friends-dispatcher therefore also
+writes the model, along with older rows that have been pruned from it,
+to a file, in a simple columnar format that readers can mmap() and
+pick single columns or rows out of without copying the rest.
+SnapshotReader does that, and needs nothing but the standard library.
+
+The file is little-endian, and starts with a preamble:
+
+    magic       8 bytes, b'FRNDSNAP'
+    format      uint32, FORMAT
+    n_columns   uint32
+    n_rows      uint64
+    version     uint64, the model's sequence number
+
+followed by an entry for each column, in model schema order:
+
+    name        up to 32 bytes of UTF-8, padded with zero bytes
+    type        1 byte, the column's GVariant type: b, d, s or t
+    padding     7 bytes
+    offset      uint64, where the column's data starts in the file
+    size        uint64, how many bytes of data it has
+
+Booleans take one byte per row, doubles and uint64s eight.  Strings
+take n_rows + 1 uint64 offsets, followed by the UTF-8 data that the
+offsets point into.  Each column's data starts on an eight byte
+boundary.
+
+A new snapshot is renamed over the old one, so a reader that already
+has a snapshot open keeps seeing the version that it opened.
+"""
+
+
+__all__ = [
+    'SnapshotReader',
+    'write_snapshot',
+    ]
+
+
+import os
+import sys
+import mmap
+import struct
+
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+
+from friends.errors import ignored
+
+
+MAGIC = b'FRNDSNAP'
+FORMAT = 1
+
+PREAMBLE = struct.Struct('<8sIIQQ')
+ENTRY = struct.Struct('<32sc7xQQ')
+NAME_SIZE = 32
+
+# The array typecodes and struct formats for fixed size columns.
+TYPECODES = dict(d='d', t='Q')
+FORMATS = dict(d=struct.Struct('<d'), t=struct.Struct('<Q'))
+OFFSETS = struct.Struct('<QQ')
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _pack(values, typecode):
+    data = array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _unpack(data, typecode):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _encode(variant, values):
+    """Return the data for a column of the given type."""
+    if variant == 'b':
+        return bytes(1 if value else 0 for value in values)
+    if variant in TYPECODES:
+        return _pack(values, TYPECODES[variant])
+    if variant == 's':
+        strings = [value.encode('utf-8') for value in values]
+        offsets = [0]
+        offsets.extend(accumulate(len(string) for string in strings))
+        return _pack(offsets, 'Q') + b''.join(strings)
+    raise ValueError('Unsupported column type: {}'.format(variant))
+
+
+def write_snapshot(path, columns, rows, version):
+    """Write rows to a new snapshot at path.
+
+    :param columns: The (name, type) pair of each column, just like
+        Schema.COLUMNS.
+    :type columns: list
+    :param rows: The rows, each with a value for every column.
+    :type rows: iterable
+    :param version: A number that changes whenever the rows do.
+    :type version: int
+    :raises: ValueError if a column name is longer than NAME_SIZE bytes
+        of UTF-8, or a column's type is not supported.
+    """
+    names = [name.encode('utf-8') for name, variant in columns]
+    for name in names:
+        if len(name) > NAME_SIZE:
+            raise ValueError('Column name is too long: {}'.format(
+                name.decode('utf-8')))
+    rows = [tuple(row) for row in rows]
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    blobs = [_encode(variant, column)
+             for (name, variant), column in zip(columns, values)]
+
+    entries = []
+    offset = PREAMBLE.size + ENTRY.size * len(columns)
+    for name, (ignore, variant), blob in zip(names, columns, blobs):
+        offset = _align(offset)
+        entries.append(ENTRY.pack(
+            name, variant.encode('ascii'), offset, len(blob)))
+        offset += len(blob)
+
+    temp_path = path + '.new'
+    with ignored(FileExistsError):
+        os.makedirs(os.path.dirname(path))
+    with open(temp_path, 'wb') as snapshot:
+        snapshot.write(PREAMBLE.pack(
+            MAGIC, FORMAT, len(columns), len(rows), version))
+        snapshot.writelines(entries)
+        for blob in blobs:
+            position = snapshot.tell()
+            snapshot.write(bytes(_align(position) - position))
+            snapshot.write(blob)
+    os.rename(temp_path, path)
+
+
+class _Column(Sequence):
+    """One column of a snapshot, read from the mapped file on demand."""
+
+    def __init__(self, data, variant, offset, n_rows):
+        self._data = data
+        self._variant = variant
+        self._offset = offset
+        self._n_rows = n_rows
+        # Where the UTF-8 data of a string column starts.
+        self._strings = offset + 8 * (n_rows + 1)
+
+    def __len__(self):
+        return self._n_rows
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._n_rows))]
+        if i < 0:
+            i += self._n_rows
+        if not 0 <= i < self._n_rows:
+            raise IndexError('Snapshot row out of range')
+        if self._variant == 'b':
+            return self._data[self._offset + i] != 0
+        if self._variant == 's':
+            start, end = OFFSETS.unpack_from(
+                self._data, self._offset + 8 * i)
+            return self._data[
+                self._strings + start:self._strings + end].decode('utf-8')
+        return FORMATS[self._variant].unpack_from(
+            self._data, self._offset + 8 * i)[0]
+
+    def __iter__(self):
+        # Decode the whole column in one go, rather than value by value.
+        if self._variant == 'b':
+            data = self._data[self._offset:self._offset + self._n_rows]
+            return (byte != 0 for byte in data)
+        end = self._offset + 8 * self._n_rows
+        if self._variant in TYPECODES:
+            return iter(_unpack(
+                self._data[self._offset:end], TYPECODES[self._variant]))
+        offsets = _unpack(self._data[self._offset:end + 8], 'Q')
+        strings = self._data[self._strings:self._strings + offsets[-1]]
+        return (strings[start:end].decode('utf-8')
+                for start, end in zip(offsets, offsets[1:]))
+
+
+class SnapshotReader:
+    """Read a snapshot that write_snapshot() wrote, straight from disk.
+
+    The file is mapped into memory, and values are only decoded as they
+    are asked for, so reading one column of a big snapshot costs about
+    as much as that column is big.
+
+    example:
+        with SnapshotReader(path) as snapshot:
+            senders = snapshot.column('sender')
+            for i, message in enumerate(snapshot.column('message')):
+                print(senders[i], message)
+
+    :param path: Where the snapshot is, as GetSnapshot() says.
+    :type path: str
+    :raises: ValueError if the file is not a snapshot that this reader
+        understands.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self._data = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, file_format, n_columns, self.n_rows, self.version = (
+                PREAMBLE.unpack_from(self._data))
+            if magic != MAGIC or file_format != FORMAT:
+                raise ValueError('Not a version {} snapshot: {}'.format(
+                    FORMAT, path))
+            self.columns = []
+            self._entries = {}
+            for i in range(n_columns):
+                name, variant, offset, size = ENTRY.unpack_from(
+                    self._data, PREAMBLE.size + ENTRY.size * i)
+                name = name.rstrip(b'\0').decode('utf-8')
+                self.columns.append(name)
+                self._entries[name] = (variant.decode('ascii'), offset)
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        """Return a read-only sequence of the values in a column."""
+        variant, offset = self._entries[name]
+        return _Column(self._data, variant, offset, self.n_rows)
+
+    def row(self, i):
+        """Return the values in row i, as a tuple in column order."""
+        return tuple(self.column(name)[i] for name in self.columns)
+
+    def __iter__(self):
+        return zip(*(self.column(name) for name in self.columns))
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+        return False
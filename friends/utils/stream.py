@@ -0,0 +1,314 @@
+# friends-dispatcher -- send & receive messages from any social network
+# Copyright (C) 2013  Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Decode JSON a piece at a time, as it arrives.
+
+Instead of polling a timeline every few minutes, some services can keep
+one HTTP response open indefinitely and send each new message down it
+as it is posted, as one JSON object per line.  StreamReceiver keeps
+such a connection open in its own thread, and reconnects, with a
+growing delay, whenever it drops.
+
+Ordinary responses can be big, too, such as a thousand Facebook
+friends in one page.  JsonArrayDecoder picks the items out of the
+array in such a response one at a time, so that the whole response
+never has to be decoded in one go.
+"""
+
+
+__all__ = [
+    'JsonArrayDecoder',
+    'JsonLineDecoder',
+    'StreamReceiver',
+    ]
+
+
+import re
+import json
+import logging
+import threading
+
+from friends.utils import jsoncodec
+
+
+log = logging.getLogger(__name__)
+
+
+# How many bytes to ask for at a time.  Reads return as soon as there
+# is anything at all to return, so this is only an upper bound.
+CHUNK_SIZE = 4096
+
+# How many seconds to wait before reconnecting.  The delay doubles after
+# every failed attempt, and starts over once a connection delivers data.
+MIN_BACKOFF = 5
+MAX_BACKOFF = 320
+
+
+class JsonLineDecoder:
+    """Turn chunks of newline-delimited JSON into objects.
+
+    Chunks can end anywhere, even in the middle of a multibyte
+    character, so incomplete lines are held back until the rest of
+    them arrives.  Blank lines, which streaming APIs send to keep the
+    connection alive, are skipped.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Return the objects on the lines that chunk completes.
+
+        :param chunk: The next bytes from the stream.
+        :type chunk: bytes
+        :return: The decoded JSON objects, in the order they arrived.
+        :rtype: list
+        """
+        self._buffer.extend(chunk)
+        end = self._buffer.rfind(b'\n')
+        if end < 0:
+            return []
+        lines = self._buffer[:end].split(b'\n')
+        del self._buffer[:end + 1]
+        objects = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                objects.append(jsoncodec.loads(bytes(line)))
+            except ValueError:
+                log.error('Skipping undecodable stream line: {!r}'.format(
+                    bytes(line[:80])))
+        return objects
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_decode = json.JSONDecoder().raw_decode
+
+
+class JsonArrayDecoder:
+    """Turn chunks of a JSON document into the items of one array in it.
+
+    :param path: The key of the array in the top level object, or '' if
+        the whole document is the array.
+    :type path: str
+    :param rest: If given, this is filled in with the other keys in the
+        top level object, and the array's key maps to an empty list.
+    :type rest: dict
+
+    Only the item currently being decoded is kept in memory, along with
+    the rest of the top level object, which is usually small.
+    """
+
+    def __init__(self, path='', rest=None):
+        self._path = path
+        self._rest = {} if rest is None else rest
+        self._buffer = ''
+        self._state = 'array' if path == '' else 'object'
+        self._key = None
+
+    def feed(self, text):
+        """Return the array items that text completes.
+
+        :param text: The next piece of the document.
+        :type text: str
+        :return: The decoded items, in the order they arrived.
+        :rtype: list
+        :raises ValueError: if the document isn't shaped as expected.
+        """
+        self._buffer += text
+        items = []
+        pos = 0
+        while True:
+            pos = _whitespace.match(self._buffer, pos).end()
+            if pos == len(self._buffer):
+                break
+            char = self._buffer[pos]
+            state = self._state
+            if state == 'done':
+                raise ValueError('Extra data after the JSON document')
+            elif state in ('array', 'object'):
+                if char != ('[' if state == 'array' else '{'):
+                    raise ValueError('Expected {} at {!r}'.format(
+                        state, self._buffer[pos:pos + 20]))
+                pos += 1
+                self._state = 'items' if state == 'array' else 'key'
+            elif state == 'key':
+                if char == '}':
+                    pos += 1
+                    self._state = 'done'
+                    continue
+                if char == ',':
+                    pos += 1
+                    continue
+                try:
+                    key, end = _decode(self._buffer, pos)
+                except ValueError:
+                    # It isn't all here yet.
+                    break
+                colon = _whitespace.match(self._buffer, end).end()
+                if colon == len(self._buffer):
+                    break
+                if self._buffer[colon] != ':':
+                    raise ValueError('Expected : after {!r}'.format(key))
+                pos = colon + 1
+                self._key = key
+                self._state = 'value'
+            elif state == 'value':
+                if self._key == self._path and char == '[':
+                    pos += 1
+                    self._rest[self._key] = []
+                    self._state = 'items'
+                    continue
+                value, end = self._decode_complete(pos)
+                if end is None:
+                    break
+                self._rest[self._key] = value
+                pos = end
+                self._state = 'key'
+            elif state == 'items':
+                if char == ']':
+                    pos += 1
+                    self._state = 'key' if self._path else 'done'
+                    continue
+                if char == ',':
+                    pos += 1
+                    continue
+                item, end = self._decode_complete(pos)
+                if end is None:
+                    break
+                items.append(item)
+                pos = end
+        self._buffer = self._buffer[pos:]
+        return items
+
+    def _decode_complete(self, pos):
+        """Decode the value at pos, if the whole of it has arrived.
+
+        A number at the end of the buffer might still be missing some
+        digits, or its fraction or exponent, so a value only counts as
+        complete once the comma or bracket after it has arrived too.
+
+        :return: The value and where it ends, or (None, None).
+        """
+        try:
+            value, end = _decode(self._buffer, pos)
+        except ValueError:
+            return None, None
+        after = _whitespace.match(self._buffer, end).end()
+        if self._buffer[after:after + 1] not in (',', ']', '}'):
+            return None, None
+        return value, end
+
+    def close(self):
+        """Check that the whole document has been fed in.
+
+        :raises ValueError: if it hasn't.
+        """
+        if self._state != 'done' or self._buffer.strip():
+            raise ValueError('Incomplete JSON document')
+
+
+class StreamReceiver(threading.Thread):
+    """Hand each object from a streaming connection to a callback.
+
+    :param name: What to call this stream in the logs.
+    :type name: str
+    :param connect: Called to open the connection, and again every time
+        it needs reopening.  It returns an object with read(size) and
+        close() methods, where read() returns whatever data has arrived,
+        up to size bytes, or b'' once the connection is closed.
+    :type connect: callable
+    :param callback: Called with every decoded object, in this thread.
+    :type callback: callable
+    """
+
+    # How many receivers are running.  ManageTimers leaves these out
+    # when it waits for every other thread to finish.
+    running = 0
+    _running_lock = threading.Lock()
+
+    def __init__(self, name, connect, callback):
+        super().__init__(name=name, daemon=True)
+        self._connect = connect
+        self._callback = callback
+        self._stopped = threading.Event()
+        self._response = None
+        self.connections = 0
+        self.received = 0
+
+    def stop(self):
+        """Close the connection, and don't open it again."""
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            response.close()
+
+    def run(self):
+        with self._running_lock:
+            StreamReceiver.running += 1
+        try:
+            self._run()
+        finally:
+            with self._running_lock:
+                StreamReceiver.running -= 1
+
+    def _run(self):
+        backoff = MIN_BACKOFF
+        while not self._stopped.is_set():
+            try:
+                if self._receive():
+                    backoff = MIN_BACKOFF
+            except Exception as error:
+                if not self._stopped.is_set():
+                    log.error('{} stream failed: {}'.format(self.name, error))
+            if self._stopped.is_set():
+                break
+            log.info('Reconnecting {} stream in {} seconds'.format(
+                self.name, backoff))
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        log.debug('{} stream stopped'.format(self.name))
+
+    def _receive(self):
+        """Read from one connection until it closes.
+
+        :return: Whether anything at all arrived on this connection.
+        :rtype: bool
+        """
+        self._response = self._connect()
+        self.connections += 1
+        log.debug('{} stream connected'.format(self.name))
+        decoder = JsonLineDecoder()
+        got_data = False
+        try:
+            while not self._stopped.is_set():
+                chunk = self._response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                got_data = True
+                for obj in decoder.feed(chunk):
+                    self.received += 1
+                    try:
+                        self._callback(obj)
+                    except Exception:
+                        # One bad message shouldn't cost us the connection.
+                        log.exception('{} stream could not handle {!r}'
+                                      .format(self.name, obj))
+        finally:
+            self._response.close()
+            self._response = None
+        return got_data
@@ -21,6 +21,7 @@ using Ag;
 [DBus (name = "com.canonical.Friends.Dispatcher")]
 private interface Dispatcher : GLib.Object {
         public abstract void Refresh () throws GLib.IOError;
+        public abstract void RefreshDue () throws GLib.IOError;
         public abstract async void Do (
             string action,
             string account_id,
@@ -193,10 +194,12 @@ public class Master : Object
     {
         debug ("Interval is %d", interval);
         // By default, this happens immediately on startup, and then
-        // every 15 minutes thereafter.
+        // every 15 minutes thereafter.  The dispatcher's poll scheduler
+        // decides which streams are due, so this only polls those, and
+        // starts the dispatcher again if it has exited while idle.
         Timeout.add_seconds ((interval * 60), on_refresh);
         try {
-            dispatcher.Refresh ();
+            dispatcher.RefreshDue ();
         } catch (IOError e) {
             warning ("Failed to refresh - %s", e.message);
         }
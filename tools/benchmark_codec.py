@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_codec.py [REPEAT]
+
+Time decoding each protocol's fixture from friends/tests/data, scaled
+up to the size of a full page of results by repeating its items, with
+the json module and with friends.utils.jsoncodec.  Each page is
+decoded from bytes, the way HTTP.get_json() gets it, REPEAT (default
+50) times, and the best time is printed.
+
+If jsoncodec.BACKEND is 'json', there is no fast backend installed and
+both columns measure the same thing.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import json
+import time
+
+sys.path.insert(0, '.')
+
+from friends.utils import jsoncodec
+
+
+# Fixture, the path to its items, and how many items a full page has.
+PAGES = (
+    ('facebook-full.dat', ('data',), 50),
+    ('twitter-home.dat', (), 200),
+    ('linkedin_contacts.json', ('values',), 500),
+    ('instagram-full.dat', ('data',), 50),
+    ('foursquare-full.dat', ('response', 'recent'), 50),
+    ('flickr-full.dat', ('photos', 'photo'), 100),
+    )
+
+
+def scale(document, path, size):
+    """Repeat the items at path until there are size of them."""
+    container = document
+    for key in path[:-1]:
+        container = container[key]
+    if path:
+        items = container[path[-1]]
+    else:
+        items = document
+    items[:] = (items * (size // len(items) + 1))[:size]
+    return document
+
+
+def best(function, payload, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(payload)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    print('Backend: {}'.format(jsoncodec.BACKEND))
+    print('{:24} {:>5} {:>8} {:>10} {:>10}'.format(
+        'fixture', 'items', 'KiB', 'json ms', 'codec ms'))
+    for fixture, path, size in PAGES:
+        with open('friends/tests/data/' + fixture, 'rb') as fd:
+            document = json.loads(fd.read().decode('utf-8'))
+        payload = json.dumps(scale(document, path, size)).encode('utf-8')
+        stdlib = best(
+            lambda payload: json.loads(payload.decode('utf-8')),
+            payload, repeat)
+        codec = best(jsoncodec.loads, payload, repeat)
+        print('{:24} {:5} {:8.0f} {:10.2f} {:10.2f}'.format(
+            fixture, size, len(payload) / 1024, stdlib * 1000, codec * 1000))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_json.py [COUNT]
+
+Compare the peak memory used by Downloader.get_json() and
+Downloader.iter_json() on a Facebook style page of COUNT (default
+5000) friends, as measured by tracemalloc.
+
+The response body is handed over in 8 KiB chunks, the way libsoup
+receives it from the network.  It is allocated before measuring starts,
+just as libsoup's own copy of it would not show up in tracemalloc, so
+only the memory used for decoding is compared.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import json
+import tracemalloc
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import FakeSoupBuffer, mock
+
+from friends.utils.http import Downloader
+
+
+class StandInMessage:
+    chunk_size = 8192
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+        self._chunks = [
+            FakeSoupBuffer(data[offset:offset + self.chunk_size])
+            for offset in range(0, len(data), self.chunk_size)]
+        self.response_body = self.response_headers = self
+        self.request_headers = self
+
+    def new(self, method, url):
+        return self
+
+    def flatten(self):
+        # Soup.Buffer.get_data() copies the body into a new bytes object.
+        return FakeSoupBuffer(bytes(bytearray(self._data)))
+
+    def get_chunk(self, offset):
+        if offset >= len(self._data):
+            return None
+        return self._chunks[offset // self.chunk_size]
+
+    def get_content_type(self):
+        return 'application/json', {}
+
+    def append(self, header, value):
+        pass
+
+
+def peak(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def streamed():
+    # Handle each friend and let it go, the way contacts() would.
+    for friend in Downloader('http://example.com').iter_json('data'):
+        pass
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    page = dict(
+        data=[dict(name='Friend Number {}'.format(i), id=str(100000 + i))
+              for i in range(count)],
+        paging=dict(next='https://graph.facebook.com/me/friends?after=x'))
+    message = StandInMessage(json.dumps(page).encode('utf-8'))
+    del page
+
+    with mock.patch('friends.utils.http._soup'), \
+         mock.patch('friends.utils.http.Soup.Message', message):
+        print('{} friends, {:.0f} KiB response'.format(
+            count, len(message._data) / 1024))
+        print('get_json():            {:8.0f} KiB'.format(peak(
+            lambda: Downloader('http://example.com').get_json()) / 1024))
+        print('list(iter_json()):     {:8.0f} KiB'.format(peak(
+            lambda: list(Downloader('http://example.com').iter_json('data')))
+            / 1024))
+        print('iter_json(), streamed: {:8.0f} KiB'.format(
+            peak(streamed) / 1024))
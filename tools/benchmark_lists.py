@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_lists.py [LISTS] [LATENCY]
+
+Time Twitter.lists() against a fake Twitter server on localhost, which
+claims that we subscribe to LISTS (default 20) lists, and answers every
+request LATENCY milliseconds (default 200) after it arrives, with the
+tweets from friends/tests/data/twitter-home.dat.
+
+lists() is timed once fetching one list at a time, and once fetching
+Twitter._LIST_WORKERS lists at a time, going through the real
+Downloader and rate limiter both times.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import FakeAccount, TestModel, mock
+
+from friends.protocols.twitter import Twitter
+from friends.utils.cache import JsonCache
+
+
+class FakeTwitter(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    lists = 20
+    latency = 0.2
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    with open('friends/tests/data/twitter-home.dat', 'rb') as fd:
+        timeline = fd.read()
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith('/1.1/lists/list.json'):
+            body = json.dumps([
+                dict(id_str=str(i)) for i in range(self.server.lists)
+                ]).encode()
+        else:
+            body = self.timeline
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def time_lists(api_base, workers):
+    protocol = Twitter(FakeAccount())
+    protocol._api_base = api_base
+    protocol._lists = (
+        api_base.format(endpoint='lists/statuses') + '?list_id={}')
+    protocol._LIST_WORKERS = workers
+    protocol._get_oauth_headers = lambda **kws: {}
+    with mock.patch('friends.utils.base.Model', TestModel), \
+         mock.patch('friends.utils.base._seen_ids', {}):
+        start = time.perf_counter()
+        protocol.lists()
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    FakeTwitter.lists = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    FakeTwitter.latency = (
+        float(sys.argv[2]) if len(sys.argv) > 2 else 200) / 1000
+
+    server = FakeTwitter(('127.0.0.1', 0), FakeTwitterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_base = 'http://127.0.0.1:{}/1.1/{{endpoint}}.json'.format(
+        server.server_port)
+
+    # Keep the ids and rate limits of this run out of the real cache.
+    temp_cache = tempfile.mkdtemp()
+    JsonCache._root = temp_cache + '/{}.json'
+    try:
+        print('{} lists, {:.0f} ms latency'.format(
+            FakeTwitter.lists, FakeTwitter.latency * 1000))
+        for workers in (1, Twitter._LIST_WORKERS):
+            print('{} at a time: {:8.1f} ms'.format(
+                workers, time_lists(api_base, workers) * 1000))
+    finally:
+        server.shutdown()
+        shutil.rmtree(temp_cache)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_login.py [COUNT] [DELAY]
+
+Time COUNT (default 20) calls to Authentication.login() against a local
+stand-in for Signon, which answers DELAY milliseconds (default 20) after
+being asked, from another thread, just like the real callback arrives
+in MainThread while login() blocks a subthread.
+
+The average and worst login latencies are printed, so the overhead that
+login() adds on top of Signon's own response time is easy to see.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import time
+import threading
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import mock
+
+from friends.utils.authentication import Authentication
+
+
+class StandInSignon:
+    delay = 0.02
+
+    class AuthSession:
+        @classmethod
+        def new(cls, id, method):
+            return cls()
+
+        def process(self, parameters, mechanism, callback, user_data):
+            threading.Timer(
+                StandInSignon.delay, callback,
+                (self, dict(AccessToken='stand-in token'), None, user_data),
+                ).start()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    StandInSignon.delay = (
+        float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+
+    manager = mock.Mock()
+    manager.get_account().list_services.return_value = ['stand-in']
+
+    timings = []
+    with mock.patch('friends.utils.authentication.Signon', StandInSignon), \
+         mock.patch('friends.utils.authentication.manager', manager), \
+         mock.patch('friends.utils.authentication.Accounts'):
+        for i in range(count):
+            authenticator = Authentication(i)
+            start = time.perf_counter()
+            authenticator.login()
+            timings.append(time.perf_counter() - start)
+
+    print('Signon delay: {:.1f} ms'.format(StandInSignon.delay * 1000))
+    print('login() average: {:.1f} ms, worst: {:.1f} ms'.format(
+        sum(timings) / len(timings) * 1000, max(timings) * 1000))
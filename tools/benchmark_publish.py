@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_publish.py [THREADS] [ROWS]
+
+Have THREADS (default 8) protocol threads publish ROWS (default 500)
+new rows each into a stand-in SharedModel, whose appends take 0.2 ms
+each, standing in for the D-Bus traffic that each append causes.
+
+This is done twice: once the way friends used to do it, with every
+thread appending under _publish_lock itself, and once through the
+publish queue, with this script's main thread playing the main loop.
+For each, the wall time is printed, along with how long the threads
+spent inside _publish() altogether, which is mostly spent waiting,
+for _publish_lock or for the main loop to append their rows.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import time
+import threading
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import FakeAccount, mock
+
+from friends.utils import base
+from friends.utils.base import Base, _publish_lock, _publish_queue
+
+
+APPEND_COST = 0.0002
+
+
+class StandInModel:
+    def __init__(self):
+        self.rows = []
+
+    def append(self, *args):
+        time.sleep(APPEND_COST)
+        self.rows.append(args)
+        return len(self.rows) - 1
+
+    def get_position(self, row):
+        return row
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class Locked(Base):
+    """Publish the old way, holding _publish_lock in each thread."""
+
+    def _publish(self, **kwargs):
+        kwargs['protocol'] = self._name
+        kwargs['account_id'] = self._account.id
+        args = base.SCHEMA.build_row(**kwargs)
+        with _publish_lock:
+            return self._append_row(args, '', threading.current_thread())
+
+
+def publish(protocol, prefix, rows, spent):
+    start = time.perf_counter()
+    for i in range(rows):
+        protocol._publish(
+            message_id='{}-{}'.format(prefix, i),
+            stream='messages',
+            sender='Somebody',
+            message='Message number {}'.format(i),
+            timestamp='2013-10-18T12:00:00Z')
+    spent.append(time.perf_counter() - start)
+
+
+def run(protocol, threads, rows, idle):
+    model = StandInModel()
+    spent = []
+    with mock.patch('friends.utils.base.Model', model), \
+         mock.patch('friends.utils.base._seen_ids', {}):
+        workers = [
+            threading.Thread(target=publish,
+                             args=(protocol, n, rows, spent))
+            for n in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        # The main loop, which wakes up when the idle handler is added.
+        while any(worker.is_alive() for worker in workers):
+            if idle.wait(0.01):
+                idle.clear()
+                while _publish_queue._drain():
+                    pass
+        wall = time.perf_counter() - start
+    assert len(model) == threads * rows
+    return wall, sum(spent)
+
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print('{} threads publishing {} rows each'.format(threads, rows))
+    print('{:12} {:>10} {:>16}'.format('', 'wall s', 'in _publish() s'))
+    idle = threading.Event()
+    with mock.patch('friends.utils.base.GLib') as glib, \
+         mock.patch('friends.utils.base.Avatar'), \
+         mock.patch('friends.utils.base.Base._do_notify',
+                    return_value=False):
+        glib.idle_add.side_effect = lambda handler: idle.set()
+        for name, protocol in (('locked', Locked(FakeAccount())),
+                               ('queued', Base(FakeAccount()))):
+            wall, spent = run(protocol, threads, rows, idle)
+            print('{:12} {:10.2f} {:16.2f}'.format(name, wall, spent))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_refresh.py [COUNT] [PAUSE]
+
+Time COUNT (default 5) Refresh calls to friends-dispatcher over DBus,
+pausing PAUSE seconds (default 40) in between.
+
+Refresh() returns as soon as it has started polling, so each one is
+timed twice: until Refresh() replies, and until every operation that
+it started has sent OperationCompleted.  An operation counts as part
+of the refresh if its OperationStarted arrives before the others have
+all completed and SETTLE seconds have passed without another one
+starting.  Operations that other clients start in the meantime are
+counted too, so don't use friends while this runs.
+
+With the default pause, a dispatcher in the normal activate-and-exit
+mode will have shut itself down before every call, so each Refresh pays
+for DBus activation and the whole startup.  Run it again after
+
+    gsettings set com.canonical.friends resident true
+
+to compare against a resident dispatcher that is already warm.  The
+per-account receive times are in the friends log, as
+'<Protocol>.receive has completed in ...'.
+"""
+
+import sys
+import json
+import time
+import dbus
+
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+
+DBUS_INTERFACE = 'com.canonical.Friends.Dispatcher'
+OBJECT_PATH = '/com/canonical/friends/Dispatcher'
+
+# How long to wait for more operations to start, and for all of them
+# to finish, in seconds.
+SETTLE = 2
+TIMEOUT = 600
+
+
+class Refresh:
+    """Call Refresh() once, and wait for its operations to complete."""
+
+    def __init__(self, bus):
+        self.loop = GLib.MainLoop()
+        self.started = set()
+        self.completed = {}
+        self.new_rows = 0
+        self.replied = None
+        self.finished = None
+        self.last_started = None
+        self.error = None
+        self._receivers = [
+            bus.add_signal_receiver(
+                handler, signal_name=name, dbus_interface=DBUS_INTERFACE)
+            for name, handler in (('OperationStarted', self.on_started),
+                                  ('OperationCompleted', self.on_completed))]
+        self.bus = bus
+
+    def run(self):
+        self.start = time.perf_counter()
+        obj = self.bus.get_object(DBUS_INTERFACE, OBJECT_PATH)
+        dbus.Interface(obj, DBUS_INTERFACE).Refresh(
+            reply_handler=self.on_reply, error_handler=self.on_error)
+        sources = [GLib.timeout_add(100, self.check),
+                   GLib.timeout_add_seconds(TIMEOUT, self.on_timeout)]
+        self.loop.run()
+        for source in sources:
+            GLib.source_remove(source)
+        for receiver in self._receivers:
+            receiver.remove()
+
+    def on_reply(self):
+        self.replied = time.perf_counter()
+        self.last_started = self.last_started or self.replied
+
+    def on_error(self, error):
+        self.error = error
+        self.loop.quit()
+
+    def on_started(self, operation_id):
+        self.started.add(operation_id)
+        self.last_started = time.perf_counter()
+
+    def on_completed(self, operation_id, succeeded, counts):
+        if operation_id in self.started:
+            self.completed[operation_id] = bool(succeeded)
+            self.new_rows += json.loads(counts).get('new_rows', 0)
+            self.finished = time.perf_counter()
+
+    def pending(self):
+        return self.started.difference(self.completed)
+
+    def check(self):
+        if self.replied is None or self.pending():
+            return True
+        if time.perf_counter() - self.last_started >= SETTLE:
+            self.finished = self.finished or self.replied
+            self.loop.quit()
+        return True
+
+    def on_timeout(self):
+        self.error = 'Gave up after {} s with {} operations running'.format(
+            TIMEOUT, len(self.pending()))
+        self.loop.quit()
+        return True
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    pause = float(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    timings = []
+    for i in range(count):
+        if i:
+            time.sleep(pause)
+        running = bus.name_has_owner(DBUS_INTERFACE)
+        refresh = Refresh(bus)
+        refresh.run()
+        if refresh.error is not None:
+            sys.exit('Refresh {} failed: {}'.format(i + 1, refresh.error))
+        reply = refresh.replied - refresh.start
+        elapsed = refresh.finished - refresh.start
+        timings.append(elapsed)
+        print('Refresh {}: replied in {:8.1f} ms, done in {:8.1f} ms, '
+              '{} operations ({} failed), {} new rows ({})'.format(
+                  i + 1, reply * 1000, elapsed * 1000,
+                  len(refresh.completed),
+                  list(refresh.completed.values()).count(False),
+                  refresh.new_rows, 'warm' if running else 'activated'))
+    print('Best: {:.1f} ms, worst: {:.1f} ms'.format(
+        min(timings) * 1000, max(timings) * 1000))
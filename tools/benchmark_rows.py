@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_rows.py [ITERATIONS]
+
+Measure the per-row cost of turning _publish() keyword arguments into a
+Dee.SharedModel row.
+
+Every protocol is fed its canned test fixture, and the keyword arguments
+that it hands to _publish() are captured.  Those rows are then built
+repeatedly, both with the compiled SCHEMA.build_row() and with the
+column-by-column loop that _publish() used to run, and the average cost
+per row is printed for each protocol.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+import os
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import SCHEMA, FakeAccount, FakeSoupMessage, mock
+
+from friends.utils.cache import JsonCache
+from friends.protocols.facebook import Facebook
+from friends.protocols.flickr import Flickr
+from friends.protocols.foursquare import FourSquare
+from friends.protocols.instagram import Instagram
+from friends.protocols.linkedin import LinkedIn
+from friends.protocols.twitter import Twitter
+
+
+FIXTURES = [
+    (Facebook, 'facebook-full.dat'),
+    (Flickr, 'flickr-full.dat'),
+    (FourSquare, 'foursquare-full.dat'),
+    (Instagram, 'instagram-full.dat'),
+    (LinkedIn, 'linkedin_receive.json'),
+    (Twitter, 'twitter-home.dat'),
+    ]
+
+
+def legacy_build_row(kwargs):
+    """The column loop that _publish() ran before build_row() existed."""
+    args = []
+    for column_name, column_type in SCHEMA.COLUMNS:
+        args.append(kwargs.pop(column_name, SCHEMA.DEFAULTS[column_type]))
+    if len(kwargs) > 0:
+        raise TypeError('Unexpected keyword arguments: {}'.format(
+            ', '.join(sorted(kwargs))))
+    return args
+
+
+def capture_rows(protocol_class, fixture):
+    """Return the _publish() keyword arguments produced by a fixture."""
+    rows = []
+
+    def capture(self, **kwargs):
+        kwargs.update(protocol=self._name, account_id=self._account.id)
+        rows.append(kwargs)
+        return True
+
+    with mock.patch('friends.utils.base.Base._publish', capture), \
+         mock.patch('friends.utils.base.Base._get_access_token',
+                    mock.Mock(return_value='Access Tolkien')), \
+         mock.patch('friends.utils.base.Base._get_oauth_headers',
+                    mock.Mock(return_value={})), \
+         mock.patch('friends.utils.http._soup', mock.Mock()), \
+         mock.patch('friends.utils.http.Soup.Message',
+                    FakeSoupMessage('friends.tests.data', fixture)):
+        protocol = protocol_class(FakeAccount())
+        protocol._account.user_name = 'nobody'
+        protocol.receive()
+    return rows
+
+
+def timed(builder, rows, iterations):
+    """Return the average seconds spent building one row."""
+    start = time.perf_counter()
+    for i in range(iterations):
+        for row in rows:
+            builder(dict(row))
+    return (time.perf_counter() - start) / (iterations * len(rows))
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    temp_cache = tempfile.mkdtemp()
+    JsonCache._root = os.path.join(temp_cache, '{}.json')
+
+    compiled = lambda kwargs: SCHEMA.build_row(**kwargs)
+
+    print('{:12} {:>5} {:>12} {:>12} {:>8}'.format(
+        'protocol', 'rows', 'legacy (us)', 'compiled (us)', 'speedup'))
+    try:
+        for protocol_class, fixture in FIXTURES:
+            rows = capture_rows(protocol_class, fixture)
+            if not rows:
+                continue
+            legacy = timed(legacy_build_row, rows, iterations)
+            fast = timed(compiled, rows, iterations)
+            print('{:12} {:5} {:12.3f} {:12.3f} {:7.2f}x'.format(
+                protocol_class.__name__, len(rows),
+                legacy * 1e6, fast * 1e6, legacy / fast))
+    finally:
+        shutil.rmtree(temp_cache)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_snapshot.py [ROWS]
+
+Write a model snapshot of ROWS (default 20000) rows of tweet-sized
+messages, then time opening it and reading a single column, and
+reading every row, with friends.utils.snapshot.SnapshotReader.
+
+It is not intended for use with an installed friends package.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, '.')
+
+from friends.utils.model import Schema
+from friends.utils.snapshot import SnapshotReader, write_snapshot
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def read_column(path):
+    with SnapshotReader(path) as snapshot:
+        return list(snapshot.column('sender'))
+
+
+def read_all(path):
+    with SnapshotReader(path) as snapshot:
+        return list(snapshot)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    schema = Schema()
+    rows = [
+        schema.build_row(
+            protocol='twitter', account_id=6, message_id=str(10 ** 17 + i),
+            stream='messages', sender='Somebody Number {}'.format(i % 500),
+            sender_id=str(i % 500), timestamp='2013-10-18T12:00:00Z',
+            message='Message number {} '.format(i) + 'x' * 100,
+            icon_uri='https://pbs.twimg.com/profile_images/{}.png'.format(
+                i % 500),
+            url='https://twitter.com/somebody/status/{}'.format(i))
+        for i in range(count)]
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'model-snapshot.bin')
+        written, ignore = timed(
+            lambda: write_snapshot(path, schema.COLUMNS, rows, 1))
+        column, ignore = timed(lambda: read_column(path))
+        everything, ignore = timed(lambda: read_all(path))
+        print('{} rows, {:.0f} KiB snapshot'.format(
+            count, os.path.getsize(path) / 1024))
+        print('write:          {:8.1f} ms'.format(written * 1000))
+        print('read 1 column:  {:8.1f} ms'.format(column * 1000))
+        print('read all rows:  {:8.1f} ms'.format(everything * 1000))
+    finally:
+        shutil.rmtree(directory)
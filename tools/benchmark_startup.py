@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_startup.py [REPEAT]
+
+Show how long it takes to import each of the modules that
+friends-dispatcher loads at startup, and which GObject-introspection
+typelibs each of them drags in.
+
+Every module is imported in a fresh interpreter, so the times are
+cumulative: they include everything that module imports.  The best of
+REPEAT runs (default 5) is reported.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import json
+import subprocess
+
+
+MODULES = [
+    'gi.repository.GLib',
+    'friends.utils.model',
+    'friends.utils.http',
+    'friends.utils.authentication',
+    'friends.utils.avatar',
+    'friends.utils.notify',
+    'friends.utils.base',
+    'friends.utils.manager',
+    'friends.utils.account',
+    'friends.service.dispatcher',
+    ]
+
+
+PROBE = """\
+import sys, time, json
+sys.path.insert(0, '.')
+start = time.perf_counter()
+import {}
+elapsed = time.perf_counter() - start
+typelibs = sorted(name.rpartition('.')[2] for name in sys.modules
+                  if name.startswith('gi.repository.'))
+print(json.dumps(dict(elapsed=elapsed, typelibs=typelibs)))
+"""
+
+
+def probe(module):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(module)],
+        universal_newlines=True)
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for module in MODULES:
+        results = [probe(module) for i in range(repeat)]
+        best = min(result['elapsed'] for result in results)
+        print('{:32} {:8.1f} ms  {}'.format(
+            module, best * 1000, ' '.join(results[0]['typelibs'])))
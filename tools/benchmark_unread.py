@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Usage: ./tools/benchmark_unread.py [ROWS]
+
+Time the dispatcher's row-added handler over ROWS (default 2000) new
+rows, as they would arrive in one refresh, once updating the messaging
+menu for every row the way it used to, and once the way
+Dispatcher._increment_unread_count() does now.
+
+Updating the messaging menu is a D-Bus call, which is stood in for by
+a 0.1 ms sleep.  The rows are spread across the streams that a Twitter
+account fills.
+
+It is not intended for use with an installed friends package.
+"""
+
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+# Ignore system-installed schema.
+from friends.tests.mocks import mock
+
+from friends.service.dispatcher import Dispatcher
+
+
+STREAMS = ('messages', 'messages', 'mentions', 'private', 'list/1234')
+
+
+class StandInModel:
+    def get_value(self, itr, column):
+        return STREAMS[itr % len(STREAMS)]
+
+
+class StandInMenu:
+    updates = 0
+
+    def update_unread_count(self, count):
+        self.updates += 1
+        time.sleep(0.0001)
+
+
+def every_row(dispatcher, model, itr):
+    """The handler as it used to be."""
+    dispatcher._unread_count += 1
+    dispatcher.menu_manager.update_unread_count(dispatcher._unread_count)
+
+
+def run(handler, rows):
+    with mock.patch('dbus.service.BusName'), \
+         mock.patch('friends.service.dispatcher.find_accounts'), \
+         mock.patch('dbus.service.Object.__init__'):
+        dispatcher = Dispatcher(mock.Mock(), mock.Mock())
+    dispatcher.menu_manager = StandInMenu()
+    dispatcher._unread_count = 0
+    model = StandInModel()
+    start = time.perf_counter()
+    for itr in range(rows):
+        handler(dispatcher, model, itr)
+    elapsed = time.perf_counter() - start
+    # What the timer does once the refresh is over.
+    if dispatcher._unread_timer is not None:
+        dispatcher._update_unread_count()
+    return elapsed / rows, dispatcher.menu_manager.updates
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print('{} rows'.format(rows))
+    print('{:12} {:>12} {:>8}'.format('', 'us per row', 'updates'))
+    with mock.patch('friends.service.dispatcher.GLib.timeout_add',
+                    return_value=42), \
+         mock.patch('friends.service.dispatcher.Model'):
+        for name, handler in (
+                ('every row', every_row),
+                ('throttled', Dispatcher._increment_unread_count)):
+            per_row, updates = run(handler, rows)
+            print('{:12} {:12.1f} {:8}'.format(
+                name, per_row * 1e6, updates))